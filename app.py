@@ -1,14 +1,49 @@
 import streamlit as st
 import datetime
+import hashlib
 import json
+import math
 from rubicon_cs.main import geotiff_for_veg_index
+from rubicon_cs.download import RateLimitedDownloadClient
+from rubicon_cs.cache import resolve_cache
+from rubicon_cs.postprocess import colormap_lut, colorize_values
+from rubicon_cs.writers import read_overview
+import numpy as np
 import os
 import rasterio
-import matplotlib.pyplot as plt
-import io
-from PIL import Image
 
-def display_geotiff_streamlit(tiff_path, ncols=2, cmap='Greens', ):
+PREVIEW_SIZE = 1024
+
+
+@st.cache_resource
+def get_download_client():
+    """Client Sentinel Hub partagé entre les sessions et les reruns (pool de connexions, limites de débit, cache)."""
+    return RateLimitedDownloadClient.from_secrets(cache=resolve_cache(True))
+
+
+@st.cache_resource
+def get_colormap_lut(cmap):
+    """Table de couleurs précalculée une seule fois par colormap."""
+    return colormap_lut(cmap)
+
+
+@st.cache_data(show_spinner=False)
+def load_previews(tiff_path, mtime, cmap='Greens', max_size=PREVIEW_SIZE):
+    """
+    Aperçus RGB des bandes d’un GeoTIFF, lus depuis les overviews du COG et colorisés avec une LUT.
+
+    `mtime` fait partie de la clé du cache pour invalider l’aperçu si le fichier est régénéré.
+    """
+    lut = get_colormap_lut(cmap)
+    previews = []
+    with rasterio.open(tiff_path) as tiff:
+        for band in range(1, tiff.count + 1):
+            date = tiff.tags(band).get("DATE", "Date inconnue")
+            previews.append((date, colorize_values(read_overview(tiff, band, max_size), lut)))
+    return previews
+
+
+def display_geotiff_streamlit(tiff_path, ncols=2, cmap='Greens', max_size=PREVIEW_SIZE):
     """
     Affiche les bandes d’un fichier GeoTIFF dans Streamlit.
 
@@ -16,37 +51,50 @@ def display_geotiff_streamlit(tiff_path, ncols=2, cmap='Greens', ):
         tiff_path (str) : chemin du fichier GeoTIFF
         ncols (int) : nombre de colonnes dans l’affichage en grille
         cmap (str) : colormap Matplotlib
+        max_size (int) : taille maximale des aperçus en pixels
     """
-    with rasterio.open(tiff_path) as tiff:
-        nrows = (tiff.count // ncols) + (1 if tiff.count % ncols != 0 else 0)
-
-        fig, ax = plt.subplots(ncols=ncols, nrows=nrows, figsize=(10, 5 * nrows))
-        axes = ax.flatten() if tiff.count > 1 else [ax]
+    index_name = tiff_path.split('.tif')[-2].split('_')[-1].upper()
+    previews = load_previews(tiff_path, os.path.getmtime(tiff_path), cmap, max_size)
+    columns = st.columns(ncols)
+    for i, (acquisition_date, rgb) in enumerate(previews):
+        with columns[i % ncols]:
+            st.image(rgb, caption=f"{index_name} Index in AOI on {acquisition_date}", use_container_width=True)
+    display_colorbar(cmap)
 
-        for i in range(tiff.count):
-            band_data = tiff.read(i + 1)
 
-            # Metadata date
-            band_metadata = tiff.tags(i + 1)
-            acquisition_date = band_metadata.get("DATE", "Date inconnue")
+def display_colorbar(cmap, vmin=-1, vmax=1):
+    gradient = np.repeat(get_colormap_lut(cmap)[np.newaxis], 12, axis=0)
+    st.image(gradient, caption=f"{vmin} → {vmax}", use_container_width=True)
 
-            im = axes[i].imshow(band_data, cmap=cmap, vmin=-1, vmax=1)
-            axes[i].set_title(f"{tiff_path.split('.tif')[-2].split('_')[-1].upper()} Index in AOI on {acquisition_date}", fontsize=10)
-            axes[i].axis("off")
-            fig.colorbar(im, ax=axes[i], orientation='horizontal', shrink=0.7, pad=0.05)
 
-        for j in range(tiff.count, len(axes)):
-            axes[j].axis("off")  # désactive les cases en trop
+class BandStreamer:
+    """
+    Affiche chaque date dès que ses tuiles sont téléchargées, via le `progress_callback` de `geotiff_for_veg_index`.
 
-        plt.tight_layout()
+    Les tuiles sont sous-échantillonnées dans un canevas de la taille de l’aperçu.
+    """
 
-        # Sauvegarde de la figure dans un buffer
-        buf = io.BytesIO()
-        plt.savefig(buf, format="png", bbox_inches="tight", pad_inches=0.1)
-        buf.seek(0)
-        image = Image.open(buf)
-        st.image(image, caption="Aperçu des bandes du GeoTIFF", use_container_width=True)
-        plt.close(fig)
+    def __init__(self, container, index_name, cmap='Greens', max_size=PREVIEW_SIZE):
+        self.container = container
+        self.index_name = index_name
+        self.lut = get_colormap_lut(cmap)
+        self.max_size = max_size
+        self.canvases = {}
+        self.placeholders = {}
+
+    def __call__(self, date, window, array, plan):
+        step = max(1, math.ceil(max(plan.width, plan.height) / self.max_size))
+        if date not in self.canvases:
+            self.canvases[date] = np.full((math.ceil(plan.height / step), math.ceil(plan.width / step)), np.nan,
+                                          dtype=np.float32)
+            self.placeholders[date] = self.container.empty()
+
+        # First preview row/col of the tile, aligned on the sampling grid of the whole image
+        row, col = math.ceil(window.row_off / step), math.ceil(window.col_off / step)
+        tile = array[row * step - window.row_off::step, col * step - window.col_off::step]
+        self.canvases[date][row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+        self.placeholders[date].image(colorize_values(self.canvases[date], self.lut),
+                                      caption=f"{self.index_name} Index in AOI on {date}", use_container_width=True)
 
 
 st.set_page_config(page_title="Sélection des paramètres", layout="centered")
@@ -74,6 +122,7 @@ cloud_coverage = st.slider("Pourcentage max de nuages (%)", min_value=0, max_val
 st.subheader("📍 Zone d’étude (AOI.geojson)")
 uploaded_file = st.file_uploader("Importer un fichier .geojson", type=["geojson"])
 
+geojson_data = None
 if uploaded_file:
     try:
         geojson_data = json.load(uploaded_file)["features"][0]["geometry"]
@@ -83,34 +132,49 @@ if uploaded_file:
 
 # Traitement
 if st.button("🚀 Lancer l’analyse") and geojson_data:
-    st.info("Traitement en cours...")
-    with st.spinner("Génération du GeoTIFF..."):
-        geotiff_for_veg_index(
-            AOI=geojson_data,
-            date_range=(start_date, end_date),
-            veg_index=selected_index.lower(),
-            cloud_cover_limit=cloud_coverage,
-            output_dir = 'app_outputs/section_1'
-        )
-
-        # Chemin attendu du GeoTIFF généré
-        tif_path = f'app_outputs/section_1/{start_date}_{end_date}_{selected_index.lower()}.tif'
-
-        if os.path.exists(tif_path):
-            st.success("✅ GeoTIFF généré avec succès !")
-
-            # Affichage
-            st.subheader("🖼️ Aperçu du rendu")
-            with st.spinner("Génération du rendu..."):
-                display_geotiff_streamlit(tif_path, ncols=1, cmap='Greens')
-
-            # Téléchargement
-            with open(tif_path, "rb") as file:
-                st.download_button(
-                    label="💾 Télécharger le GeoTIFF",
-                    data=file,
-                    file_name=os.path.basename(tif_path),
-                    mime="application/octet-stream"
-                )
-        else:
-            st.error("❌ Le fichier GeoTIFF n’a pas été trouvé.")
+    # Un dossier par AOI et limite de nuages : les résultats déjà calculés pour ces paramètres sont réutilisés
+    aoi_key = hashlib.sha256(json.dumps(geojson_data, sort_keys=True).encode()).hexdigest()[:12]
+    output_dir = f'app_outputs/section_1/{aoi_key}_cc{cloud_coverage}'
+    tif_path = f'{output_dir}/{start_date}_{end_date}_{selected_index.lower()}.tif'
+    # Comme pour le catalogue, seule une période passée est figée : de nouvelles acquisitions peuvent encore
+    # arriver à partir d’aujourd’hui, le GeoTIFF d’une période qui n’est pas terminée est donc toujours régénéré
+    period_is_past = end_date < datetime.date.today()
+
+    if not (period_is_past and os.path.exists(tif_path)):
+        os.makedirs(output_dir, exist_ok=True)
+        st.info("Traitement en cours...")
+        # Les dates s’affichent au fil des téléchargements, puis laissent la place aux aperçus finaux
+        streaming = st.empty()
+        with st.spinner("Génération du GeoTIFF..."):
+            geotiff_for_veg_index(
+                AOI=geojson_data,
+                date_range=(start_date, end_date),
+                veg_index=selected_index.lower(),
+                cloud_cover_limit=cloud_coverage,
+                output_dir=output_dir,
+                download_client=get_download_client(),
+                progress_callback=BandStreamer(streaming.container(), selected_index),
+            )
+        streaming.empty()
+    st.session_state["tif_path"] = tif_path
+
+# Le dernier résultat reste affiché lors des reruns, à partir des aperçus en cache
+tif_path = st.session_state.get("tif_path")
+if tif_path:
+    if os.path.exists(tif_path):
+        st.success("✅ GeoTIFF généré avec succès !")
+
+        # Affichage
+        st.subheader("🖼️ Aperçu du rendu")
+        display_geotiff_streamlit(tif_path, ncols=1, cmap='Greens')
+
+        # Téléchargement
+        with open(tif_path, "rb") as file:
+            st.download_button(
+                label="💾 Télécharger le GeoTIFF",
+                data=file,
+                file_name=os.path.basename(tif_path),
+                mime="application/octet-stream"
+            )
+    else:
+        st.error("❌ Le fichier GeoTIFF n’a pas été trouvé.")
@@ -0,0 +1,187 @@
+"""
+Offline end-to-end benchmark of the rubicon_cs pipeline against a local Sentinel Hub mock (mock_sentinelhub.py).
+
+Times, without any Sentinel Hub account or quota:
+
+    - geotiff_for_veg_index: catalog search, concurrent index downloads and the Cloud-Optimized GeoTIFF writing;
+    - png_for_target_date: nearest date lookup and the RGB download;
+    - find_nearest_available_date: cold (empty in-process catalog index) and warm lookups;
+    - pad_to_multiple / extract_patches / semantic_segmentation_large_image / stitch_patches with a small
+      stand-in model.
+
+The raster size follows the AOI size (`--aoi-km`, 10 m pixels, downscaled to at most 2500 px unless `--tiled`),
+the mock latency and HTTP 429 rate are configurable. Each step is repeated and the median time is reported
+with the number of requests served by the mock. Results are printed and written as JSON, so runs can be
+compared for regressions.
+
+Usage:
+    PYTHONPATH=src python benchmarks/end_to_end.py --aoi-km 5 --dates 12 --latency 0.05 --rate-limit 0.1 \
+        --output end_to_end.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import numpy as np
+import sentinelhub
+import torch
+
+from mock_sentinelhub import MockSentinelHub
+from inference_scaling import StandInSegmentationModel
+from rubicon_cs import catalog
+from rubicon_cs.download import RateLimitedDownloadClient
+from rubicon_cs.main import geotiff_for_veg_index, png_for_target_date
+from rubicon_cs.patches import extract_patches, pad_to_multiple, stitch_patches
+from rubicon_cs.segmentation import semantic_segmentation_large_image
+from rubicon_cs.utils import find_nearest_available_date
+
+
+def square_aoi(size_km, lon=2.35, lat=48.85):
+    """GeoJSON square of about `size_km` per side centered on (lon, lat)."""
+    half_lat = size_km / 2 / 111.32
+    half_lon = half_lat / np.cos(np.radians(lat))
+    ring = [[lon - half_lon, lat - half_lat], [lon + half_lon, lat - half_lat], [lon + half_lon, lat + half_lat],
+            [lon - half_lon, lat + half_lat], [lon - half_lon, lat - half_lat]]
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+@contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def measure(name, server, function, repeats, setup=None):
+    """Run `function` `repeats` times and summarize its timings and the requests it sent to the mock."""
+    timings, counters = [], []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        before = dict(server.counters) if server is not None else {}
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+        if server is not None:
+            counters.append({key: value - before.get(key, 0) for key, value in server.counters.items()})
+
+    result = {"step": name, "repeats": repeats, "median_seconds": statistics.median(timings),
+              "min_seconds": min(timings), "max_seconds": max(timings)}
+    if counters:
+        result["requests"] = counters[-1]
+    print(f"{name:>40}: {result['median_seconds']:8.3f} s median ({min(timings):.3f}-{max(timings):.3f})"
+          + (f", requests {result['requests']}" if counters else ""))
+    return result
+
+
+def run_pipeline(args, server, workdir):
+    config = server.config()
+    client = RateLimitedDownloadClient(config=config, base_url=server.url, cache=None, backoff_factor=0.05)
+    aoi = square_aoi(args.aoi_km)
+    start = date(2024, 6, 1)
+    date_range = (start.isoformat(), (start + timedelta(days=args.dates * server.revisit_days - 1)).isoformat())
+    target_date = (start + timedelta(days=7)).isoformat()
+    geometry = sentinelhub.Geometry.from_geojson(aoi, crs=sentinelhub.CRS.WGS84)
+    sh_catalog = client.catalog
+
+    def clear_catalog_index():
+        with catalog._INDEXES_LOCK:
+            catalog._INDEXES.clear()
+
+    def nearest_date():
+        find_nearest_available_date(sh_catalog, sentinelhub.DataCollection.SENTINEL2_L2A, geometry, target_date,
+                                    cloud_cover_limit=args.cloud_cover_limit)
+
+    def veg_index_geotiff():
+        geotiff_for_veg_index(aoi, date_range, cloud_cover_limit=args.cloud_cover_limit,
+                              output_dir=workdir, tiled=args.tiled,
+                              max_workers=args.workers, download_client=client, cache=False)
+
+    def rgb_png():
+        with working_directory(workdir):  # the PNG is written to the current directory
+            png_for_target_date(aoi, target_date, cloud_cover_limit=args.cloud_cover_limit, tiled=args.tiled,
+                                max_workers=args.workers, download_client=client, cache=False)
+
+    return [
+        measure("find_nearest_available_date (cold)", server, nearest_date, args.repeats, setup=clear_catalog_index),
+        measure("find_nearest_available_date (warm)", server, nearest_date, args.repeats),
+        measure("geotiff_for_veg_index", server, veg_index_geotiff, args.repeats, setup=clear_catalog_index),
+        measure("png_for_target_date", server, rgb_png, args.repeats, setup=clear_catalog_index),
+    ]
+
+
+def run_inference(args):
+    torch.manual_seed(0)
+    model = StandInSegmentationModel().eval()
+    image = torch.rand(3, args.image_size, args.image_size)
+    patch_size = args.patch_size
+    state = {}
+
+    def pad():
+        state["padded"], _, _ = pad_to_multiple(image, patch_size)
+
+    def extract():
+        state["patches"] = extract_patches(state["padded"], patch_size)
+
+    def segment():
+        with torch.inference_mode():
+            state["logits"] = semantic_segmentation_large_image(image, model, "cpu", patch_size=patch_size,
+                                                                batch_size=args.batch_size)
+
+    def stitch():
+        stitch_patches(state["patches"], state["padded"].shape, patch_size)
+
+    return [
+        measure("pad_to_multiple", None, pad, args.repeats),
+        measure("extract_patches", None, extract, args.repeats),
+        measure("semantic_segmentation_large_image", None, segment, args.repeats),
+        measure("stitch_patches", None, stitch, args.repeats),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--aoi-km", type=float, default=5.0, help="Side of the square AOI in km (10 m pixels)")
+    parser.add_argument("--tiled", action="store_true", help="Fetch at native resolution as tiles")
+    parser.add_argument("--dates", type=int, default=12, help="Number of revisits in the date range")
+    parser.add_argument("--cloud-cover-limit", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent downloads")
+    parser.add_argument("--latency", type=float, default=0.02, help="Mock latency in seconds per response")
+    parser.add_argument("--latency-per-megapixel", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Fraction of process requests getting a 429")
+    parser.add_argument("--image-size", type=int, default=1024, help="Width/height of the inference scene")
+    parser.add_argument("--patch-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default="end_to_end.json", help="Path of the JSON results")
+    args = parser.parse_args()
+
+    with MockSentinelHub(latency=args.latency, latency_per_megapixel=args.latency_per_megapixel,
+                         rate_limit_probability=args.rate_limit) as server, \
+            tempfile.TemporaryDirectory() as workdir:
+        results = run_pipeline(args, server, workdir)
+        total_requests = dict(server.counters)
+    results += run_inference(args)
+
+    with open(args.output, "w") as file:
+        json.dump({
+            "benchmark": "end_to_end",
+            "parameters": vars(args),
+            "environment": {"python": platform.python_version(), "numpy": np.__version__, "torch": torch.__version__,
+                            "sentinelhub": sentinelhub.__version__, "cpu_count": os.cpu_count()},
+            "mock_requests": total_requests,
+            "results": results,
+        }, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
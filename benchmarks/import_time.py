@@ -0,0 +1,86 @@
+"""
+Import-time budget check of the rubicon_cs entry points.
+
+Each module is imported in a fresh interpreter, several times, and the median import time and peak RSS are
+reported. Fetch-only entry points must stay under their time budget and must not load the heavy modules of
+the other paths (torch, streamlit, matplotlib). Exits with status 1 if a budget is exceeded or a forbidden
+module is loaded, so it can be run as a regression check. Results are printed and written as JSON.
+
+Usage:
+    PYTHONPATH=src python benchmarks/import_time.py --repeats 5 --output import_time.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ("torch", "streamlit", "matplotlib", "pandas", "xarray", "onnxruntime")
+
+# (module, time budget in seconds or None to only report, modules that must not be imported)
+TARGETS = [
+    ("rubicon_cs.config", 0.2, ("torch", "streamlit", "sentinelhub")),
+    ("rubicon_cs.main", 1.5, ("torch", "streamlit", "matplotlib")),
+    ("rubicon_cs.cli", 1.5, ("torch", "streamlit", "matplotlib")),
+    ("rubicon_cs.postprocess", 1.0, ("torch", "streamlit", "sentinelhub")),
+    ("rubicon_cs.segmentation", None, ("streamlit", "sentinelhub")),
+]
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(module, repeats):
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "median_seconds": statistics.median(run["seconds"] for run in runs),
+        "max_rss_mb": max(run["max_rss_mb"] for run in runs),
+        "loaded": runs[-1]["loaded"],
+    }
+
+
+def run(repeats, budget_scale=1.0):
+    results = []
+    for module, budget, forbidden in TARGETS:
+        result = {"module": module, **measure(module, repeats)}
+        result["budget_seconds"] = budget * budget_scale if budget is not None else None
+        result["forbidden_loaded"] = [name for name in forbidden if name in result["loaded"]]
+        result["ok"] = not result["forbidden_loaded"] and (
+            budget is None or result["median_seconds"] <= result["budget_seconds"]
+        )
+        results.append(result)
+        budget_text = f"budget {result['budget_seconds']:.2f} s" if budget is not None else "no budget"
+        print(f"{module:>24}: {result['median_seconds']:6.2f} s ({budget_text}), {result['max_rss_mb']:6.0f} MB RSS, "
+              f"loads {', '.join(result['loaded']) or 'no heavy module'}"
+              + ("" if result["ok"] else "  <-- FAIL"))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5, help="Fresh interpreters per module")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="Multiplier of the budgets, for slow machines")
+    parser.add_argument("--output", default="import_time.json", help="Path of the JSON results")
+    args = parser.parse_args()
+
+    results = run(args.repeats, args.budget_scale)
+    with open(args.output, "w") as file:
+        json.dump({"benchmark": "import_time", "python": sys.version.split()[0], "results": results}, file, indent=2)
+
+    ok = all(result["ok"] for result in results)
+    print("All imports within budget" if ok else "Import budget exceeded or heavy module loaded")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
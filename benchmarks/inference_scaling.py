@@ -0,0 +1,85 @@
+"""
+Scaling benchmark of the multi-process CPU inference engine (rubicon_cs.parallel.InferencePool).
+
+Runs the patch inference of a synthetic scene with a small stand-in convolutional model, first in the
+calling process and then with an increasing number of single-threaded workers, and reports the patches
+per second of each run. Results are printed and written as JSON.
+
+Usage:
+    python benchmarks/inference_scaling.py --size 2048 --workers 1 2 4 8 --output inference_scaling.json
+"""
+import argparse
+import json
+import os
+import time
+
+import torch
+
+from rubicon_cs.segmentation import semantic_segmentation_large_image
+from rubicon_cs.parallel import InferencePool
+
+
+class StandInSegmentationModel(torch.nn.Module):
+    """Small fully convolutional model with the same interface as the Satlas model: model(x)[0] are the logits."""
+
+    def __init__(self, in_channels=3, num_classes=12, width=32, depth=4):
+        super().__init__()
+        layers = []
+        for k in range(depth):
+            layers += [torch.nn.Conv2d(in_channels if k == 0 else width, width, 3, padding=1), torch.nn.ReLU()]
+        self.features = torch.nn.Sequential(*layers)
+        self.head = torch.nn.Conv2d(width, num_classes, 1)
+
+    def forward(self, x):
+        return self.head(self.features(x)), None
+
+
+def run(size, workers, patch_size, batch_size, repeats):
+    torch.manual_seed(0)
+    model = StandInSegmentationModel().eval()
+    image = torch.rand(3, size, size)
+    num_patches = (size // patch_size) ** 2
+    kwargs = dict(patch_size=patch_size, batch_size=batch_size, output='class_map', nodata_value=None)
+
+    results = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        semantic_segmentation_large_image(image, model, torch.device("cpu"), **kwargs)
+    elapsed = (time.perf_counter() - start) / repeats
+    results.append({"mode": "single_process", "workers": 1, "threads": torch.get_num_threads(),
+                    "seconds": elapsed, "patches_per_second": num_patches / elapsed})
+
+    for num_workers in workers:
+        with InferencePool(model, num_workers=num_workers, threads_per_worker=1) as pool:
+            pool.segment_large_image(image, **kwargs)  # warm up the workers
+            start = time.perf_counter()
+            for _ in range(repeats):
+                pool.segment_large_image(image, **kwargs)
+            elapsed = (time.perf_counter() - start) / repeats
+        results.append({"mode": "pool", "workers": num_workers, "threads": 1,
+                        "seconds": elapsed, "patches_per_second": num_patches / elapsed})
+
+    for result in results:
+        print(f"{result['mode']:>15} workers={result['workers']:<3} threads={result['threads']:<3} "
+              f"{result['patches_per_second']:8.2f} patches/s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2048, help="Width/height of the synthetic scene")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}), help="Worker counts to benchmark")
+    parser.add_argument("--patch-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default="inference_scaling.json", help="Path of the JSON results")
+    args = parser.parse_args()
+
+    results = run(args.size, args.workers, args.patch_size, args.batch_size, args.repeats)
+    with open(args.output, "w") as file:
+        json.dump({"benchmark": "inference_scaling", "cpu_count": os.cpu_count(), "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Local stand-in for the Sentinel Hub services used by rubicon_cs, for offline benchmarks.
+
+Serves the OAuth token endpoint, the Catalog API search and the Process API with synthetic data:
+
+    - the catalog returns one acquisition every `revisit_days` days, each with a deterministic cloud cover,
+      and applies the `eo:cloud_cover < N` filter and pagination;
+    - the process endpoint renders a smooth synthetic raster of the requested size, number of output bands
+      and sample type (parsed from the evalscript) as a TIFF or PNG.
+
+Every response is delayed by `latency` seconds (plus `latency_per_megapixel` for process requests), and a
+`rate_limit_probability` fraction of the process requests get an HTTP 429 with a Retry-After header.
+
+Usage:
+    with MockSentinelHub(latency=0.05, rate_limit_probability=0.1) as server:
+        config = server.config()
+        client = RateLimitedDownloadClient(config=config, base_url=server.url)
+        geotiff_for_veg_index(AOI, date_range, download_client=client, cache=False)
+
+    python benchmarks/mock_sentinelhub.py --port 8000  # serve until interrupted
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+import warnings
+from collections import Counter
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import numpy as np
+from PIL import Image
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.io import MemoryFile
+from sentinelhub import SHConfig
+
+TOKEN_PATH = "/auth/realms/main/protocol/openid-connect/token"
+CATALOG_SEARCH_PATH = "/api/v1/catalog/1.0.0/search"
+PROCESS_PATH = "/api/v1/process"
+FIRST_ACQUISITION = date(2020, 1, 1)
+
+SAMPLE_TYPES = {"UINT8": np.uint8, "UINT16": np.uint16, "INT16": np.int16, "FLOAT32": np.float32, "AUTO": np.uint8}
+
+
+def _seed(*parts):
+    return int(hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:8], 16)
+
+
+def encode_tiff(raster):
+    """Encode a (H, W, bands) raster as a pixel-interleaved TIFF, decoded back to (H, W, bands) like Sentinel Hub's."""
+    height, width, bands = raster.shape
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with MemoryFile() as memory_file:
+            with memory_file.open(driver="GTiff", width=width, height=height, count=bands, dtype=raster.dtype,
+                                  interleave="pixel") as dst:
+                dst.write(np.moveaxis(raster, -1, 0))
+            return memory_file.read()
+
+
+def synthetic_raster(width, height, bands, sample_type, seed):
+    """Smooth (height, width, bands) raster with a dtype and value range matching the sample type."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    layers = []
+    for _ in range(bands):
+        fx, fy, phase = rng.uniform(0.002, 0.02), rng.uniform(0.002, 0.02), rng.uniform(0, 2 * np.pi)
+        layers.append(0.5 + 0.5 * np.sin(x * fx + phase) * np.cos(y * fy))  # in [0, 1]
+    raster = np.stack(layers, axis=-1)
+
+    if sample_type == "FLOAT32":
+        raster = raster * 0.6  # reflectance-like values
+    elif sample_type == "INT16":
+        raster = (raster * 2 - 1) * 10000  # quantized index in [-1, 1] with scale 1e-4
+    elif sample_type == "UINT16":
+        raster = raster * 10000
+    else:
+        raster = raster * 255
+    return raster.astype(SAMPLE_TYPES[sample_type])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "MockSentinelHub/1.0"
+    protocol_version = "HTTP/1.1"  # keep-alive, like Sentinel Hub
+
+    def setup(self):
+        super().setup()
+        self.server.mock.count("connections")
+
+    def log_message(self, *_):
+        pass
+
+    def do_POST(self):
+        mock = self.server.mock
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(mock.latency)
+
+        if self.path.startswith(TOKEN_PATH):
+            mock.count("token")
+            form = parse_qs(body.decode())
+            if not form.get("client_id"):
+                return self._send_json(401, {"error": "invalid_client"})
+            return self._send_json(200, {"access_token": "mock-token", "token_type": "Bearer", "expires_in": 3600})
+
+        if self.headers.get("Authorization") != "Bearer mock-token":
+            return self._send_json(401, {"error": "Unauthorized"})
+
+        if self.path.startswith(CATALOG_SEARCH_PATH):
+            mock.count("catalog")
+            return self._send_json(200, mock.search(json.loads(body)))
+
+        if self.path.startswith(PROCESS_PATH):
+            mock.count("process")
+            if mock.rng_random() < mock.rate_limit_probability:
+                mock.count("rate_limited")
+                return self._send_json(429, {"error": "Too many requests"}, {"Retry-After": str(mock.retry_after_ms)})
+            content, content_type, processing_units = mock.process(json.loads(body))
+            mock.count("bytes", len(content))
+            return self._send(200, content, content_type, {"X-ProcessingUnits-Spent": f"{processing_units:.3f}"})
+
+        self._send_json(404, {"error": f"Unknown endpoint {self.path}"})
+
+    def _send_json(self, status, payload, headers=None):
+        self._send(status, json.dumps(payload).encode(), "application/json", headers)
+
+    def _send(self, status, content, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class MockSentinelHub:
+    """
+    Threaded local HTTP server mimicking the Sentinel Hub OAuth, Catalog and Process APIs.
+
+    Parameters:
+        port (int): Port to listen on, 0 picks a free one. Default is 0.
+        latency (float): Delay in seconds added to every response. Default is 0.
+        latency_per_megapixel (float): Extra delay of process responses per requested megapixel. Default is 0.
+        rate_limit_probability (float): Fraction of process requests answered with HTTP 429. Default is 0.
+        retry_after_ms (int): Retry-After header of the 429 responses, in milliseconds. Default is 100.
+        revisit_days (int): Days between two acquisitions in the catalog. Default is 5.
+        seed (int): Seed of the 429 draws. Default is 0.
+    """
+
+    def __init__(self, port=0, latency=0.0, latency_per_megapixel=0.0, rate_limit_probability=0.0,
+                 retry_after_ms=100, revisit_days=5, seed=0):
+        self.latency = latency
+        self.latency_per_megapixel = latency_per_megapixel
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after_ms = retry_after_ms
+        self.revisit_days = revisit_days
+        self.counters = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def config(self):
+        """SHConfig pointing at the mock server, with dummy credentials."""
+        # oauthlib refuses to fetch tokens over plain HTTP otherwise
+        os.environ.setdefault("OAUTHLIB_INSECURE_TRANSPORT", "1")
+        return SHConfig(
+            sh_client_id="mock-client", sh_client_secret="mock-secret",
+            sh_base_url=self.url, sh_token_url=f"{self.url}{TOKEN_PATH}", use_defaults=True
+        )
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def rng_random(self):
+        with self._lock:
+            return self._rng.random()
+
+    def search(self, payload):
+        """Catalog search over a (start, end) datetime interval with an optional eo:cloud_cover filter."""
+        start, end = (value[:10] for value in payload["datetime"].split("/"))
+        match = re.search(r"eo:cloud_cover\s*<\s*([\d.]+)", str(payload.get("filter") or ""))
+        cloud_limit = float(match.group(1)) if match else 100.0
+
+        features = []
+        day = FIRST_ACQUISITION + timedelta(days=-(-(date.fromisoformat(start) - FIRST_ACQUISITION).days
+                                                   // self.revisit_days) * self.revisit_days)
+        while day <= date.fromisoformat(end):
+            cloud_cover = _seed(day.isoformat()) % 60  # 0-59 %, so a third of the dates have more than 40 %
+            if cloud_cover < cloud_limit:
+                features.append({
+                    "type": "Feature",
+                    "id": f"S2_MOCK_{day:%Y%m%d}",
+                    "properties": {"datetime": f"{day.isoformat()}T10:30:00Z", "eo:cloud_cover": cloud_cover},
+                })
+            day += timedelta(days=self.revisit_days)
+
+        offset, limit = int(payload.get("next") or 0), int(payload.get("limit") or 100)
+        page = features[offset:offset + limit]
+        next_offset = offset + limit if offset + limit < len(features) else None
+        return {"type": "FeatureCollection", "features": page,
+                "context": {"limit": limit, "returned": len(page), "next": next_offset}}
+
+    def process(self, payload):
+        """Render the synthetic response of a process request, returning (content, content type, PUs)."""
+        output = payload["output"]
+        width, height = int(output["width"]), int(output["height"])
+        evalscript = payload["evalscript"]
+        bands_match = re.search(r"bands:\s*(\d+)", evalscript)
+        bands = int(bands_match.group(1)) if bands_match else 3
+        sample_match = re.search(r'sampleType:\s*"(\w+)"', evalscript)
+        sample_type = sample_match.group(1) if sample_match else "AUTO"
+        image_format = output["responses"][0]["format"]["type"]
+
+        time_range = payload["input"]["data"][0]["dataFilter"]["timeRange"]
+        seed = _seed(time_range["from"][:10], payload["input"]["bounds"].get("bbox"), bands, sample_type)
+        time.sleep(self.latency_per_megapixel * width * height / 1e6)
+
+        buffer = io.BytesIO()
+        if image_format == "image/png":
+            raster = synthetic_raster(width, height, bands, "UINT8", seed)
+            Image.fromarray(raster.squeeze(-1) if bands == 1 else raster).save(buffer, format="PNG")
+        else:
+            raster = synthetic_raster(width, height, bands, sample_type, seed)
+            buffer.write(encode_tiff(raster))
+        processing_units = max(width * height / 512 ** 2, 0.01) * max(bands / 3, 1)
+        return buffer.getvalue(), image_format, processing_units
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--latency-per-megapixel", type=float, default=0.0)
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0, help="Fraction of HTTP 429 responses")
+    args = parser.parse_args()
+
+    server = MockSentinelHub(args.port, args.latency, args.latency_per_megapixel, args.rate_limit_probability)
+    print(f"Mock Sentinel Hub listening on {server.url}, token URL {server.url}{TOKEN_PATH}")
+    server.start()
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Reconstruction error and size of the quantized index formats (rubicon_cs.quantize).
+
+For each vegetation index, computes the index from a synthetic mix of vegetation, soil, water and cloud
+Sentinel-2 reflectances with the local formulas, quantizes it as the quantized evalscripts do and dequantizes
+it. Checks that:
+
+    - every value inside the quantized range is restored within half a quantization step, and every value
+      outside it saturates at the nearest edge;
+    - the fraction of such saturated values stays under --max-clipped;
+    - with Node.js installed, the quantized evalscripts themselves, run on a sample of the pixels, return
+      the integers of `quantize` (up to one step on rounding ties between float32 and float64), and the RGB
+      evalscripts return values in [0, 1], which their AUTO sample type stretches to UINT8 without clipping.
+
+Also reports the raw and deflate-compressed sizes against FLOAT32. Exits with status 1 if a check fails.
+Results are printed and written as JSON.
+
+Usage:
+    python benchmarks/quantization_error.py --pixels 1000000 --max-clipped 0.02 --output quantization_error.json
+"""
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import zlib
+
+import numpy as np
+
+from rubicon_cs.evalscripts import INDEX_DICT
+from rubicon_cs.indices import INDEX_FORMULAS, compute_indices, required_bands
+from rubicon_cs.quantize import (
+    QUANTIZATIONS, RGB_QUANTIZATION, build_quantized_index_evalscript, dequantize, get_quantization,
+    max_quantization_error, quantize, quantized_range,
+)
+
+# Typical reflectances of B02, B03, B04, B05 and B08
+ENDMEMBERS = np.array([
+    [0.03, 0.07, 0.04, 0.12, 0.40],  # vegetation
+    [0.10, 0.14, 0.18, 0.22, 0.28],  # bare soil
+    [0.06, 0.05, 0.03, 0.02, 0.01],  # water
+    [0.45, 0.45, 0.45, 0.46, 0.50],  # cloud
+])
+ENDMEMBER_BANDS = ["B02", "B03", "B04", "B05", "B08"]
+RGB_EVALSCRIPTS = ("rgb", "rgb_optimized")
+
+
+def synthetic_bands(pixels, seed=0):
+    """Mixed endmember reflectances with multiplicative and additive noise, and 5% of nodata pixels."""
+    rng = np.random.default_rng(seed)
+    bands = required_bands(list(INDEX_FORMULAS))
+    assert bands == ENDMEMBER_BANDS
+    stack = rng.dirichlet(np.full(len(ENDMEMBERS), 0.3), pixels) @ ENDMEMBERS
+    stack = stack * rng.normal(1.0, 0.1, stack.shape) + rng.normal(0.0, 0.005, stack.shape)
+    stack = np.clip(stack, 0.0, None).astype(np.float32)[np.newaxis]
+    data_mask = (rng.random((1, pixels)) > 0.05).astype(np.float32)
+    return stack, bands, data_mask
+
+
+def run_evalscript(evalscript, samples):
+    """Return the `evaluatePixel` outputs of an evalscript on sample dicts, run with Node.js, or None without it."""
+    node = shutil.which("node")
+    if node is None:
+        return None
+    script = (evalscript + "\nconst samples = JSON.parse(require('fs').readFileSync(0, 'utf8'));\n"
+              "process.stdout.write(JSON.stringify(samples.map((sample) => evaluatePixel(sample))));\n")
+    result = subprocess.run([node, "-e", script], input=json.dumps(samples), capture_output=True, text=True,
+                            check=True)
+    return np.array(json.loads(result.stdout), dtype=np.float64)
+
+
+def evalscript_samples(stack, bands, data_mask, count):
+    return [{**{band: float(value) for band, value in zip(bands, pixel)}, "dataMask": float(mask)}
+            for pixel, mask in zip(stack[0, :count], data_mask[0, :count])]
+
+
+def check_index(name, values, quantization_name, max_clipped, evalscript_outputs):
+    q = get_quantization(quantization_name, name)
+    ints = quantize(values, q)
+    restored = dequantize(ints, q)
+
+    low, high = quantized_range(q)
+    finite = np.isfinite(values)
+    in_range = finite & (values >= low) & (values <= high)
+    error = float(np.abs(restored[in_range] - values[in_range]).max())
+    bound = max_quantization_error(q) + 1e-6
+    edges = np.where(values > high, high, low)
+    saturated = bool(np.allclose(restored[finite & ~in_range], edges[finite & ~in_range], atol=1e-6))
+    clipped_fraction = float(1 - in_range.sum() / finite.sum())
+
+    result = {
+        "index": name,
+        "quantization": quantization_name,
+        "range": [low, high],
+        "max_error": error,
+        "error_bound": bound,
+        "within_bound": error <= bound,
+        "saturated_to_edge": saturated,
+        "nodata_preserved": bool(np.array_equal(np.isnan(restored), np.isnan(values))),
+        "clipped_fraction": clipped_fraction,
+        "clipped_within_threshold": clipped_fraction <= max_clipped,
+        "raw_size_ratio": values.nbytes / ints.nbytes,
+        "compressed_size_ratio": len(zlib.compress(values.tobytes(), 6)) / len(zlib.compress(ints.tobytes(), 6)),
+    }
+    if evalscript_outputs is not None:
+        difference = np.abs(evalscript_outputs[:, 0] - ints[:len(evalscript_outputs)].astype(np.float64))
+        result["evalscript_exact_fraction"] = float((difference == 0).mean())
+        result["evalscript_matches"] = bool(difference.max() <= 1 and np.array_equal(
+            evalscript_outputs[:, 0] == q.nodata, ints[:len(evalscript_outputs)] == q.nodata))
+    return result
+
+
+def check_rgb(name, outputs):
+    """RGB outputs of an evalscript, whose AUTO sample type is stretched to UINT8 by Sentinel Hub."""
+    rgb = outputs[:, :3]
+    restored = dequantize(quantize(rgb, RGB_QUANTIZATION), RGB_QUANTIZATION)
+    error = float(np.abs(restored - rgb).max())
+    bound = max_quantization_error(RGB_QUANTIZATION) + 1e-6
+    clipped_fraction = float(((rgb < 0) | (rgb > 1)).mean())
+    return {
+        "index": name,
+        "quantization": RGB_QUANTIZATION.sample_type,
+        "range": list(quantized_range(RGB_QUANTIZATION)),
+        "max_error": error,
+        "error_bound": bound,
+        "within_bound": error <= bound,
+        "clipped_fraction": clipped_fraction,
+        "clipped_within_threshold": clipped_fraction == 0,
+    }
+
+
+def run(pixels, max_clipped, evalscript_pixels):
+    stack, bands, data_mask = synthetic_bands(pixels)
+    indices = compute_indices(stack, bands, list(INDEX_FORMULAS), data_mask=data_mask)
+    samples = evalscript_samples(stack, bands, data_mask, evalscript_pixels)
+    if shutil.which("node") is None:
+        print("Node.js not found, the evalscripts are not checked")
+
+    results = []
+    for name, values in indices.items():
+        values = values.ravel()
+        for quantization_name in QUANTIZATIONS:
+            outputs = run_evalscript(build_quantized_index_evalscript(name, quantization_name), samples)
+            results.append(check_index(name, values, quantization_name, max_clipped, outputs))
+            result = results[-1]
+            evalscript = (f", evalscript {'ok' if result['evalscript_matches'] else 'MISMATCH'}"
+                          if "evalscript_matches" in result else "")
+            print(f"{name:>13} {quantization_name:>5}: max error {result['max_error']:.2e} "
+                  f"(bound {result['error_bound']:.2e}), {result['clipped_fraction']:.2%} clipped, "
+                  f"{result['raw_size_ratio']:.0f}x raw / {result['compressed_size_ratio']:.1f}x deflate{evalscript}")
+
+    for name in RGB_EVALSCRIPTS:
+        outputs = run_evalscript(INDEX_DICT[name], samples)
+        if outputs is not None:
+            results.append(check_rgb(name, outputs))
+            print(f"{name:>13} {RGB_QUANTIZATION.sample_type:>5}: max error {results[-1]['max_error']:.2e} "
+                  f"(bound {results[-1]['error_bound']:.2e}), {results[-1]['clipped_fraction']:.2%} clipped")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pixels", type=int, default=1_000_000, help="Number of synthetic pixels")
+    parser.add_argument("--max-clipped", type=float, default=0.02,
+                        help="Largest allowed fraction of index values outside the quantized range")
+    parser.add_argument("--evalscript-pixels", type=int, default=20_000,
+                        help="Number of pixels the evalscripts are run on with Node.js")
+    parser.add_argument("--output", default="quantization_error.json", help="Path of the JSON results")
+    args = parser.parse_args()
+
+    results = run(args.pixels, args.max_clipped, args.evalscript_pixels)
+    with open(args.output, "w") as file:
+        json.dump({"benchmark": "quantization_error", "parameters": vars(args), "results": results}, file, indent=2)
+
+    checks = ("within_bound", "saturated_to_edge", "nodata_preserved", "clipped_within_threshold",
+              "evalscript_matches")
+    ok = all(result.get(check, True) for result in results for check in checks)
+    print("All quantization checks passed" if ok else "Quantization check failed")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
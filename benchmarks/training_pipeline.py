@@ -0,0 +1,155 @@
+"""
+Throughput benchmark of the fine-tuning data pipeline (rubicon_cs.training).
+
+Writes the patch shards of synthetic uint16 multi-band scenes with crop labels, then compares the samples per
+second of:
+
+    - the baseline, which pads and cuts the full scenes with `pad_to_multiple` + `extract_patches` and stacks
+      shuffled batches at every epoch;
+    - `PatchShardDataset` with shuffling and augmentations, in a DataLoader with each number of workers.
+
+Each loader is measured alone and with the training step of a small stand-in model, to report the fraction of
+the time spent waiting for data. Also checks that the shards match `extract_patches` and that the batches of
+an epoch are the same for every number of workers; exits with status 1 if a check fails. Results are printed
+and written as JSON.
+
+Usage:
+    PYTHONPATH=src python benchmarks/training_pipeline.py --scenes 4 --size 1024 --workers 0 2 4 --output training_pipeline.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+from rubicon_cs.patches import extract_patches, pad_to_multiple
+from rubicon_cs.training import PatchShardDataset, measure_throughput, write_patch_shards
+
+
+def synthetic_scenes(count, size, channels, num_classes, seed=0):
+    """Scenes of uint16 digital numbers and uint8 labels with an unlabeled border, like field parcel masks."""
+    rng = np.random.default_rng(seed)
+    scenes = []
+    for _ in range(count):
+        image = rng.integers(0, 10000, (channels, size, size), dtype=np.uint16)
+        label = rng.integers(0, num_classes, (size, size), dtype=np.uint8)
+        label[:, : size // 8] = 255
+        scenes.append((image, label))
+    return scenes
+
+
+def baseline_batches(scenes, patch_size, batch_size, seed):
+    """One epoch of the per-epoch approach: pad and cut every scene, then stack shuffled batches."""
+    samples = []
+    for image, label in scenes:
+        image, _, _ = pad_to_multiple(torch.from_numpy(image.astype(np.float32)), patch_size)
+        label, _, _ = pad_to_multiple(torch.from_numpy(label.astype(np.int64))[None], patch_size)
+        samples += [(patch, label_patch[0]) for (_, patch), (_, label_patch)
+                    in zip(extract_patches(image, patch_size), extract_patches(label, patch_size))]
+    order = np.random.default_rng(seed).permutation(len(samples))
+    for start in range(0, len(order) - batch_size + 1, batch_size):
+        chunk = [samples[i] for i in order[start:start + batch_size]]
+        yield torch.stack([image for image, _ in chunk]) / 10000, torch.stack([label for _, label in chunk])
+
+
+def make_step(channels, num_classes):
+    """Training step of a small fully convolutional model, standing in for the fine-tuned network."""
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(channels, 32, 3, padding=1), torch.nn.ReLU(),
+                                torch.nn.Conv2d(32, num_classes, 1))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    loss_function = torch.nn.CrossEntropyLoss(ignore_index=255)
+
+    def step(images, labels):
+        optimizer.zero_grad()
+        loss_function(model(images), labels).backward()
+        optimizer.step()
+
+    return step
+
+
+def check_extract_compatible(scenes, index_path, patch_size):
+    """The stored patches are those of `extract_patches`, minus the fully unlabeled ones."""
+    dataset = PatchShardDataset(index_path)
+    positions = np.load(os.path.join(os.path.dirname(index_path), "positions.npy"))
+    image, _ = scenes[0]
+    padded, _, _ = pad_to_multiple(torch.from_numpy(image.astype(np.int32)), patch_size)
+    expected = {position: patch for position, patch in extract_patches(padded, patch_size)}
+    for i, (source, row, col) in enumerate(positions):
+        if source != 0:
+            break
+        if not np.array_equal(dataset.sample(i)[0].numpy(), expected[(row, col)].numpy()):
+            return False
+    return True
+
+
+def epoch_digest(dataset, workers):
+    loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=workers)
+    digest = hashlib.sha256()
+    for images, labels in loader:
+        digest.update(images.numpy().tobytes())
+        digest.update(labels.numpy().tobytes())
+    return digest.hexdigest()
+
+
+def run(scenes_count, size, channels, num_classes, patch_size, batch_size, workers, with_step):
+    scenes = synthetic_scenes(scenes_count, size, channels, num_classes)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        index_path = write_patch_shards(scenes, directory, patch_size=patch_size, shard_size=64)
+        with open(index_path) as file:
+            index = json.load(file)
+        print(f"{index['num_samples']} patches in {len(index['shards'])} shards "
+              f"({index['skipped_unlabeled']} unlabeled skipped)")
+
+        checks = {"extract_patches_compatible": check_extract_compatible(scenes, index_path, patch_size)}
+        dataset = PatchShardDataset(index_path, batch_size=batch_size, shuffle=True, augment=True, seed=0)
+        dataset.set_epoch(1)
+        digests = {count: epoch_digest(dataset, count) for count in sorted({0, *workers})}
+        checks["same_batches_for_any_workers"] = len(set(digests.values())) == 1
+
+        steps = [("loader", None)] + ([("with_step", make_step(channels, num_classes))] if with_step else [])
+        for mode, step in steps:
+            # No warmup: the baseline cuts the scenes before its first batch, which is the cost being compared
+            stats = measure_throughput(baseline_batches(scenes, patch_size, batch_size, seed=0), step=step, warmup=0)
+            results.append({"loader": "extract_patches_per_epoch", "workers": 0, "mode": mode, **stats})
+            for count in workers:
+                loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=count)
+                stats = measure_throughput(loader, step=step, warmup=1 if count else 0)
+                results.append({"loader": "patch_shards", "workers": count, "mode": mode, **stats})
+
+    for result in results:
+        print(f"{result['loader']:>26} workers={result['workers']} {result['mode']:>9}: "
+              f"{result['samples_per_second']:8.1f} samples/s, waiting for data {result['data_wait_fraction']:6.1%}")
+    for name, ok in checks.items():
+        print(f"{name}: {'ok' if ok else 'FAIL'}")
+    return results, checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenes", type=int, default=4, help="Number of synthetic scenes")
+    parser.add_argument("--size", type=int, default=1024, help="Side of the scenes in pixels")
+    parser.add_argument("--channels", type=int, default=10, help="Bands of the scenes")
+    parser.add_argument("--classes", type=int, default=6, help="Number of crop classes")
+    parser.add_argument("--patch-size", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2], help="DataLoader worker counts")
+    parser.add_argument("--no-step", action="store_true", help="Only measure the loaders, without training step")
+    parser.add_argument("--output", default="training_pipeline.json", help="Path of the JSON results")
+    args = parser.parse_args()
+
+    results, checks = run(args.scenes, args.size, args.channels, args.classes, args.patch_size, args.batch_size,
+                          args.workers, not args.no_step)
+    with open(args.output, "w") as file:
+        json.dump({"benchmark": "training_pipeline", "parameters": vars(args), "torch": torch.__version__,
+                   "cpus": os.cpu_count(), "checks": checks, "results": results}, file, indent=2)
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
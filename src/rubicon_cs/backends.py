@@ -0,0 +1,224 @@
+"""
+Pluggable inference backends for the segmentation pipeline.
+
+`load_backend` returns a module with the same interface as the eager Satlas model (`backend(batch)[0]` are
+the logits), so it can be passed as `model` to `semantic_segmentation_large_image` or `InferencePool`.
+`semantic_segmentation_large_image`, `segment_geotiff` and `rubicon-cs segment` also take a `backend` name and
+build it for their batch shape.
+
+Backends:
+    - 'eager': the PyTorch model as is.
+    - 'compile': `torch.compile`, with the inductor cache kept in the cache directory.
+    - 'torchscript': traced and frozen TorchScript module.
+    - 'onnx': ONNX export run by ONNX Runtime on CPU (requires the `onnx` extra: onnx, onnxruntime).
+
+TorchScript and ONNX artifacts are cached on disk, keyed by the checkpoint hash, input shape and library
+versions. When an artifact is cached the eager model doesn't even have to be built, which removes the
+Satlas model construction and `torch.load` from the cold start.
+"""
+import hashlib
+import os
+
+import torch
+
+BACKENDS = ('eager', 'compile', 'torchscript', 'onnx')
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rubicon_cs", "backends")
+
+
+def _import_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError as error:
+        raise ImportError("The 'onnx' backend requires onnx and onnxruntime: pip install onnx onnxruntime") from error
+    return onnxruntime
+
+
+def load_satlas_model(checkpoint_path, model_id="Sentinel2_SwinB_SI_RGB", num_categories=12):
+    """Build the Satlas SwinB+FPN segmentation model and load the fine-tuned weights, as in section two."""
+    import satlaspretrain_models
+
+    model = satlaspretrain_models.Weights().get_pretrained_model(
+        model_id, fpn=True, head=satlaspretrain_models.Head.SEGMENT, num_categories=num_categories
+    )
+    weights = torch.load(checkpoint_path, map_location=torch.device('cpu'))
+    model.load_state_dict(weights, strict=False)
+    return model.eval()
+
+
+class _LogitsOnly(torch.nn.Module):
+    """Adapter returning only the logits, as tracing and export can't handle the (logits, loss) tuple."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)[0]
+
+
+class _TupleOutput(torch.nn.Module):
+    """Adapter restoring the model(x)[0] interface around a logits-only module."""
+
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x):
+        return (self.module(x),)
+
+
+class _FixedBatch(torch.nn.Module):
+    """Run a module traced for a fixed batch size on batches of any size, zero-padding the last chunk."""
+
+    def __init__(self, module, batch_size):
+        super().__init__()
+        self.module = module
+        self.batch_size = batch_size
+
+    def forward(self, x):
+        if x.shape[0] == self.batch_size:
+            return self.module(x)
+        outputs = []
+        for chunk in x.split(self.batch_size):
+            n = chunk.shape[0]
+            if n < self.batch_size:
+                chunk = torch.cat([chunk, chunk.new_zeros((self.batch_size - n, *chunk.shape[1:]))])
+            outputs.append(self.module(chunk)[:n])
+        return torch.cat(outputs)
+
+
+class OnnxRuntimeModel(torch.nn.Module):
+    """Run an exported ONNX model with ONNX Runtime on CPU, with the model(x)[0] interface."""
+
+    def __init__(self, onnx_path, num_threads=None):
+        super().__init__()
+        onnxruntime = _import_onnxruntime()
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+
+    def forward(self, x):
+        logits = self.session.run(None, {"input": x.detach().cpu().float().contiguous().numpy()})[0]
+        return (torch.from_numpy(logits),)
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read by chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _state_dict_hash(model):
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _artifact_path(cache_dir, backend, weights_hash, input_shape):
+    versions = f"torch{torch.__version__}"
+    if backend == 'onnx':
+        versions += f"-ort{_import_onnxruntime().__version__}"
+    key = hashlib.sha256(f"{weights_hash}-{tuple(input_shape)}-{versions}".encode()).hexdigest()[:24]
+    extension = "onnx" if backend == 'onnx' else "pt"
+    return os.path.join(cache_dir, f"{backend}-{key}.{extension}")
+
+
+def check_parity(candidate, reference, example, atol=1e-3, rtol=1e-3):
+    """
+    Compare the logits of a backend against the eager model on an example batch.
+
+    Returns the max absolute difference and raises a ValueError if the outputs are not close.
+    """
+    with torch.inference_mode():
+        expected = reference(example)[0].float()
+        actual = candidate(example)[0].float()
+    max_diff = (expected - actual).abs().max().item()
+    if not torch.allclose(expected, actual, atol=atol, rtol=rtol):
+        raise ValueError(f"Backend output differs from eager mode by up to {max_diff:.3g} (atol={atol}, rtol={rtol})")
+    return max_diff
+
+
+def load_backend(backend='eager', model=None, model_factory=None, checkpoint_path=None, input_shape=(8, 3, 512, 512),
+                 cache_dir=None, parity_check=True, atol=1e-3, num_threads=None):
+    """
+    Build (or load from the cache) an inference backend for a segmentation model.
+
+    Parameters:
+        backend (str): One of 'eager', 'compile', 'torchscript' or 'onnx'.
+        model: Eager model. Either it or `model_factory` is required.
+        model_factory (callable): Builds the eager model, e.g. `lambda: load_satlas_model(path)`. Only called if
+            the model is needed, i.e. not for a cached TorchScript/ONNX artifact.
+        checkpoint_path (str): Checkpoint used to key the cache. Without it the key is a hash of the model weights.
+        input_shape (tuple): (B, C, H, W) of the batches fed to the model. Default is (8, 3, 512, 512), the
+            default batch of `semantic_segmentation_large_image`. TorchScript is traced for this batch size
+            (smaller batches are zero-padded to it), the ONNX export has a dynamic batch dimension.
+        cache_dir (str): Directory of the cached artifacts. Default is ~/.cache/rubicon_cs/backends.
+        parity_check (bool): Compare the backend against eager mode on a random batch when it is built.
+        atol (float): Tolerance of the parity check. Default is 1e-3.
+        num_threads (int): Intra-op threads of the ONNX Runtime session. Default lets ONNX Runtime decide.
+
+    Returns:
+        torch.nn.Module whose output `[0]` are the logits.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, choose from {BACKENDS}")
+    if model is None and model_factory is None:
+        raise ValueError("Either model or model_factory is required")
+
+    def get_model():
+        nonlocal model
+        if model is None:
+            model = model_factory()
+        return model.eval()
+
+    if backend == 'eager':
+        return get_model()
+
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    example = torch.rand(*input_shape)
+
+    if backend == 'compile':
+        # Compiled kernels are reused across sessions through the inductor on-disk cache
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_dir, "inductor"))
+        compiled = torch.compile(get_model(), dynamic=False)
+        if parity_check:
+            check_parity(compiled, model, example, atol=atol, rtol=atol)
+        return compiled
+
+    weights_hash = file_hash(checkpoint_path) if checkpoint_path else _state_dict_hash(get_model())
+    artifact_path = _artifact_path(cache_dir, backend, weights_hash, input_shape)
+    cached = os.path.exists(artifact_path)
+
+    if not cached:
+        tmp_path = f"{artifact_path}.{os.getpid()}.tmp"
+        logits_model = _LogitsOnly(get_model()).eval()
+        with torch.inference_mode():
+            if backend == 'torchscript':
+                traced = torch.jit.freeze(torch.jit.trace(logits_model, example))
+                torch.jit.save(traced, tmp_path)
+            else:
+                torch.onnx.export(
+                    logits_model, example, tmp_path, input_names=["input"], output_names=["logits"],
+                    dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}}, opset_version=17
+                )
+        os.replace(tmp_path, artifact_path)
+
+    if backend == 'torchscript':
+        traced = torch.jit.optimize_for_inference(torch.jit.load(artifact_path))
+        loaded = _TupleOutput(_FixedBatch(traced, input_shape[0])).eval()
+    else:
+        loaded = OnnxRuntimeModel(artifact_path, num_threads=num_threads).eval()
+
+    # A cached artifact was already checked when it was built
+    if parity_check and not cached:
+        check_parity(loaded, model, example, atol=atol, rtol=atol)
+    return loaded
@@ -0,0 +1,183 @@
+"""
+Persistent, content-addressed cache for Sentinel Hub responses.
+
+Entries are stored as files named after the SHA-256 hash of everything that defines a response
+(evalscript, collection, bbox/geometry, size, time interval, output mime type...), so a repeated
+request for the same AOI and dates is served from disk instead of the network.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rubicon_cs")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+_default_cache = None
+
+
+class ResponseCache:
+    """
+    On-disk cache with a size cap and least-recently-used eviction.
+
+    Parameters:
+        cache_dir (str): Directory where entries are stored, `~` is expanded. Default is ~/.cache/rubicon_cs.
+        max_bytes (int): Maximum total size of the cache. Least recently used entries are evicted above it.
+
+    Notes:
+        - Files are written to a temporary file and moved in place with `os.replace`, so several
+          processes can share the same cache directory without ever reading a partial entry.
+        - Reading an entry refreshes its modification time, which is used as the LRU clock.
+        - `hits` and `misses` count lookups made through this instance.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        """Hash any JSON-serializable parts into a cache key."""
+        hashable = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(hashable.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def request_key(cls, download_request):
+        """
+        Cache key of a sentinelhub `DownloadRequest`.
+
+        The Process API payload holds the evalscript, data collection, time interval, bbox/geometry,
+        output size and response formats, so hashing it with the URL identifies the response.
+        """
+        return cls.make_key(download_request.url, download_request.post_values)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """Return the cached bytes for `key`, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                content = file.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)  # Mark as recently used for the eviction, best effort
+        except FileNotFoundError:
+            pass  # Evicted by a concurrent put since it was read, the content is still valid
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def put(self, key, content):
+        """Atomically store `content` (bytes) under `key` and evict old entries if the cache is too big."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(content)
+            try:
+                replaced_size = os.stat(path).st_size  # overwriting an entry doesn't grow the cache by its size
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(content) - replaced_size
+            if self._size is None or self._size > self.max_bytes:
+                self._evict()
+
+    def get_json(self, key):
+        """Return the cached JSON object for `key`, or None on a miss."""
+        content = self.get(key)
+        return None if content is None else json.loads(content)
+
+    def put_json(self, key, value):
+        """Store a JSON-serializable object under `key`."""
+        self.put(key, json.dumps(value).encode("utf-8"))
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits in `max_bytes`."""
+        entries = self._entries()
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Already evicted by another process
+                pass
+            self._size -= size
+
+    def stats(self):
+        """Return hit/miss counters and the current number of entries and size of the cache."""
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "size_bytes": sum(size for _, size, _ in entries),
+        }
+
+    def clear(self):
+        """Remove every entry of the cache."""
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._size = 0
+
+
+def get_default_cache():
+    """
+    Return the process-wide default cache.
+
+    Its location and size cap can be set with the RUBICON_CACHE_DIR and RUBICON_CACHE_MAX_MB environment variables.
+    """
+    global _default_cache
+    if _default_cache is None:
+        max_mb = os.environ.get("RUBICON_CACHE_MAX_MB")
+        _default_cache = ResponseCache(
+            cache_dir=os.path.expanduser(os.environ.get("RUBICON_CACHE_DIR", DEFAULT_CACHE_DIR)),
+            max_bytes=int(max_mb) * 1024 ** 2 if max_mb else DEFAULT_MAX_BYTES,
+        )
+    return _default_cache
+
+
+def resolve_cache(cache):
+    """Turn a `cache` argument (True, False/None or a ResponseCache) into a ResponseCache or None."""
+    if cache is True:
+        return get_default_cache()
+    return cache or None
@@ -0,0 +1,152 @@
+"""
+In-process index of Sentinel Hub catalog acquisitions.
+
+Catalog searches are made over whole time windows and their results are memoized per
+(AOI, collection, cloud cover limit), so that any later lookup within an already searched window,
+such as finding the nearest acquisition to a target date, is answered locally without a request.
+Only the past days of a window count as searched, as new acquisitions can still appear from today on.
+"""
+import json
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import date as datetime_date, datetime, timedelta
+
+from sentinelhub import DataCollection
+
+from rubicon_cs.instrumentation import count, stage
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+class AcquisitionIndex:
+    """Sorted acquisition dates of one (AOI, collection, cloud cover limit) and the time windows already searched."""
+
+    def __init__(self):
+        self.dates = []
+        self.intervals = []
+        self.lock = threading.Lock()
+
+    def covers(self, start, end):
+        """Check whether the [start, end] window has already been searched."""
+        return any(s <= start and end <= e for s, e in self.intervals)
+
+    def add(self, start, end, dates):
+        """
+        Register the acquisition dates found by a search, and [start, end] as searched if start <= end.
+
+        Overlapping windows and windows on consecutive days are merged into one searched interval.
+        """
+        self.dates = sorted(set(self.dates).union(dates))
+        if start > end:
+            return
+        intervals = sorted(self.intervals + [(start, end)])
+        merged = [intervals[0]]
+        for s, e in intervals[1:]:
+            if s <= _next_day(merged[-1][1]):
+                merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+            else:
+                merged.append((s, e))
+        self.intervals = merged
+
+    def dates_between(self, start, end):
+        """Return the acquisition dates within [start, end]."""
+        return self.dates[bisect_left(self.dates, start):bisect_right(self.dates, end)]
+
+    def nearest(self, target_date, max_days):
+        """
+        Return the acquisition date closest to `target_date` within ±`max_days`, or None.
+
+        On a tie the later date is preferred.
+        """
+        target = datetime.strptime(target_date, "%Y-%m-%d")
+        position = bisect_left(self.dates, target_date)
+        best, best_delta = None, None
+        # dates[position] is the first date >= target, dates[position - 1] the last one before it
+        for candidate in self.dates[position:position + 1] + self.dates[max(position - 1, 0):position]:
+            delta = abs((datetime.strptime(candidate, "%Y-%m-%d") - target).days)
+            if delta <= max_days and (best_delta is None or delta < best_delta):
+                best, best_delta = candidate, delta
+        return best
+
+
+def _next_day(day):
+    """Return the 'YYYY-MM-DD' day after `day`."""
+    return (datetime_date.fromisoformat(day) + timedelta(days=1)).isoformat()
+
+
+def get_acquisition_index(geometry, data_collection=DataCollection.SENTINEL2_L2A, cloud_cover_limit=20):
+    """Return the memoized acquisition index of an AOI, collection and cloud cover limit."""
+    key = (
+        json.dumps(geometry.geojson, sort_keys=True), str(geometry.crs),
+        data_collection.api_id, cloud_cover_limit
+    )
+    with _INDEXES_LOCK:
+        if key not in _INDEXES:
+            _INDEXES[key] = AcquisitionIndex()
+        return _INDEXES[key]
+
+
+def get_acquisition_dates(catalog, geometry, time_interval, cloud_cover_limit=20,
+                          data_collection=DataCollection.SENTINEL2_L2A, cache=None):
+    """
+    Return the sorted acquisition dates of the AOI within a time interval.
+
+    Parameters:
+        catalog: A STAC catalog or API object with a `.search()` method.
+        geometry (Geometry): The area of interest (AOI).
+        time_interval (tuple): (start_date, end_date) as 'YYYY-MM-DD' strings or dates, both included.
+        cloud_cover_limit (int): The maximum allowed cloud cover percentage. Default is 20%.
+        data_collection: The dataset or collection to search. Default is Sentinel-2 L2A.
+        cache (ResponseCache): Optional persistent cache. Only windows entirely in the past are stored in it,
+            as later searches could return new acquisitions.
+
+    Returns:
+        list: Acquisition dates as 'YYYY-MM-DD' strings.
+    """
+    start, end = str(time_interval[0]), str(time_interval[1])
+    index = get_acquisition_index(geometry, data_collection, cloud_cover_limit)
+
+    with index.lock:
+        if not index.covers(start, end):
+            dates = _search_dates(catalog, geometry, start, end, cloud_cover_limit, data_collection, cache)
+            # Like the persistent cache, only memoize the days before today: later days are searched again
+            yesterday = (datetime_date.today() - timedelta(days=1)).isoformat()
+            index.add(start, min(end, yesterday), dates)
+        return index.dates_between(start, end)
+
+
+def _search_dates(catalog, geometry, start, end, cloud_cover_limit, data_collection, cache):
+    """Run a single catalog search over the [start, end] window, going through the persistent cache if possible."""
+    cache_key = None
+    if cache is not None and end < datetime_date.today().isoformat():
+        cache_key = cache.make_key(
+            "catalog", data_collection.api_id, geometry.geojson, str(geometry.crs), [start, end], cloud_cover_limit
+        )
+        acquisition_dates = cache.get_json(cache_key)
+        if acquisition_dates is not None:
+            count("catalog_cache_hits")
+            return acquisition_dates
+
+    with stage("catalog_search"):
+        search_iterator = catalog.search(
+            data_collection,
+            geometry=geometry,
+            time=(start, end),
+            filter=f'eo:cloud_cover < {cloud_cover_limit}',
+            fields={"include": ["properties.datetime"], "exclude": []}
+        )
+        acquisition_dates = sorted({item["properties"]["datetime"][:10] for item in search_iterator})
+
+    if cache_key is not None:
+        cache.put_json(cache_key, acquisition_dates)
+    return acquisition_dates
+
+
+def search_window(target_date, max_days):
+    """Return the ('YYYY-MM-DD', 'YYYY-MM-DD') window of ±`max_days` around `target_date`."""
+    target = datetime.strptime(target_date, "%Y-%m-%d")
+    return (
+        (target - timedelta(days=max_days)).strftime("%Y-%m-%d"),
+        (target + timedelta(days=max_days)).strftime("%Y-%m-%d"),
+    )
@@ -0,0 +1,308 @@
+"""
+`rubicon-cs` command line interface.
+
+    rubicon-cs batch jobs.jsonl --status jobs.status.jsonl --jobs 4
+
+The batch mode reads a JSONL manifest, one job per line:
+
+    {"id": "farm-12-ndvi", "aoi": "AOI_Rubicon.geojson", "date_range": ["2024-08-20", "2024-09-10"],
+     "index": "ndvi", "cloud_cover_limit": 20, "output_dir": "outputs/batch"}
+
+`aoi` is a GeoJSON file path or an inline GeoJSON geometry/Feature/FeatureCollection, `index` can be replaced
+by a list of `indices`, and `id` defaults to a hash of the job. Jobs are planned before anything is fetched:
+
+    - jobs on the same AOI and cloud cover limit form a unit, whose acquisition dates are searched once over
+      the union of their date ranges and whose raw bands are requested with the same evalscript, so dates
+      shared by several date ranges come from the download cache instead of Sentinel Hub;
+    - jobs of a unit with the same date range and output directory are merged into a single fetch computing
+      all their indices.
+
+Units run in parallel (`--jobs`) and share one rate-limited download client. A status line is appended to
+the status JSONL as each job finishes. Rerunning the same command skips the jobs whose last status is "ok",
+so only the failed ones are retried.
+
+`--metrics metrics.prom` (or `.json`) saves the time spent in each stage (catalog search, download, decode,
+write...) and the download counters, `--events events.jsonl` logs every stage, and `--profile DIR` saves
+cProfile stats of the run (see rubicon_cs.instrumentation).
+
+The segment mode writes the class map of a GeoTIFF with the fine-tuned Satlas model (see `segment_geotiff`),
+optionally through a faster inference backend (see rubicon_cs.backends):
+
+    rubicon-cs segment mosaic.tif class_map.tif --checkpoint weights.pth --backend onnx --batch-size 8
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+
+from sentinelhub import CRS, Geometry
+
+from rubicon_cs.cache import resolve_cache
+from rubicon_cs.catalog import get_acquisition_dates
+from rubicon_cs.download import RateLimitedDownloadClient
+from rubicon_cs.indices import required_bands
+from rubicon_cs.instrumentation import profile, recording
+from rubicon_cs.main import geotiff_for_veg_indices
+
+DEFAULT_OUTPUT_DIR = "outputs/batch"
+
+
+def load_aoi(aoi):
+    """Return the GeoJSON geometry of an AOI given as a file path or as inline GeoJSON."""
+    if isinstance(aoi, str):
+        with open(aoi) as f:
+            aoi = json.load(f)
+    if aoi.get("type") == "FeatureCollection":
+        aoi = aoi["features"][0]
+    if aoi.get("type") == "Feature":
+        aoi = aoi["geometry"]
+    return aoi
+
+
+def read_manifest(path):
+    """Read and normalize the jobs of a JSONL manifest."""
+    jobs = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            spec = json.loads(line)
+            try:
+                indices = spec.get("indices") or [spec["index"]]
+                job = {
+                    "aoi": load_aoi(spec["aoi"]),
+                    "date_range": [str(date) for date in spec["date_range"]],
+                    "indices": [index.lower() for index in indices],
+                    "cloud_cover_limit": spec.get("cloud_cover_limit", 20),
+                    "output_dir": spec.get("output_dir", DEFAULT_OUTPUT_DIR),
+                    "tiled": spec.get("tiled", False),
+                }
+            except KeyError as error:
+                raise ValueError(f"{path}:{line_number}: missing job field {error}") from error
+            required_bands(job["indices"])
+            job["id"] = str(spec.get("id") or _hash(job))
+            jobs.append(job)
+
+    duplicates = {job["id"] for job in jobs if sum(other["id"] == job["id"] for other in jobs) > 1}
+    if duplicates:
+        raise ValueError(f"Duplicate job ids in {path}: {sorted(duplicates)}")
+    return jobs
+
+
+def read_status(path):
+    """Return the last status record of each job id in a status JSONL, if it exists."""
+    records = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    records[record["id"]] = record
+    return records
+
+
+def plan_jobs(jobs):
+    """
+    Group jobs into units sharing an AOI and cloud cover limit, then into fetches within each unit.
+
+    Returns:
+        list: Units as dicts with the shared `aoi`, `cloud_cover_limit`, `tiled`, `bands` and `date_span`,
+            and their `fetches`, each with a `date_range`, `output_dir`, the union of `indices` and its `jobs`.
+    """
+    units = defaultdict(lambda: defaultdict(list))
+    for job in jobs:
+        unit_key = (_hash(job["aoi"]), job["cloud_cover_limit"], job["tiled"])
+        fetch_key = (tuple(job["date_range"]), job["output_dir"])
+        units[unit_key][fetch_key].append(job)
+
+    plan = []
+    for fetches in units.values():
+        unit_jobs = [job for fetch_jobs in fetches.values() for job in fetch_jobs]
+        first = unit_jobs[0]
+        plan.append({
+            "aoi": first["aoi"],
+            "cloud_cover_limit": first["cloud_cover_limit"],
+            "tiled": first["tiled"],
+            "bands": required_bands(sorted({index for job in unit_jobs for index in job["indices"]})),
+            "date_span": [min(job["date_range"][0] for job in unit_jobs),
+                          max(job["date_range"][1] for job in unit_jobs)],
+            "fetches": [
+                {
+                    "date_range": list(date_range),
+                    "output_dir": output_dir,
+                    "indices": sorted({index for job in fetch_jobs for index in job["indices"]}),
+                    "jobs": fetch_jobs,
+                }
+                for (date_range, output_dir), fetch_jobs in fetches.items()
+            ],
+        })
+    return plan
+
+
+def run_batch(manifest, status_path=None, jobs=4, download_workers=4, retry_all=False, dry_run=False):
+    """
+    Run the jobs of a JSONL manifest, see the module docstring.
+
+    Parameters:
+        manifest (str): Path of the JSONL manifest.
+        status_path (str): Path of the status JSONL. Default is the manifest path with a `.status.jsonl` suffix.
+        jobs (int): Number of units processed in parallel. Default is 4.
+        download_workers (int): Concurrent downloads of each fetch. Default is 4.
+        retry_all (bool): Rerun the jobs already marked "ok" in the status file. Default is False.
+        dry_run (bool): Only print the plan. Default is False.
+
+    Returns:
+        dict: Number of jobs per status, including the "skipped" ones.
+    """
+    status_path = status_path or f"{os.path.splitext(manifest)[0]}.status.jsonl"
+    all_jobs = read_manifest(manifest)
+    done = set() if retry_all else {
+        job_id for job_id, record in read_status(status_path).items() if record["status"] == "ok"
+    }
+    pending = [job for job in all_jobs if job["id"] not in done]
+    plan = plan_jobs(pending)
+    summary = {"skipped": len(all_jobs) - len(pending), "ok": 0, "failed": 0}
+
+    fetch_count = sum(len(unit["fetches"]) for unit in plan)
+    print(f"{len(pending)} jobs to run ({summary['skipped']} already done) in {len(plan)} AOI units "
+          f"and {fetch_count} fetches")
+    if dry_run or not plan:
+        return summary
+
+    cache = resolve_cache(True)
+    client = RateLimitedDownloadClient.from_secrets(cache=cache)
+    catalog = client.catalog
+
+    status_lock = threading.Lock()
+
+    def record(job, status, started, outputs=None, error=None):
+        line = {
+            "id": job["id"],
+            "status": status,
+            "outputs": outputs or [],
+            "error": error,
+            "elapsed_s": round(time.perf_counter() - started, 3),
+            "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with status_lock:
+            with open(status_path, "a") as f:
+                f.write(json.dumps(line) + "\n")
+            summary[status] += 1
+
+    def run_unit(unit):
+        geometry = Geometry.from_geojson(unit["aoi"], crs=CRS.WGS84)
+        started = time.perf_counter()
+        try:
+            # A single catalog search over the union of the date ranges, the fetches are then served by the index
+            get_acquisition_dates(catalog, geometry, unit["date_span"], unit["cloud_cover_limit"], cache=cache)
+        except Exception as error:
+            for fetch in unit["fetches"]:
+                for job in fetch["jobs"]:
+                    record(job, "failed", started, error=f"Catalog search failed: {error!r}")
+            return
+
+        for fetch in unit["fetches"]:
+            started = time.perf_counter()
+            try:
+                os.makedirs(fetch["output_dir"], exist_ok=True)
+                geotiff_for_veg_indices(
+                    unit["aoi"], fetch["date_range"], veg_indices=fetch["indices"],
+                    cloud_cover_limit=unit["cloud_cover_limit"], output_dir=fetch["output_dir"],
+                    multi_index=False, tiled=unit["tiled"], max_workers=download_workers,
+                    download_client=client, cache=cache, bands=unit["bands"],
+                )
+            except Exception:
+                error = traceback.format_exc(limit=3)
+                for job in fetch["jobs"]:
+                    record(job, "failed", started, error=error)
+                continue
+
+            prefix = f"{fetch['output_dir']}/{fetch['date_range'][0]}_{fetch['date_range'][1]}"
+            for job in fetch["jobs"]:
+                record(job, "ok", started, outputs=[f"{prefix}_{index}.tif" for index in job["indices"]])
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in as_completed([executor.submit(run_unit, unit) for unit in plan]):
+            future.result()
+
+    print(f"Done: {summary['ok']} ok, {summary['failed']} failed, {summary['skipped']} skipped. "
+          f"Status written to {status_path}")
+    return summary
+
+
+def _hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="rubicon-cs", description=__doc__.split("\n\n")[0].strip())
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch = subparsers.add_parser("batch", help="Run the vegetation index jobs of a JSONL manifest")
+    batch.add_argument("manifest", help="JSONL manifest, one job per line")
+    batch.add_argument("--status", help="Status JSONL, default is <manifest>.status.jsonl")
+    batch.add_argument("--jobs", type=int, default=4, help="AOI units processed in parallel (default: 4)")
+    batch.add_argument("--download-workers", type=int, default=4,
+                       help="Concurrent downloads per fetch (default: 4)")
+    batch.add_argument("--retry-all", action="store_true", help="Also rerun the jobs already marked ok")
+    batch.add_argument("--dry-run", action="store_true", help="Only print the plan")
+    batch.add_argument("--metrics", help="Write per-stage timings and counters to this file "
+                                         "(Prometheus text format if it ends with .prom, else JSON)")
+    batch.add_argument("--events", help="Append every stage and counter event to this JSON lines log")
+    batch.add_argument("--profile", metavar="DIR", help="Save cProfile stats of the run to this directory")
+
+    segment = subparsers.add_parser("segment", help="Write the class map of a GeoTIFF with the segmentation model")
+    segment.add_argument("input", help="Input GeoTIFF, e.g. an RGB mosaic")
+    segment.add_argument("output", help="Output class map GeoTIFF")
+    segment.add_argument("--checkpoint", required=True, help="Fine-tuned Satlas weights")
+    segment.add_argument("--model-id", default="Sentinel2_SwinB_SI_RGB", help="Satlas pretrained model id")
+    segment.add_argument("--num-categories", type=int, default=12, help="Number of classes of the model")
+    segment.add_argument("--backend", default="eager", choices=("eager", "compile", "torchscript", "onnx"),
+                         help="Inference backend (default: eager)")
+    segment.add_argument("--device", default="cpu", help="Torch device (default: cpu)")
+    segment.add_argument("--batch-size", type=int, default=8, help="Patches per forward pass (default: 8)")
+    segment.add_argument("--patch-size", type=int, default=512, help="Patch size in pixels (default: 512)")
+    segment.add_argument("--window-size", type=int, default=4096, help="Window read at a time (default: 4096)")
+    segment.add_argument("--overlap", type=int, default=0, help="Pixels shared by neighbouring patches")
+    segment.add_argument("--bf16", action="store_true", help="Run the forward pass under bfloat16 autocast")
+    segment.add_argument("--no-resume", action="store_true", help="Start over instead of resuming")
+
+    args = parser.parse_args(argv)
+    if args.command == "batch":
+        with ExitStack() as stack:
+            if args.metrics or args.events:
+                stack.enter_context(recording(log_path=args.events, metrics_path=args.metrics))
+            if args.profile:
+                stack.enter_context(profile(args.profile))
+            summary = run_batch(args.manifest, args.status, jobs=args.jobs, download_workers=args.download_workers,
+                                retry_all=args.retry_all, dry_run=args.dry_run)
+        return 1 if summary["failed"] else 0
+    if args.command == "segment":
+        run_segment(args)
+        return 0
+
+
+def run_segment(args):
+    """Segment a GeoTIFF with the Satlas model and the chosen backend (torch is only imported here)."""
+    from rubicon_cs.backends import load_backend, load_satlas_model
+    from rubicon_cs.segmentation import segment_geotiff
+
+    # A cached TorchScript/ONNX artifact doesn't need the eager model to be built
+    model = load_backend(
+        args.backend, checkpoint_path=args.checkpoint,
+        model_factory=lambda: load_satlas_model(args.checkpoint, args.model_id, args.num_categories),
+        input_shape=(args.batch_size, 3, args.patch_size, args.patch_size),
+    )
+    segment_geotiff(args.input, args.output, model, args.device, window_size=args.window_size,
+                    resume=not args.no_resume, patch_size=args.patch_size, batch_size=args.batch_size,
+                    overlap=args.overlap, use_bf16=args.bf16)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
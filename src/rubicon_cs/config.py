@@ -0,0 +1,42 @@
+"""
+Sentinel Hub credentials and configuration.
+
+Secrets are read from the Streamlit secrets when running inside a Streamlit app and from the environment
+otherwise. Streamlit is never imported here: it is only looked up if the app already loaded it, so scripts,
+the CLI and worker processes can read their credentials without it.
+"""
+import os
+import sys
+
+
+def get_secret(secret_name):
+    """
+    Return a secret from the Streamlit secrets (on Streamlit Cloud) or from the environment.
+
+    Raises:
+        KeyError: If the secret is set in neither.
+    """
+    # Vérifier si l'application tourne sur Streamlit (Cloud ou local)
+    streamlit = sys.modules.get("streamlit")
+    if streamlit is not None:
+        try:
+            return streamlit.secrets[secret_name]
+        except Exception:
+            pass
+    # Sinon, récupérer depuis os.environ (local ou autre environnement)
+    try:
+        return os.environ[secret_name]
+    except KeyError:
+        raise KeyError(f"{secret_name} is neither a Streamlit secret nor an environment variable") from None
+
+
+def get_sh_config(download_client=None):
+    """Return the config of the download client, or a config with the Sentinel Hub credentials from the secrets."""
+    if download_client is not None:
+        return download_client.config
+    from sentinelhub import SHConfig
+
+    config = SHConfig()
+    config.sh_client_id = get_secret("SH_CLIENT_ID")
+    config.sh_client_secret = get_secret("SH_CLIENT_SECRET")
+    return config
@@ -0,0 +1,175 @@
+"""
+Chunked Zarr datacube backend for vegetation index time series.
+
+A GeoTIFF with one band per date interleaves the dates band by band, so reading the history of one pixel
+touches every band. The datacube stores the series as a single (time, y, x) array chunked along the three
+axes and compressed with Zarr's default codec, with time/y/x coordinates, the CRS and transform as
+attributes and per-date metadata (band tags and valid-pixel fraction). The default chunks of
+(4, 512, 512) keep both access patterns cheap: one date over the full AOI reads one chunk row of 4 dates,
+and the full history of a small window reads one 512x512 chunk per 4 dates.
+
+Requires the optional `datacube` extra: xarray, zarr and dask.
+"""
+import json
+from contextlib import contextmanager
+
+import numpy as np
+from affine import Affine
+
+DEFAULT_CHUNKS = (4, 512, 512)
+
+
+def _import_xarray():
+    try:
+        import dask.array
+        import xarray
+    except ImportError as error:
+        raise ImportError("The Zarr datacube requires xarray, zarr and dask: pip install xarray zarr dask") from error
+    return xarray, dask.array
+
+
+def _pixel_centers(transform, width, height):
+    x = transform.c + (np.arange(width) + 0.5) * transform.a
+    y = transform.f + (np.arange(height) + 0.5) * transform.e
+    return x, y
+
+
+class ZarrDatacubeWriter:
+    """
+    Write a (time, y, x) datacube window by window, with the same `write`/`update_tags` calls as a rasterio dataset.
+
+    Band k (1-based) is the k-th date of `dates`. Use `open_zarr_writer` rather than this class directly.
+    """
+
+    def __init__(self, path, width, height, dates, dtype, crs, transform, nodata=None, variable="index",
+                 chunks=DEFAULT_CHUNKS):
+        xarray, dask_array = _import_xarray()
+        self._xarray = xarray
+        self.path = path
+        self.variable = variable
+        self.dates = list(dates)
+        self._valid_pixels = np.zeros(len(self.dates), dtype=np.int64)
+        self._pixels = width * height
+        self._band_tags = {}
+
+        x, y = _pixel_centers(transform, width, height)
+        time_chunk, y_chunk, x_chunk = chunks
+        fill_value = np.nan if nodata is None else nodata
+        template = xarray.Dataset(
+            {
+                variable: (("time", "y", "x"), dask_array.full(
+                    (len(self.dates), height, width), fill_value, dtype=dtype,
+                    chunks=(time_chunk, y_chunk, x_chunk)
+                )),
+                "valid_fraction": (("time",), dask_array.zeros(len(self.dates), dtype=np.float32,
+                                                               chunks=len(self.dates))),
+            },
+            coords={"time": np.array(self.dates, dtype="datetime64[ns]"), "y": y, "x": x},
+            attrs={"crs": crs.to_wkt(), "transform": list(transform)[:6], "variable": variable},
+        )
+        # Writes the metadata and coordinates only, the data chunks are filled by `write`
+        template.to_zarr(path, mode="w", compute=False)
+
+    def write(self, array, band, window=None):
+        """Write a (h, w) array into the date of `band` (1-based), at `window` or over the full extent."""
+        time_idx = band - 1
+        region = {"time": slice(time_idx, time_idx + 1)}
+        if window is not None:
+            row_off, col_off = int(window.row_off), int(window.col_off)
+            region["y"] = slice(row_off, row_off + int(window.height))
+            region["x"] = slice(col_off, col_off + int(window.width))
+        self._valid_pixels[time_idx] += np.count_nonzero(np.isfinite(array))
+        data = self._xarray.Dataset({self.variable: (("time", "y", "x"), array[np.newaxis])})
+        # Tiles are not aligned on the chunks, writes are sequential so partial chunk updates are safe
+        data.to_zarr(self.path, region=region, safe_chunks=False)
+
+    def update_tags(self, band, **tags):
+        """Store per-date metadata, like the band tags of a GeoTIFF."""
+        self._band_tags.setdefault(self.dates[band - 1], {}).update({k: str(v) for k, v in tags.items()})
+
+    def close(self):
+        """Write the per-date metadata."""
+        valid_fraction = (self._valid_pixels / max(self._pixels, 1)).astype(np.float32)
+        self._xarray.Dataset({"valid_fraction": (("time",), valid_fraction)}).to_zarr(
+            self.path, region={"time": slice(0, len(self.dates))}
+        )
+        import zarr
+        zarr.open_group(self.path, mode="a").attrs["band_tags"] = json.dumps(self._band_tags)
+        # Keep the consolidated metadata read by `open_datacube` in sync with the new attribute
+        zarr.consolidate_metadata(self.path)
+
+
+@contextmanager
+def open_zarr_writer(path, width, height, dates, dtype, crs, transform, nodata=None, variable="index",
+                     chunks=DEFAULT_CHUNKS):
+    """
+    Create a Zarr datacube for the given dates and grid, like `open_cog_writer` for GeoTIFFs.
+
+    Parameters:
+        path (str): Output .zarr directory, overwritten if it exists.
+        width, height (int): Raster size.
+        dates (list): Acquisition dates, 'YYYY-MM-DD', in band order.
+        dtype: Data type of the values, e.g. np.float32.
+        crs, transform: Georeferencing of the raster.
+        nodata: Optional nodata value, NaN by default.
+        variable (str): Name of the data variable, e.g. the vegetation index. Default is 'index'.
+        chunks (tuple): (time, y, x) chunk sizes. Default is (4, 512, 512).
+
+    Yields:
+        ZarrDatacubeWriter, whose per-date metadata is written when the context exits, even on an error.
+    """
+    writer = ZarrDatacubeWriter(path, width, height, dates, dtype, crs, transform, nodata=nodata,
+                                variable=variable, chunks=chunks)
+    try:
+        yield writer
+    finally:
+        writer.close()
+
+
+def open_datacube(path, chunks=None):
+    """
+    Open a Zarr datacube lazily as an xarray Dataset backed by dask arrays.
+
+    Nothing is read until values are computed, then only the chunks overlapping the selection are.
+    The CRS and transform are in `ds.attrs`, see `datacube_transform`, and the band tags of each date
+    in `ds.attrs['band_tags']` (JSON).
+
+    Parameters:
+        path (str): .zarr directory.
+        chunks: Dask chunks, default uses the chunks of the store.
+    """
+    xarray, _ = _import_xarray()
+    return xarray.open_zarr(path, chunks=chunks if chunks is not None else {})
+
+
+def datacube_transform(ds):
+    """Return the affine transform of a datacube."""
+    return Affine(*ds.attrs["transform"])
+
+
+def read_date(ds, date, variable=None):
+    """Lazy (y, x) DataArray of one date, 'YYYY-MM-DD', over the full extent."""
+    return ds[variable or ds.attrs["variable"]].sel(time=np.datetime64(date, "ns"))
+
+
+def read_window(ds, window, variable=None, time=None):
+    """
+    Lazy (time, y, x) DataArray of a pixel window.
+
+    Parameters:
+        ds: Datacube opened with `open_datacube`.
+        window (rasterio.windows.Window): Pixel window, e.g. from `rasterio.windows.from_bounds` and
+            `datacube_transform(ds)`.
+        variable (str): Data variable, default is the index of the datacube.
+        time (slice): Optional date range, e.g. slice('2024-08-01', '2024-09-30').
+    """
+    data = ds[variable or ds.attrs["variable"]].isel(
+        y=slice(window.row_off, window.row_off + window.height),
+        x=slice(window.col_off, window.col_off + window.width),
+    )
+    return data if time is None else data.sel(time=time)
+
+
+def pixel_history(ds, x, y, variable=None):
+    """Lazy time series DataArray of the pixel nearest to the (x, y) coordinates, in the CRS of the datacube."""
+    return ds[variable or ds.attrs["variable"]].sel(x=x, y=y, method="nearest")
@@ -0,0 +1,384 @@
+"""
+Concurrent, rate-limit aware download of Sentinel Hub requests.
+
+All requests go through a single `RateLimitedDownloadClient`, which throttles the outgoing requests with
+token buckets (requests per second and processing units per minute) and retries HTTP 429, 5xx and
+connection errors with exponential backoff. Its `base_url` sends every request to another host, e.g. a
+local mock server, as sentinelhub picks the service URL of process requests from the data collection.
+
+The client is meant to be long-lived and shared: it owns its config, a keep-alive HTTP connection pool and an
+OAuth session whose token is refreshed before it expires, and can be used from several threads at once.
+`get_default_client()` returns a process-wide one built from the secrets, used by the fetch functions when
+no client is given, so back-to-back calls reuse the same connections and token.
+"""
+import copy
+import dataclasses
+import logging
+import random
+import threading
+import time
+import warnings
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from sentinelhub import SentinelHubCatalog, SentinelHubDownloadClient, SentinelHubSession
+from sentinelhub.download.client import DownloadClient
+from sentinelhub.download.handlers import fail_user_errors
+from sentinelhub.download.models import DownloadResponse
+from sentinelhub.exceptions import DownloadFailedException, SHRuntimeWarning
+
+from rubicon_cs.config import get_sh_config
+from rubicon_cs.instrumentation import count, stage
+
+LOGGER = logging.getLogger(__name__)
+
+# Headers returned by Sentinel Hub, both Retry-After and the PU headers are expressed in milliseconds/PUs
+RETRY_AFTER_HEADER = "Retry-After"
+PROCESSING_UNITS_HEADER = "X-ProcessingUnits-Spent"
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Parameters:
+        rate (float): Number of tokens added per second. If None the bucket never blocks.
+        capacity (float): Maximum number of tokens the bucket can hold, i.e. the allowed burst. Defaults to `rate`.
+    """
+
+    def __init__(self, rate=None, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate or 1, 1)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` tokens are available and take them."""
+        if self.rate is None:
+            return
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_time = (tokens - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+    def consume(self, tokens):
+        """Take `tokens` tokens without waiting. The balance may become negative, which delays the next acquire."""
+        if self.rate is None:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+
+    def pause(self, seconds):
+        """Empty the bucket so that no token is handed out during the next `seconds` seconds."""
+        if self.rate is None:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class RateLimitedDownloadClient(SentinelHubDownloadClient):
+    """
+    Sentinel Hub download client with token-bucket throttling and exponential backoff.
+
+    Parameters:
+        requests_per_second (float): Max sustained request rate. None disables request throttling.
+        processing_units_per_minute (float): Max sustained processing unit (PU) consumption, based on the
+            PUs reported by Sentinel Hub for each response. None disables PU throttling.
+        max_attempts (int): Number of attempts per request before giving up. Default is 5.
+        backoff_factor (float): Base waiting time in seconds of the exponential backoff. Default is 1.
+        max_backoff (float): Upper bound in seconds of a single backoff. Default is 60.
+        cache (ResponseCache): If given, responses are looked up in and stored to this cache.
+        base_url (str): If given, the scheme and host of every request URL are replaced by this URL,
+            e.g. 'http://127.0.0.1:8000' for a local mock server. Default keeps the Sentinel Hub URLs.
+        pool_size (int): Number of keep-alive connections kept per host. Should be at least the number of
+            concurrent downloads. Default is 16.
+        refresh_before_expiry (float): The OAuth token is renewed when it expires in less than this many
+            seconds. Default is 120.
+        kwargs: Passed to `SentinelHubDownloadClient` (e.g. `config`, or an authenticated `session`).
+
+    Notes:
+        - The OAuth session is created on the first request and kept by the client, the token is only fetched
+          again when it is about to expire. `with_cache` copies and the `catalog` share it.
+        - Unlike `SentinelHubDownloadClient`, the lock guarding the token refresh lives as long as the client,
+          so several threads can call `download` concurrently on the same client.
+    """
+
+    def __init__(self, *, requests_per_second=None, processing_units_per_minute=None, max_attempts=5,
+                 backoff_factor=1.0, max_backoff=60.0, cache=None, base_url=None, pool_size=16,
+                 refresh_before_expiry=SentinelHubSession.DEFAULT_SECONDS_BEFORE_EXPIRY, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+        self.base_url = base_url.rstrip("/") if base_url else None
+        self.request_bucket = TokenBucket(requests_per_second)
+        pu_rate = processing_units_per_minute / 60 if processing_units_per_minute else None
+        self.pu_bucket = TokenBucket(pu_rate, capacity=processing_units_per_minute)
+        self.max_attempts = max_attempts
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.refresh_before_expiry = refresh_before_expiry
+
+        # Shared by reference with the copies made by `with_cache`
+        self.http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http_session.mount("https://", adapter)
+        self.http_session.mount("http://", adapter)
+        self._shared = _SharedAuth(self.session)
+
+    @classmethod
+    def from_secrets(cls, **kwargs):
+        """Create a client with the Sentinel Hub credentials of the secrets, see `rubicon_cs.config.get_secret`."""
+        return cls(config=get_sh_config(), **kwargs)
+
+    def with_cache(self, cache):
+        """Return a copy using another response cache, sharing the rate limits, connections and OAuth session."""
+        if cache is self.cache:
+            return self
+        client = copy.copy(self)
+        client.cache = cache
+        return client
+
+    @property
+    def catalog(self):
+        """`SentinelHubCatalog` sending its searches through this client, without response cache."""
+        with self._shared.lock:
+            if self._shared.catalog is None:
+                catalog = SentinelHubCatalog(config=self.config)
+                # Catalog results are cached by rubicon_cs.catalog, only for windows that are over
+                catalog.client = self.with_cache(None)
+                self._shared.catalog = catalog
+            return self._shared.catalog
+
+    def download(self, *args, **kwargs):
+        """Download requests, see `DownloadClient.download`. Safe to call from several threads at once."""
+        # SentinelHubDownloadClient.download replaces its lock on each call, which breaks concurrent calls
+        return DownloadClient.download(self, *args, **kwargs)
+
+    def _execute_thread_safe(self, thread_unsafe_function, *args, **kwargs):
+        with self._shared.lock:
+            return thread_unsafe_function(*args, **kwargs)
+
+    def get_session(self):
+        """Return the client's OAuth session, authenticating on first use."""
+        with self._shared.lock:
+            if self._shared.session is None:
+                self._shared.session = _InstrumentedSession(
+                    config=self.config, refresh_before_expiry=self.refresh_before_expiry
+                )
+            return self._shared.session
+
+    def _do_download(self, request):
+        """Send the request through the keep-alive connection pool."""
+        if request.url is None:
+            raise ValueError(f"Faulty request {request}, no URL specified.")
+        return self.http_session.request(
+            request.request_type.value,
+            url=request.url,
+            json=request.post_values,
+            headers=self._prepare_headers(request),
+            timeout=self.config.download_timeout_seconds,
+        )
+
+    @fail_user_errors
+    def _execute_download(self, request):
+        """Execute a single request, waiting for the token buckets and retrying temporary failures."""
+        labels = _request_labels(request)
+        with stage("download", **labels):
+            return self._download_with_retries(self._route(request), labels)
+
+    def _download_with_retries(self, request, labels):
+        if self.cache is not None:
+            cache_key = self.cache.request_key(request)
+            content = self.cache.get(cache_key)
+            if content is not None:
+                LOGGER.debug("Serving %s from cache", request.url)
+                count("download_cache_hits", **labels)
+                return DownloadResponse(request=request, content=content, status_code=requests.codes.OK)
+
+        for attempt in range(self.max_attempts):
+            self.request_bucket.acquire()
+            self.pu_bucket.acquire()
+
+            count("download_requests", **labels)
+            if attempt:
+                count("download_retries", **labels)
+            try:
+                response = self._do_download(request)
+            except (requests.ConnectionError, requests.Timeout) as exception:
+                if attempt + 1 == self.max_attempts:
+                    raise DownloadFailedException(
+                        f"Failed to download from {request.url}: {exception}", request_exception=exception
+                    ) from exception
+                delay = self._backoff_time(attempt)
+                LOGGER.debug("Connection error on %s, retrying in %.2fs", request.url, delay)
+                time.sleep(delay)
+                continue
+
+            # One PU was reserved before the request, settle the difference with what was actually spent
+            spent = float(response.headers.get(PROCESSING_UNITS_HEADER, 1))
+            self.pu_bucket.consume(spent - 1)
+
+            if response.status_code == requests.codes.TOO_MANY_REQUESTS or response.status_code >= 500:
+                if attempt + 1 == self.max_attempts:
+                    break
+                delay = self._backoff_time(attempt, response.headers.get(RETRY_AFTER_HEADER))
+                if response.status_code == requests.codes.TOO_MANY_REQUESTS:
+                    count("http_429", **labels)
+                    # Rate and PU limits are per account, so every thread has to slow down
+                    self.request_bucket.pause(delay)
+                    self.pu_bucket.pause(delay)
+                LOGGER.debug("Got HTTP %d on %s, retrying in %.2fs", response.status_code, request.url, delay)
+                time.sleep(delay)
+                continue
+
+            response.raise_for_status()
+            count("download_bytes", len(response.content), **labels)
+            if self.cache is not None:
+                self.cache.put(cache_key, response.content)
+            return DownloadResponse.from_response(response, request)
+
+        raise DownloadFailedException(f"Maximum number of download attempts reached for {request.url}")
+
+    def _single_download_decoded(self, request):
+        """Download a response and decode it into data, e.g. a numpy array for TIFF/PNG responses."""
+        response = self._single_download(request)
+        if response is None:
+            return None
+        with stage("decode"):
+            return response.decode()
+
+    def _route(self, request):
+        """Point the request at `base_url`, keeping its path and query."""
+        if self.base_url is None or request.url is None:
+            return request
+        url, base = urlsplit(request.url), urlsplit(self.base_url)
+        routed_url = urlunsplit((base.scheme, base.netloc, base.path + url.path, url.query, url.fragment))
+        return dataclasses.replace(request, url=routed_url)
+
+    def _backoff_time(self, attempt, retry_after=None):
+        """Exponential backoff with jitter, never shorter than the server's Retry-After (in milliseconds)."""
+        delay = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        delay *= 0.5 + random.random() / 2
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after) / 1000)
+            except ValueError:
+                pass
+        return delay
+
+
+def _request_labels(request):
+    """Instrumentation labels of a request: the start date of a Process API request's time range, if any."""
+    try:
+        time_from = request.post_values["input"]["data"][0]["dataFilter"]["timeRange"]["from"]
+    except (KeyError, IndexError, TypeError):
+        return {}
+    return {"date": time_from[:10]}
+
+
+class _InstrumentedSession(SentinelHubSession):
+    """OAuth session recording its token fetches and refreshes in the oauth stage, not the cached token lookups."""
+
+    def _collect_new_token(self):
+        with stage("oauth"):
+            return super()._collect_new_token()
+
+
+class _SharedAuth:
+    """OAuth session, catalog and lock of a client, shared with its `with_cache` copies."""
+
+    def __init__(self, session=None):
+        self.lock = threading.RLock()
+        self.session = session
+        self.catalog = None
+
+
+def get_default_client(cache=None):
+    """
+    Return the process-wide download client, created from the secrets on first use.
+
+    Parameters:
+        cache (ResponseCache): Response cache of the returned client. The clients returned for different
+            caches share the same rate limits, connections and OAuth session.
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = RateLimitedDownloadClient.from_secrets()
+    return _default_client.with_cache(cache)
+
+
+def _download_decoded(client, request):
+    """Download and decode a request like `client.download([request])`, without starting a thread pool per request."""
+    try:
+        return client._single_download_decoded(request)
+    except DownloadFailedException as exception:
+        if client.raise_download_errors:
+            raise
+        warnings.warn(str(exception), category=SHRuntimeWarning)
+        return None
+
+
+def iter_downloads(download_requests, client, max_workers=4, ordered=True, max_pending=None):
+    """
+    Download requests concurrently and yield (index, data) pairs.
+
+    The `max_workers` threads of a single executor pick up the next request as soon as they are done with one,
+    so a slow response doesn't hold back the others. At most `max_pending` requests are in flight or downloaded but not yet
+    yielded, which bounds the responses held in memory.
+
+    Parameters:
+        download_requests (list): List of sentinelhub `DownloadRequest` objects.
+        client (SentinelHubDownloadClient): Client used for all downloads, e.g. a `RateLimitedDownloadClient`.
+            It must be safe to call from several threads, as `RateLimitedDownloadClient` is.
+        max_workers (int): Number of concurrent downloads. Default is 4.
+        ordered (bool): Yield in the order of the input list (a slow response then delays the yields, not the
+            downloads), else in completion order. Default is True.
+        max_pending (int): Maximum number of requests in flight or waiting to be yielded. Default is
+            2 * max_workers.
+    """
+    max_pending = max(max_pending or 2 * max_workers, max_workers)
+    requests_iter = iter(enumerate(download_requests))
+    pending = deque()
+
+    def submit(executor):
+        for index, request in requests_iter:
+            pending.append((index, executor.submit(_download_decoded, client, request)))
+            if len(pending) >= max_pending:
+                return
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        submit(executor)
+        while pending:
+            if ordered:
+                index, future = pending.popleft()
+                yield index, future.result()
+            else:
+                wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                done = [(index, future) for index, future in pending if future.done()]
+                for item in done:
+                    pending.remove(item)
+                for index, future in done:
+                    yield index, future.result()
+            submit(executor)
+    finally:
+        # Stop the queued requests if the caller stops early or a download failed
+        executor.shutdown(wait=True, cancel_futures=True)
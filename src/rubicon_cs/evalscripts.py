@@ -7,8 +7,8 @@ function setup() {
             bands: ["B02", "B03", "B04"]
         }],
         output: {
-            bands: 3
-            sampleType: "UINT8"
+            bands: 3,
+            sampleType: "AUTO"
         }
     };
 }
@@ -179,6 +179,38 @@ return ar * (ar * (tx / maxC + ty - 1) - ty) / (ar * (2 * tx / maxC - 1) - tx /
 const sRGB = (c) => c <= 0.0031308 ? (12.92 * c) : (1.055 * Math.pow(c, 0.41666666666) - 0.055); 
 """
 
+def build_bands_evalscript(bands, sample_type="FLOAT32"):
+    """
+    Build an evalscript returning the raw values of the given bands, followed by dataMask.
+
+    Used by the local index engine (rubicon_cs.indices) to fetch every band needed by several indices at once.
+    With sample_type="FLOAT32" the bands are reflectances, with "UINT16" they are the digital numbers
+    (reflectance * 10000), half the size of FLOAT32.
+    """
+    if sample_type not in ("FLOAT32", "UINT16"):
+        raise ValueError(f"sample_type must be 'FLOAT32' or 'UINT16', got {sample_type}")
+    band_list = ", ".join(f'"{band}"' for band in bands)
+    samples = ", ".join(f"sample.{band}" for band in bands)
+    # FLOAT32 keeps the original script text, so that cached responses stay valid (tests/test_evalscripts.py)
+    inputs = f'{band_list}, "dataMask"'
+    if sample_type == "UINT16":
+        inputs = f'{{ bands: [{inputs}], units: "DN" }}'
+    return f"""
+//VERSION=3
+function setup() {{
+    return {{
+        input: [{inputs}],
+        output: {{
+            bands: {len(bands) + 1},
+            sampleType: "{sample_type}"
+        }}
+    }};
+}}
+function evaluatePixel(sample) {{
+  return [{samples}, sample.dataMask];
+}}
+"""
+
 INDEX_DICT = {
     'ndvi':evalscript_ndvi,
     'evi':evalscript_evi,
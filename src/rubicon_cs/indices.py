@@ -0,0 +1,79 @@
+"""
+Local vegetation index engine.
+
+Instead of running one evalscript per index on Sentinel Hub, the raw bands needed by all the requested
+indices are fetched once and the indices are computed here with vectorized NumPy. Adding a new index
+only requires adding its bands and formula to `INDEX_FORMULAS`.
+"""
+import numpy as np
+
+
+def safe_divide(numerator, denominator):
+    """Element-wise division returning NaN where the denominator is 0."""
+    out = np.full(np.broadcast(numerator, denominator).shape, np.nan, dtype=np.float32)
+    return np.divide(numerator, denominator, out=out, where=denominator != 0)
+
+
+def normalized_difference(a, b):
+    """(a - b) / (a + b)"""
+    return safe_divide(a - b, a + b)
+
+
+def _savi(b, L=0.5):
+    return safe_divide(b["B08"] - b["B04"], b["B08"] + b["B04"] + L) * (1.0 + L)
+
+
+def _arvi(b):
+    red_corr = 2.0 * b["B04"] - b["B02"]
+    return normalized_difference(b["B08"], red_corr)
+
+
+# Index name -> (bands used, formula taking a dict of band name -> float32 array)
+# Formulas match the server-side evalscripts of rubicon_cs.evalscripts
+INDEX_FORMULAS = {
+    'ndvi': (["B08", "B04"], lambda b: normalized_difference(b["B08"], b["B04"])),
+    'evi': (["B02", "B04", "B08"],
+            lambda b: safe_divide(2.5 * (b["B08"] - b["B04"]), b["B08"] + 6.0 * b["B04"] - 7.5 * b["B02"] + 1.0)),
+    'gndvi': (["B08", "B03"], lambda b: normalized_difference(b["B08"], b["B03"])),
+    'ndre': (["B08", "B05"], lambda b: normalized_difference(b["B08"], b["B05"])),
+    'savi': (["B08", "B04"], _savi),
+    'arvi': (["B02", "B04", "B08"], _arvi),
+}
+
+
+def required_bands(indices):
+    """Return the sorted union of the bands needed to compute the given indices."""
+    unknown = [name for name in indices if name not in INDEX_FORMULAS]
+    if unknown:
+        raise ValueError(f"Unknown vegetation indices {unknown}, choose from {list(INDEX_FORMULAS)}")
+    return sorted({band for name in indices for band in INDEX_FORMULAS[name][0]})
+
+
+def compute_indices(band_stack, band_names, indices, data_mask=None, chunk_rows=512):
+    """
+    Compute several vegetation indices from a stack of raw bands.
+
+    Parameters:
+        band_stack (np.ndarray): Array of shape (H, W, n_bands), as returned by Sentinel Hub for a multi-band TIFF.
+        band_names (list): Name of each band of the stack, e.g. ["B02", "B04", "B08"].
+        indices (list): Indices to compute, keys of `INDEX_FORMULAS`.
+        data_mask (np.ndarray): Optional (H, W) array, pixels where it is 0 are set to NaN in every index.
+        chunk_rows (int): Number of rows processed at once, bounds the size of the temporaries. Default is 512.
+
+    Returns:
+        dict: Mapping of index name to a (H, W) float32 array.
+    """
+    height, width = band_stack.shape[:2]
+    results = {name: np.empty((height, width), dtype=np.float32) for name in indices}
+
+    for row in range(0, height, chunk_rows):
+        chunk = band_stack[row:row + chunk_rows].astype(np.float32, copy=False)
+        bands = {name: chunk[..., k] for k, name in enumerate(band_names)}
+        invalid = None if data_mask is None else data_mask[row:row + chunk_rows] == 0
+
+        for name in indices:
+            values = INDEX_FORMULAS[name][1](bands)
+            if invalid is not None:
+                values[invalid] = np.nan
+            results[name][row:row + chunk_rows] = values
+    return results
@@ -0,0 +1,276 @@
+"""
+Per-stage timings and counters of the fetch, write and inference pipeline.
+
+The pipeline wraps its stages in `stage(name)` and counts events with `count(name, value)`:
+
+    - catalog_search, oauth (OAuth token fetches and refreshes), download, decode, write (GeoTIFF/Zarr/PNG writing);
+    - pad, extract, forward (one model batch), stitch;
+    - counters download_requests, download_bytes, download_retries, download_cache_hits, http_429,
+      catalog_cache_hits, store_new_dates, patches, skipped_patches.
+
+The download stage and counters of Process API requests are labelled with the date of the request, so the
+JSON summary, the Prometheus metrics and the event log all break them down per date.
+
+Nothing is recorded until a `Recorder` is enabled: `stage` then returns a shared no-op context manager and
+`count` returns right away, so the disabled cost is a global lookup per call. Once enabled, every stage keeps
+its count, total, min and max duration (per label set), optionally every event is appended to a JSON lines
+log, and the summary can be exported as JSON or Prometheus text format.
+
+Usage:
+    with recording(log_path="events.jsonl", metrics_path="metrics.prom"):
+        geotiff_for_veg_index(AOI, date_range)
+
+    with profile("profiles/", torch_profiler=True):  # cProfile stats and a Chrome trace of one run
+        semantic_segmentation_large_image(image, model, "cpu")
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+_RECORDER = None
+_NULL_STAGE = nullcontext()
+
+
+class _Stage:
+    __slots__ = ("recorder", "name", "labels", "start", "annotation")
+
+    def __init__(self, recorder, name, labels):
+        self.recorder = recorder
+        self.name = name
+        self.labels = labels
+        self.annotation = None
+
+    def __enter__(self):
+        if self.recorder.record_function is not None:
+            # Make the stage visible in the torch profiler trace
+            self.annotation = self.recorder.record_function(self.name)
+            self.annotation.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        if self.annotation is not None:
+            self.annotation.__exit__(*exc_info)
+        self.recorder.observe(self.name, seconds, self.labels)
+        return False
+
+
+class Recorder:
+    """
+    Thread-safe store of stage timings and counters.
+
+    Parameters:
+        log_path (str): If given, every stage and counter event is appended to this JSON lines file with
+            its timestamp, thread and labels.
+    """
+
+    def __init__(self, log_path=None):
+        self.stages = {}
+        self.counters = {}
+        self.record_function = None
+        self._lock = threading.Lock()
+        self._log = open(log_path, "a") if log_path else None
+
+    def observe(self, name, seconds, labels=None):
+        """Record one `seconds` long run of stage `name`."""
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        with self._lock:
+            stats = self.stages.get(key)
+            if stats is None:
+                self.stages[key] = [1, seconds, seconds, seconds]  # count, total, min, max
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = min(stats[2], seconds)
+                stats[3] = max(stats[3], seconds)
+            self._write_event("stage", name, seconds, labels)
+
+    def count(self, name, value=1, labels=None):
+        """Add `value` to counter `name`."""
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self._write_event("counter", name, value, labels)
+
+    def _write_event(self, event_type, name, value, labels):
+        if self._log is not None:
+            event = {"ts": time.time(), "type": event_type, "name": name,
+                     "seconds" if event_type == "stage" else "value": value,
+                     "thread": threading.current_thread().name}
+            if labels:
+                event["labels"] = labels
+            self._log.write(json.dumps(event) + "\n")
+
+    def summary(self):
+        """Return the stages and counters as a JSON serializable dict."""
+        with self._lock:
+            stages = [
+                {"stage": name, "labels": dict(labels), "count": count, "total_seconds": total,
+                 "mean_seconds": total / count, "min_seconds": low, "max_seconds": high}
+                for (name, labels), (count, total, low, high) in sorted(self.stages.items())
+            ]
+            counters = [{"counter": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+        return {"stages": stages, "counters": counters}
+
+    def to_prometheus(self, prefix="rubicon_cs"):
+        """Return the stages and counters in Prometheus text exposition format."""
+        summary = self.summary()
+        lines = [f"# HELP {prefix}_stage_seconds Time spent in each pipeline stage.",
+                 f"# TYPE {prefix}_stage_seconds summary"]
+        for stats in summary["stages"]:
+            labels = _prometheus_labels({"stage": stats["stage"], **stats["labels"]})
+            lines.append(f"{prefix}_stage_seconds_count{labels} {stats['count']}")
+            lines.append(f"{prefix}_stage_seconds_sum{labels} {stats['total_seconds']:.6f}")
+        lines += [f"# HELP {prefix}_stage_seconds_max Longest run of each pipeline stage.",
+                  f"# TYPE {prefix}_stage_seconds_max gauge"]
+        for stats in summary["stages"]:
+            labels = _prometheus_labels({"stage": stats["stage"], **stats["labels"]})
+            lines.append(f"{prefix}_stage_seconds_max{labels} {stats['max_seconds']:.6f}")
+
+        for name in sorted({counter["counter"] for counter in summary["counters"]}):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for counter in summary["counters"]:
+                if counter["counter"] == name:
+                    lines.append(f"{prefix}_{name}_total{_prometheus_labels(counter['labels'])} {counter['value']}")
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path):
+        """Write the summary to `path`, in Prometheus text format if it ends with .prom, else as JSON."""
+        with open(path, "w") as file:
+            if str(path).endswith(".prom"):
+                file.write(self.to_prometheus())
+            else:
+                json.dump(self.summary(), file, indent=2)
+        return path
+
+    def close(self):
+        if self._log is not None:
+            with self._lock:
+                self._log.close()
+                self._log = None
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def stage(name, **labels):
+    """Context manager timing the stage `name`, a shared no-op when no recorder is enabled."""
+    recorder = _RECORDER
+    if recorder is None:
+        return _NULL_STAGE
+    return _Stage(recorder, name, labels)
+
+
+def count(name, value=1, **labels):
+    """Add `value` to the counter `name` of the enabled recorder, if any."""
+    recorder = _RECORDER
+    if recorder is not None:
+        recorder.count(name, value, labels)
+
+
+def enable(log_path=None):
+    """Start recording into a new `Recorder`, which is returned."""
+    global _RECORDER
+    _RECORDER = Recorder(log_path)
+    return _RECORDER
+
+
+def disable():
+    """Stop recording and return the recorder that was enabled, if any."""
+    global _RECORDER
+    recorder, _RECORDER = _RECORDER, None
+    if recorder is not None:
+        recorder.close()
+    return recorder
+
+
+def get_recorder():
+    """Return the enabled recorder, or None."""
+    return _RECORDER
+
+
+@contextmanager
+def recording(log_path=None, metrics_path=None):
+    """
+    Record the stages run inside the context.
+
+    Parameters:
+        log_path (str): Optional JSON lines file receiving every stage and counter event.
+        metrics_path (str): Optional file receiving the summary when the context exits, in Prometheus text
+            format if it ends with .prom, else as JSON.
+
+    Yields:
+        Recorder
+    """
+    recorder = enable(log_path)
+    try:
+        yield recorder
+    finally:
+        disable()
+        if metrics_path:
+            recorder.write_metrics(metrics_path)
+
+
+@contextmanager
+def profile(output_dir, torch_profiler=False, sort_by="cumulative"):
+    """
+    Profile the code run inside the context with cProfile, and optionally the torch profiler.
+
+    Writes `cprofile.prof` (for snakeviz or `pstats`) and a `cprofile.txt` summary of the 50 most expensive
+    functions to `output_dir`, plus `torch_trace.json` (open in chrome://tracing or Perfetto) with
+    `torch_profiler=True`. cProfile only sees the calling thread, the download threads are covered by the
+    `download` stage timings. When a recorder is enabled, its stages are annotated in the torch trace.
+
+    Yields:
+        dict: Paths of the written files, filled when the context exits.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    torch_context = nullcontext()
+    recorder = _RECORDER
+    if torch_profiler:
+        try:
+            import torch.profiler
+        except ImportError as error:
+            raise ImportError("torch_profiler=True requires torch") from error
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        torch_context = torch.profiler.profile(activities=activities, record_shapes=True)
+        if recorder is not None:
+            recorder.record_function = torch.profiler.record_function
+
+    profiler = cProfile.Profile()
+    torch_prof = None
+    try:
+        with torch_context as torch_prof:
+            profiler.enable()
+            try:
+                yield paths
+            finally:
+                profiler.disable()
+    finally:
+        if recorder is not None:
+            recorder.record_function = None
+        paths["cprofile"] = os.path.join(output_dir, "cprofile.prof")
+        profiler.dump_stats(paths["cprofile"])
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats(sort_by).print_stats(50)
+        paths["cprofile_summary"] = os.path.join(output_dir, "cprofile.txt")
+        with open(paths["cprofile_summary"], "w") as file:
+            file.write(text.getvalue())
+        if torch_prof is not None:
+            paths["torch_trace"] = os.path.join(output_dir, "torch_trace.json")
+            torch_prof.export_chrome_trace(paths["torch_trace"])
@@ -1,22 +1,55 @@
+"""
+Fetch functions: vegetation index time series, RGB images and zonal statistics from Sentinel Hub.
+
+Only the fetch dependencies (sentinelhub, rasterio, numpy) are imported here. The segmentation functions
+(`semantic_segmentation_large_image`, `segment_geotiff`, `predict_batches`) live in rubicon_cs.segmentation
+and are still importable from this module, torch being loaded on first access only.
+"""
+import hashlib
+import json
 import os
+from datetime import date as datetime_date
+from collections import namedtuple
+from contextlib import ExitStack
 import numpy as np
 import rasterio
-import torch
+from rasterio.windows import Window
 from PIL import Image
-import streamlit as st
 
 from sentinelhub import (
-    CRS, DataCollection, Geometry, MimeType,
-    SentinelHubCatalog, SentinelHubRequest, SHConfig
+    CRS, DataCollection, Geometry, MimeType, SentinelHubRequest
 )
 
-from rubicon_cs.evalscripts import INDEX_DICT
-from rubicon_cs.utils import (
-    extract_patches, find_nearest_available_date,
-    get_scaled_dimensions, pad_to_multiple, stitch_patches
+from rubicon_cs.cache import resolve_cache
+from rubicon_cs.catalog import get_acquisition_dates
+from rubicon_cs.config import get_secret  # still imported from here by callers
+from rubicon_cs.datacube import open_zarr_writer
+from rubicon_cs.download import get_default_client, iter_downloads
+from rubicon_cs.evalscripts import INDEX_DICT, build_bands_evalscript
+from rubicon_cs.indices import compute_indices, required_bands
+from rubicon_cs.instrumentation import count, stage
+from rubicon_cs.quantize import build_quantized_index_evalscript, dequantize, get_quantization
+from rubicon_cs.utils import find_nearest_available_date, get_scaled_dimensions, get_tile_grid
+from rubicon_cs.writers import open_cog_writer, read_band_dates
+from rubicon_cs.zonal import (
+    DEFAULT_PERCENTILES, ZonalTimeSeries, rasterize_zones, write_time_series, zones_from_geojson
 )
 
-def geotiff_for_veg_index(AOI, date_range, veg_index='ndvi', cloud_cover_limit=20, output_dir = 'outputs/section_1'):
+_SEGMENTATION_FUNCTIONS = {
+    'semantic_segmentation_large_image', 'predict_batches', 'segment_geotiff', 'to_model_input', 'valid_mask_from'
+}
+
+
+def __getattr__(name):
+    if name in _SEGMENTATION_FUNCTIONS:
+        from rubicon_cs import segmentation
+        return getattr(segmentation, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def geotiff_for_veg_index(AOI, date_range, veg_index='ndvi', cloud_cover_limit=20, output_dir = 'outputs/section_1',
+                          tiled=False, max_workers=4, download_client=None, cache=True, compress='deflate',
+                          progress_callback=None, output_format='geotiff', quantization=None):
     """
     Generate a multi-band GeoTIFF file containing vegetation index images
     for a given area and date range.
@@ -26,180 +59,468 @@ def geotiff_for_veg_index(AOI, date_range, veg_index='ndvi', cloud_cover_limit=2
         date_range (tuple): Tuple of (start_date, end_date) in 'YYYY-MM-DD' format.
         veg_index (str): Vegetation index to use, default is 'ndvi'.
         cloud_cover_limit (int): Max allowed cloud cover percentage.
-    """
+        tiled (bool): If True, fetch the AOI at native 10 m resolution as a grid of tiles that each fit
+            the Sentinel Hub 2500x2500 px limit, instead of downscaling it. Default is False.
+        max_workers (int): Number of dates/tiles downloaded concurrently. Default is 4.
+        download_client (RateLimitedDownloadClient): Long-lived client used for the catalog search and the
+            downloads, e.g. to tune rate limits. Reusing it across calls and threads reuses its connections and
+            OAuth token. Default is the process-wide client of `get_default_client`.
+        cache (bool or ResponseCache): Cache used for catalog results and downloaded scenes. True uses the
+            default on-disk cache, False disables caching. Default is True.
+        compress (str): Compression of the output Cloud-Optimized GeoTIFF, 'deflate', 'zstd' or 'none'.
+            Default is 'deflate'.
+        progress_callback (callable): Called as `progress_callback(date, window, array, plan)` for each date/tile
+            as soon as it is downloaded, e.g. to display the bands while the others are fetched.
+        output_format (str): 'geotiff' for a Cloud-Optimized GeoTIFF with one band per date, or 'zarr' for a
+            chunked (time, y, x) datacube `{start}_{end}_{index}.zarr` suited to per-pixel time series
+            (see rubicon_cs.datacube, requires xarray, zarr and dask). Default is 'geotiff'.
+        quantization (str): 'INT16' or 'UINT8' to transfer the index as scaled integers (see rubicon_cs.quantize).
+            GeoTIFFs keep the integers with the scale/offset and nodata in their metadata, use
+            `rubicon_cs.writers.read_band` to read them as floats. Datacubes store the dequantized values.
+            Default is None, i.e. FLOAT32.
 
-    geometry = Geometry.from_geojson(AOI, crs=CRS.WGS84)
+    Returns:
+        str: Path of the written GeoTIFF or Zarr store.
+    """
 
-    # Set up config
-    config = SHConfig()
-    config.sh_client_id = get_secret("SH_CLIENT_ID")
-    config.sh_client_secret = get_secret("SH_CLIENT_SECRET")
-    
+    plan = _plan_fetch(AOI, date_range, cloud_cover_limit, tiled, download_client, cache)
 
-    # Catalog to find acquisition dates
-    catalog = SentinelHubCatalog(config=config)
-
-    search_iterator = catalog.search(
-        DataCollection.SENTINEL2_L2A,
-        geometry=geometry,
-        time=(date_range[0], date_range[1]),
-        filter=f'eo:cloud_cover < {cloud_cover_limit}',
-        fields={"include": ["properties.datetime"], "exclude": []}
+    profile = dict(
+        height=plan.height,
+        width=plan.width,
+        dtype=np.float32,
+        crs=plan.crs,
+        transform=plan.transform,
+        nodata=np.nan if tiled else None,
     )
+    evalscript = INDEX_DICT[veg_index]
+    quantization = get_quantization(quantization, veg_index) if quantization else None
+    if quantization is not None:
+        evalscript = build_quantized_index_evalscript(veg_index, quantization)
+        if output_format != 'zarr':
+            profile.update(dtype=quantization.dtype, nodata=quantization.nodata)
 
-    acquisition_dates = sorted({item["properties"]["datetime"][:10] for item in search_iterator})
-    if not acquisition_dates:
-        raise ValueError("No acquisition dates found within specified date range and cloud cover limit.")
+    if output_format == 'zarr':
+        filename = f"{output_dir}/{date_range[0]}_{date_range[1]}_{veg_index}.zarr"
+        writer = open_zarr_writer(filename, dates=plan.dates, variable=veg_index, **profile)
+    elif output_format == 'geotiff':
+        filename = f"{output_dir}/{date_range[0]}_{date_range[1]}_{veg_index}.tif"
+        writer = open_cog_writer(filename, count=len(plan.dates), compress=compress, **profile)
+    else:
+        raise ValueError(f"Unknown output format {output_format}, choose 'geotiff' or 'zarr'")
 
-    ndvi_stack = []
-    transform = None
-    width, height = get_scaled_dimensions(geometry)
+    # Save as a Cloud-Optimized GeoTIFF (or datacube), writing each date/tile straight into its band and window
+    # as soon as it is downloaded, so that only a few `max_workers` responses are held in memory at once
+    with writer as dst:
+        if quantization is not None and output_format != 'zarr':
+            dst.scales = [quantization.scale] * len(plan.dates)
+            dst.offsets = [quantization.offset] * len(plan.dates)
 
-    for date in acquisition_dates:
-        request = SentinelHubRequest(
-            evalscript=INDEX_DICT[veg_index],
-            input_data=[SentinelHubRequest.input_data(
-                data_collection=DataCollection.SENTINEL2_L2A,
-                time_interval=(date, date)
-            )],
-            responses=[SentinelHubRequest.output_response("default", MimeType.TIFF)],
-            bbox=geometry.bbox,
-            size=(width, height),
-            config=config,
+        tile_data = _download_tiles(
+            evalscript, plan.dates, plan.tiles, MimeType.TIFF, plan.client, max_workers=max_workers
         )
-        ndvi_img = request.get_data()[0]
-        ndvi_stack.append(ndvi_img.squeeze())  # remove extra dimension
-
-        # After retrieving the first image, use it to get metadata
-        if transform is None:
-            bounds = geometry.bbox
-            print(f"Bounding Box: {bounds}")
-
-            height, width = ndvi_img.shape[-2], ndvi_img.shape[-1]
-            transform = rasterio.transform.from_bounds(*bounds, width, height)
-            crs = geometry.crs.pyproj_crs()
-
-    filename = f"{output_dir}/{date_range[0]}_{date_range[1]}_{veg_index}.tif"
-    # Save as GeoTIFF
-    with rasterio.open(
-        filename, "w",
-        driver="GTiff",
-        height=ndvi_stack[0].shape[0],
-        width=ndvi_stack[0].shape[1],
-        count=len(ndvi_stack),
-        dtype=np.float32,
-        crs=crs,
-        transform=transform
-    ) as dst:
-        for i, (ndvi, date) in enumerate(zip(ndvi_stack, acquisition_dates), start=1):
-            # Write each date of vegetation_index to a band in a GeoTIFF
-            dst.write(ndvi.astype(np.float32), i)
-            
+        for date_idx, window, ndvi_img in tile_data:
+            # Write each date of vegetation_index to a band in a GeoTIFF, bands follow the date order
+            band = ndvi_img.reshape(window.height, window.width).astype(profile['dtype'])
+            values = band
+            if quantization is not None and (output_format == 'zarr' or progress_callback is not None):
+                values = dequantize(band, quantization)
+            with stage("write"):
+                dst.write(values if output_format == 'zarr' else band, date_idx + 1, window=window)
+            if progress_callback is not None:
+                progress_callback(plan.dates[date_idx], window, values, plan)
+
+        for i, date in enumerate(plan.dates, start=1):
             # Add the acquisition date as a description for each band
             dst.update_tags(i, DATE=date)
 
+    return filename
 
-def png_for_target_date(AOI, target_date, cloud_cover_limit=20, rgb_evalscript='rgb_optimized'):
+
+def geotiff_for_veg_indices(AOI, date_range, veg_indices=('ndvi',), cloud_cover_limit=20,
+                            output_dir='outputs/section_1', multi_index=True, tiled=False, max_workers=4,
+                            download_client=None, cache=True, compress='deflate', bands=None):
     """
-    Generate and save an RGB image as PNG for a specific date or the nearest available one.
+    Generate GeoTIFF files for several vegetation indices, downloading the raw bands only once per date.
+
+    The union of the bands needed by the indices is requested from Sentinel Hub for each date and the
+    indices are computed locally (see rubicon_cs.indices), instead of running one evalscript per index.
 
     Parameters:
         AOI (dict): Area of interest in GeoJSON format.
-        target_date (str): Target date in 'YYYY-MM-DD' format.
+        date_range (tuple): Tuple of (start_date, end_date) in 'YYYY-MM-DD' format.
+        veg_indices (list): Vegetation indices to compute, keys of `rubicon_cs.indices.INDEX_FORMULAS`.
         cloud_cover_limit (int): Max allowed cloud cover percentage.
-        rgb_evalscript (str): Evalscript key for RGB image generation.
+        multi_index (bool): If True, write a single GeoTIFF `{start}_{end}_{index1-index2...}.tif` whose bands
+            are ordered by date then index, with DATE and INDEX band tags. Otherwise write one
+            `{start}_{end}_{index}.tif` file per index, like `geotiff_for_veg_index`. Default is True.
+        tiled, max_workers, download_client, cache, compress: See `geotiff_for_veg_index`.
+        bands (list): Bands to request, a superset of the bands needed by `veg_indices`. Calls requesting the
+            same bands for the same AOI share their cached downloads. Default is only the needed bands.
+
+    Returns:
+        list: Paths of the written GeoTIFF files.
     """
+    veg_indices = list(veg_indices)
+    needed_bands = required_bands(veg_indices)
+    bands = sorted(bands) if bands else needed_bands
+    if not set(needed_bands) <= set(bands):
+        raise ValueError(f"Bands {bands} miss some of the bands needed by {veg_indices}: {needed_bands}")
+    plan = _plan_fetch(AOI, date_range, cloud_cover_limit, tiled, download_client, cache)
 
-    geometry = Geometry.from_geojson(AOI, crs=CRS.WGS84)
+    profile = dict(
+        height=plan.height, width=plan.width, dtype=np.float32,
+        crs=plan.crs, transform=plan.transform, nodata=np.nan, compress=compress
+    )
+    prefix = f"{output_dir}/{date_range[0]}_{date_range[1]}"
+    if multi_index:
+        filenames = [f"{prefix}_{'-'.join(veg_indices)}.tif"]
+        count = len(plan.dates) * len(veg_indices)
+    else:
+        filenames = [f"{prefix}_{veg_index}.tif" for veg_index in veg_indices]
+        count = len(plan.dates)
 
-    # Set up config
-    config = SHConfig()
-    config.sh_client_id = get_secret("SH_CLIENT_ID")
-    config.sh_client_id = get_secret("SH_CLIENT_SECRET")
+    with ExitStack() as stack:
+        datasets = [stack.enter_context(open_cog_writer(filename, count=count, **profile)) for filename in filenames]
 
-    # Catalog to find acquisition dates
-    catalog = SentinelHubCatalog(config=config)
-    search_iterator = catalog.search(
-                    DataCollection.SENTINEL2_L2A,
-                    geometry=geometry,
-                    time=target_date,
-                    filter=f'eo:cloud_cover < {cloud_cover_limit}',
-                    fields={"include": ["properties.datetime"], "exclude": []}
-                )
-    if list(search_iterator):
-        date = target_date
-    else:
-        date = find_nearest_available_date(
-            catalog=catalog,
-            data_collection=DataCollection.SENTINEL2_L2A,
-            geometry=geometry,
-            target_date=target_date,
-            max_days=30,
-            cloud_cover_limit=cloud_cover_limit  # Search ±30 days from target date
+        tile_data = _download_tiles(
+            build_bands_evalscript(bands), plan.dates, plan.tiles, MimeType.TIFF, plan.client, max_workers=max_workers
         )
+        for date_idx, window, band_stack in tile_data:
+            band_stack = band_stack.reshape(window.height, window.width, len(bands) + 1)
+            results = compute_indices(band_stack[..., :-1], bands, veg_indices, data_mask=band_stack[..., -1])
+            for k, veg_index in enumerate(veg_indices):
+                if multi_index:
+                    dst, band = datasets[0], date_idx * len(veg_indices) + k + 1
+                else:
+                    dst, band = datasets[k], date_idx + 1
+                with stage("write"):
+                    dst.write(results[veg_index], band, window=window)
 
-    print(f"Using nearest available date: {date}")
+        for date_idx, date in enumerate(plan.dates):
+            for k, veg_index in enumerate(veg_indices):
+                if multi_index:
+                    datasets[0].update_tags(date_idx * len(veg_indices) + k + 1, DATE=date, INDEX=veg_index)
+                else:
+                    datasets[k].update_tags(date_idx + 1, DATE=date)
 
-    width, height = get_scaled_dimensions(geometry)
-        
-    request = SentinelHubRequest(
-        evalscript=INDEX_DICT[rgb_evalscript],
-        input_data=[SentinelHubRequest.input_data(
-            data_collection=DataCollection.SENTINEL2_L2A,
-            time_interval=(date, date)
-        )],
-        responses=[SentinelHubRequest.output_response("default", MimeType.PNG)],
-        size=(width, height),
+    return filenames
+
+
+def store_key(AOI, cloud_cover_limit):
+    """
+    Name of the store of an AOI in `update_veg_index_store`.
+
+    The first 12 hex digits of the SHA-256 of the JSON list [AOI, cloud_cover_limit], with sorted keys. This
+    format is fixed on purpose, as changing it would orphan the existing stores: it must not follow the keys
+    of the response cache.
+    """
+    payload = json.dumps([AOI, cloud_cover_limit], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:12]
+
+
+def update_veg_index_store(AOI, veg_index='ndvi', end_date=None, start_date=None, cloud_cover_limit=20,
+                           store_dir='outputs/stores', tiled=False, max_workers=4, download_client=None, cache=True,
+                           compress='deflate'):
+    """
+    Incrementally update the vegetation index time series of an AOI, only downloading the new acquisition dates.
+
+    Each AOI and index has a single store `{store_dir}/{store_key}_{index}.tif` (see `store_key`), with one band
+    per date in date order and the acquisition date in the DATE tag of each band. The dates already held by the
+    store are read from these tags and only the catalog dates missing from them are fetched. The store is then
+    rewritten as a new Cloud-Optimized GeoTIFF with the existing bands copied block by block and the new ones
+    inserted in date order, and atomically replaces the old one.
+
+    Parameters:
+        AOI (dict): Area of interest in GeoJSON format.
+        veg_index (str): Vegetation index to use, default is 'ndvi'.
+        end_date (str): Last date of the update, 'YYYY-MM-DD'. Default is today.
+        start_date (str): First date of the update. Default is the first date of the store, so that
+            acquisitions published late by the catalog are picked up too. Required to create a new store.
+        cloud_cover_limit (int): Max allowed cloud cover percentage.
+        store_dir (str): Directory of the stores. Default is 'outputs/stores'.
+        tiled, max_workers, download_client, cache, compress: See `geotiff_for_veg_index`. `tiled` must
+            be the same for every update of a store.
+
+    Returns:
+        str: Path of the store.
+    """
+    path = f"{store_dir}/{store_key(AOI, cloud_cover_limit)}_{veg_index}.tif"
+    stored_dates = read_band_dates(path) if os.path.exists(path) else []
+    if start_date is None:
+        if not stored_dates:
+            raise ValueError(f"No store at {path} yet, a start_date is required to create it")
+        start_date = stored_dates[0]
+    end_date = end_date or datetime_date.today().isoformat()
+
+    plan = _plan_fetch(AOI, (str(start_date), str(end_date)), cloud_cover_limit, tiled, download_client, cache)
+    new_dates = [date for date in plan.dates if date not in set(stored_dates)]
+    count("store_new_dates", len(new_dates))
+    if not new_dates:
+        print(f"{path} is up to date ({len(stored_dates)} dates)")
+        return path
+
+    all_dates = sorted(set(stored_dates) | set(new_dates))
+    band_of_date = {date: band for band, date in enumerate(all_dates, start=1)}
+    os.makedirs(store_dir, exist_ok=True)
+    updated_path = f"{path}.update.tif"
+
+    with ExitStack() as stack:
+        src = stack.enter_context(rasterio.open(path)) if stored_dates else None
+        if src is not None and (
+            (src.width, src.height) != (plan.width, plan.height) or not src.transform.almost_equals(plan.transform)
+        ):
+            raise ValueError(f"The grid of {path} doesn't match the fetch grid, was it created with another `tiled`?")
+
+        dst = stack.enter_context(open_cog_writer(
+            updated_path,
+            height=plan.height,
+            width=plan.width,
+            count=len(all_dates),
+            dtype=np.float32,
+            crs=plan.crs,
+            transform=plan.transform,
+            nodata=np.nan if tiled else None,
+            compress=compress
+        ))
+
+        # Existing bands are copied as they are, block by block
+        for band, date in enumerate(stored_dates, start=1):
+            for _, window in src.block_windows(band):
+                dst.write(src.read(band, window=window), band_of_date[date], window=window)
+
+        tile_data = _download_tiles(
+            INDEX_DICT[veg_index], new_dates, plan.tiles, MimeType.TIFF, plan.client, max_workers=max_workers
+        )
+        for date_idx, window, index_img in tile_data:
+            band = index_img.reshape(window.height, window.width).astype(np.float32)
+            with stage("write"):
+                dst.write(band, band_of_date[new_dates[date_idx]], window=window)
+
+        for date, band in band_of_date.items():
+            dst.update_tags(band, DATE=date)
+
+    os.replace(updated_path, path)
+    print(f"Added {len(new_dates)} new dates to {path} ({len(all_dates)} dates)")
+    return path
+
+
+def zonal_stats_for_veg_indices(AOI, date_range, veg_indices=('ndvi',), zones=None, cloud_cover_limit=20,
+                                output_path=None, percentiles=DEFAULT_PERCENTILES, tiled=False, max_workers=4,
+                                download_client=None, cache=True):
+    """
+    Compute per-date zonal statistics of vegetation indices without writing any raster.
+
+    The zones are rasterized once on the fetch grid, then each date is reduced to per-zone statistics
+    (see rubicon_cs.zonal) as soon as it is downloaded.
+
+    Parameters:
+        AOI (dict): Area of interest in GeoJSON format, which defines the fetched scene.
+        date_range (tuple): Tuple of (start_date, end_date) in 'YYYY-MM-DD' format.
+        veg_indices (list): Vegetation indices, keys of `rubicon_cs.indices.INDEX_FORMULAS`.
+        zones (dict): Polygons inside the AOI, as {zone_id: GeoJSON geometry} or a GeoJSON FeatureCollection
+            (see `zones_from_geojson`), all reduced in a single pass. Default is the AOI polygon itself.
+        cloud_cover_limit (int): Max allowed cloud cover percentage.
+        output_path (str): Optional .csv or .parquet file the time series is written to.
+        percentiles (tuple): Percentiles to compute, 50 being the median. Default is (10, 25, 50, 75, 90).
+        tiled, max_workers, download_client, cache: See `geotiff_for_veg_index`.
+
+    Returns:
+        pandas.DataFrame: One row per date, zone and index with pixel counts, valid fraction, mean, std,
+            min, max and percentiles.
+    """
+    veg_indices = list(veg_indices)
+    bands = required_bands(veg_indices)
+    plan = _plan_fetch(AOI, date_range, cloud_cover_limit, tiled, download_client, cache)
+
+    if zones is None:
+        zones = {"aoi": AOI}
+    elif zones.get("type") in ("FeatureCollection", "Feature"):
+        zones = zones_from_geojson(zones)
+    labels = rasterize_zones(zones, plan.transform, plan.width, plan.height)
+    time_series = ZonalTimeSeries(labels, zones.keys(), percentiles)
+
+    tile_data = _download_tiles(
+        build_bands_evalscript(bands), plan.dates, plan.tiles, MimeType.TIFF, plan.client, max_workers=max_workers,
+        ordered=True
+    )
+    for date_idx, window, band_stack in tile_data:
+        band_stack = band_stack.reshape(window.height, window.width, len(bands) + 1)
+        results = compute_indices(band_stack[..., :-1], bands, veg_indices, data_mask=band_stack[..., -1])
+        time_series.add(plan.dates[date_idx], window, results)
+
+    frame = time_series.to_frame()
+    if output_path is not None:
+        write_time_series(frame, output_path)
+    return frame
+
+
+def fetch_scene(AOI, target_date, evalscript='rgb_optimized', bands=None, sample_type='FLOAT32', cloud_cover_limit=20,
+                max_days=30, tiled=False, max_workers=4, download_client=None, cache=True, mime_type=MimeType.TIFF):
+    """
+    Fetch the image of a specific date, or the nearest available one, as an in-memory array.
+
+    Nothing is written to disk: the decoded response is returned as is (a single request) or pasted into
+    a preallocated mosaic (tiled), keeping the dtype of the response. Use
+    `rubicon_cs.segmentation.to_model_input` to turn it into a model input tensor without extra copies.
+
+    Parameters:
+        AOI (dict): Area of interest in GeoJSON format.
+        target_date (str): Target date in 'YYYY-MM-DD' format.
+        evalscript (str): Evalscript key of INDEX_DICT (e.g. 'rgb_optimized', whose 4th band is dataMask) or an
+            evalscript. Ignored if `bands` is given. Default is 'rgb_optimized'.
+        bands (list): Sentinel-2 bands to fetch instead, e.g. ['B02', 'B03', 'B04', 'B08'], followed by dataMask.
+        sample_type (str): Sample type of `bands`, 'FLOAT32' for reflectances or 'UINT16' for digital numbers
+            (reflectance * 10000). Default is 'FLOAT32'.
+        cloud_cover_limit (int): Max allowed cloud cover percentage.
+        max_days (int): Search ±`max_days` around the target date. Default is 30.
+        tiled, max_workers, download_client, cache: See `geotiff_for_veg_index`.
+        mime_type (MimeType): Response format. TIFF keeps any sample type, PNG is smaller for UINT8 images.
+            Default is TIFF.
+
+    Returns:
+        Scene: (date, image, transform, crs) with `image` a (H, W, C) array, `date` the acquisition date used.
+    """
+    geometry = Geometry.from_geojson(AOI, crs=CRS.WGS84)
+
+    # The long-lived client brings its config, connections and OAuth token
+    cache = resolve_cache(cache)
+    download_client = download_client or get_default_client(cache)
+
+    # Catalog to find acquisition dates, the target date itself is returned if it has an acquisition
+    date = find_nearest_available_date(
+        catalog=download_client.catalog,
+        data_collection=DataCollection.SENTINEL2_L2A,
         geometry=geometry,
-        config=config,
+        target_date=target_date,
+        max_days=max_days,
+        cloud_cover_limit=cloud_cover_limit,
+        cache=cache
+    )
+    print(f"Using nearest available date: {date}")
+
+    if bands is not None:
+        evalscript = build_bands_evalscript(bands, sample_type)
+    else:
+        evalscript = INDEX_DICT.get(evalscript, evalscript)
+    width, height, tiles = _get_tiles(geometry, tiled)
+
+    tile_data = _download_tiles(
+        evalscript, [date], tiles, mime_type, download_client, geometry=geometry, max_workers=max_workers
+    )
+    image = None
+    for _, window, tile in tile_data:
+        if tile.ndim == 2:
+            tile = tile[..., np.newaxis]
+        if len(tiles) == 1 and tile.shape[:2] == (height, width):
+            image = tile  # The decoded response is the image, no copy
+            continue
+        if image is None:
+            # Tiles are pasted into a preallocated mosaic as soon as they are downloaded
+            image = np.zeros((height, width, tile.shape[2]), dtype=tile.dtype)
+        image[window.toslices()] = tile
+
+    transform = rasterio.transform.from_bounds(*geometry.bbox, width, height)
+    return Scene(date, image, transform, geometry.crs.pyproj_crs())
+
+
+def png_for_target_date(AOI, target_date, cloud_cover_limit=20, rgb_evalscript='rgb_optimized', tiled=False, max_workers=4,
+                        download_client=None, cache=True):
+    """
+    Generate and save an RGB image as PNG for a specific date or the nearest available one.
+
+    Parameters:
+        AOI (dict): Area of interest in GeoJSON format.
+        target_date (str): Target date in 'YYYY-MM-DD' format.
+        cloud_cover_limit (int): Max allowed cloud cover percentage.
+        rgb_evalscript (str): Evalscript key for RGB image generation.
+        tiled (bool): If True, fetch the AOI at native 10 m resolution as a mosaic of tiles instead of
+            downscaling it to the Sentinel Hub 2500x2500 px limit. Default is False.
+        max_workers (int): Number of tiles downloaded concurrently in tiled mode. Default is 4.
+        download_client (RateLimitedDownloadClient): Client used for the catalog search and the downloads.
+            Default is the process-wide client of `get_default_client`.
+        cache (bool or ResponseCache): Cache used for catalog results and downloaded scenes. True uses the
+            default on-disk cache, False disables caching. Default is True.
+
+    Notes:
+        - To feed a model, `fetch_scene` returns the same image in memory without the PNG round trip.
+    """
+    scene = fetch_scene(
+        AOI, target_date, evalscript=rgb_evalscript, cloud_cover_limit=cloud_cover_limit, tiled=tiled,
+        max_workers=max_workers, download_client=download_client, cache=cache, mime_type=MimeType.PNG
     )
+    date = scene.date
+    img = scene.image.astype(np.uint8, copy=False)
+    if img.shape[2] == 1:
+        img = img[..., 0]
 
-    img = request.get_data()[0].astype(np.uint8)
-    
     # Save the image as a PNG
-    Image.fromarray(img).save(f'rgb_{date}.png')
+    with stage("write"):
+        Image.fromarray(img).save(f'rgb_{date}.png')
     print(f"Saved RGB image for {date} to rgb_{date}.png")
     return date
 
-# --- Full Inference Function ---
-def semantic_segmentation_large_image(image, model, device, patch_size=512):
-    """
-    image: torch tensor of shape (C, H, W)
-    model: segmentation model that takes input of shape (B, C, patch_size, patch_size)
-    """
-    model.eval()
-    image = image.to(device)
-    
-    # 1. Pad
-    padded_image, pad_h, pad_w = pad_to_multiple(image, patch_size)
-    
-    # 2. Extract patches
-    patches = extract_patches(padded_image, patch_size)
-
-    # 3. Predict each patch
-    predicted_patches = []
-    for (i, j), patch in patches:
-        patch = patch.unsqueeze(0).to(device)  # (1, C, H, W)
-        with torch.no_grad():
-            pred = model(patch)[0]  # (1, num_classes, H, W)
-        predicted_patches.append(((i, j), pred.squeeze().cpu()))
-    
-    # 4. Stitch prediction
-    _, H_padded, W_padded = padded_image.shape
-    stitched = stitch_patches(predicted_patches, (pred.shape[1], H_padded, W_padded), patch_size)
-
-    # 5. Remove padding
-    if pad_h > 0:
-        stitched = stitched[:, :-pad_h, :]
-    if pad_w > 0:
-        stitched = stitched[:, :, :-pad_w]
-
-    return stitched  # (num_classes, H_original, W_original)
-
-def get_secret(secret_name):
-    # Vérifier si l'application tourne sur Streamlit Cloud
-    try:
-        return st.secrets[secret_name]
-    except:
-        # Sinon, essayer de récupérer depuis os.environ (local ou autre environnement)
-        return os.environ[secret_name]
\ No newline at end of file
+FetchPlan = namedtuple("FetchPlan", ["geometry", "dates", "width", "height", "tiles", "transform", "crs", "client"])
+Scene = namedtuple("Scene", ["date", "image", "transform", "crs"])
+
+
+def _plan_fetch(AOI, date_range, cloud_cover_limit, tiled, download_client, cache):
+    """Resolve the AOI, acquisition dates, output grid and download client of a vegetation index time series."""
+    geometry = Geometry.from_geojson(AOI, crs=CRS.WGS84)
+
+    # The long-lived client brings its config, connections and OAuth token
+    cache = resolve_cache(cache)
+    download_client = download_client or get_default_client(cache)
+
+    # Catalog to find acquisition dates
+    catalog = download_client.catalog
+    acquisition_dates = get_acquisition_dates(catalog, geometry, date_range, cloud_cover_limit, cache=cache)
+    if not acquisition_dates:
+        raise ValueError("No acquisition dates found within specified date range and cloud cover limit.")
+
+    width, height, tiles = _get_tiles(geometry, tiled)
+
+    bounds = geometry.bbox
+    print(f"Bounding Box: {bounds}")
+    transform = rasterio.transform.from_bounds(*bounds, width, height)
+    crs = geometry.crs.pyproj_crs()
+
+    return FetchPlan(geometry, acquisition_dates, width, height, tiles, transform, crs, download_client)
+
+
+def _get_tiles(geometry, tiled):
+    """Return the output size and the (window, bbox) tiles to request for the AOI."""
+    if tiled:
+        return get_tile_grid(geometry)
+    width, height = get_scaled_dimensions(geometry)
+    return width, height, [(Window(0, 0, width, height), geometry.bbox)]
+
+
+def _download_tiles(evalscript, dates, tiles, mime_type, client, geometry=None, max_workers=4, ordered=False):
+    """
+    Download every tile of every acquisition date concurrently through a single download client.
+
+    Yields (date_index, window, array) as soon as each response is downloaded, so callers can write it out
+    while the other requests are in flight. With `ordered=True`, they are yielded in date order, then tile order.
+    """
+    jobs = [(date_idx, window, bbox) for date_idx in range(len(dates)) for window, bbox in tiles]
+    download_list = []
+    for date_idx, window, bbox in jobs:
+        request = SentinelHubRequest(
+            evalscript=evalscript,
+            input_data=[SentinelHubRequest.input_data(
+                data_collection=DataCollection.SENTINEL2_L2A,
+                time_interval=(dates[date_idx], dates[date_idx])
+            )],
+            responses=[SentinelHubRequest.output_response("default", mime_type)],
+            bbox=bbox,
+            geometry=geometry,
+            size=(window.width, window.height),
+            config=client.config,
+        )
+        download_list.extend(request.download_list)
+
+    for job_idx, array in iter_downloads(download_list, client, max_workers=max_workers, ordered=ordered):
+        date_idx, window, _ = jobs[job_idx]
+        yield date_idx, window, array
+
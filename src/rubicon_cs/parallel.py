@@ -0,0 +1,123 @@
+"""
+Multi-process CPU inference for large scenes and many scenes.
+
+A single `semantic_segmentation_large_image` call only uses PyTorch's intra-op thread pool, whose
+scaling flattens well before all cores of a CPU box are busy. `InferencePool` runs several worker
+processes with a few intra-op threads each. The model weights are moved to shared memory once in the
+parent, so every worker maps the same weights instead of loading its own copy.
+"""
+import os
+from collections import deque
+
+import torch
+import torch.multiprocessing as mp
+
+from rubicon_cs.segmentation import semantic_segmentation_large_image
+
+_worker_model = None
+
+
+def _init_worker(model, threads_per_worker):
+    """Pool initializer: set the thread split and keep the shared model for the tasks of this worker."""
+    global _worker_model
+    torch.set_num_threads(threads_per_worker)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once per process, e.g. not again in a forked worker
+        pass
+    _worker_model = model.eval()
+
+
+def _predict_batch(args):
+    batch, use_bf16 = args
+    with torch.inference_mode(), torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=use_bf16):
+        return _worker_model(batch)[0].float()
+
+
+def _segment_scene(args):
+    image, kwargs = args
+    return semantic_segmentation_large_image(image, _worker_model, torch.device("cpu"), **kwargs)
+
+
+class InferencePool:
+    """
+    Pool of CPU worker processes sharing one segmentation model.
+
+    Parameters:
+        model: Segmentation model, see `semantic_segmentation_large_image`. Its parameters are moved to shared memory.
+        num_workers (int): Number of worker processes. Default is the number of CPUs.
+        threads_per_worker (int): Intra-op threads of each worker. Default splits the CPUs evenly between workers.
+        max_pending (int): Maximum number of tasks queued ahead of the results being consumed, which bounds
+            the memory held by in-flight patches. Default is 2 per worker.
+        start_method (str): Multiprocessing start method. Default is 'spawn', which is safe with PyTorch's threads.
+
+    Example:
+        with InferencePool(model, num_workers=8) as pool:
+            class_map = pool.segment_large_image(image_tensor, output='class_map')
+            class_maps = pool.map_scenes(images, output='class_map')
+    """
+
+    def __init__(self, model, num_workers=None, threads_per_worker=None, max_pending=None, start_method="spawn"):
+        cpu_count = os.cpu_count() or 1
+        self.num_workers = num_workers or cpu_count
+        self.threads_per_worker = threads_per_worker or max(1, cpu_count // self.num_workers)
+        self.max_pending = max_pending or 2 * self.num_workers
+
+        model.share_memory()
+        context = mp.get_context(start_method)
+        self._pool = context.Pool(
+            self.num_workers, initializer=_init_worker, initargs=(model, self.threads_per_worker)
+        )
+
+    def _ordered_map(self, func, items):
+        """Like Pool.imap, but with at most `max_pending` tasks submitted ahead of the consumer."""
+        pending = deque()
+        for item in items:
+            pending.append(self._pool.apply_async(func, (item,)))
+            if len(pending) >= self.max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def predict_batches(self, batches, use_bf16=False):
+        """Spread (positions, batch) pairs over the workers and yield (positions, logits) pairs in order."""
+        positions_queue = deque()
+
+        def tasks():
+            for positions, batch in batches:
+                positions_queue.append(positions)
+                yield batch.cpu(), use_bf16
+
+        for pred in self._ordered_map(_predict_batch, tasks()):
+            yield positions_queue.popleft(), pred
+
+    def segment_large_image(self, image, use_bf16=False, **kwargs):
+        """
+        Segment one large scene with its patch batches spread over the workers.
+
+        Accepts the keyword arguments of `semantic_segmentation_large_image` and returns the same output.
+        """
+        return semantic_segmentation_large_image(
+            image, None, torch.device("cpu"), use_bf16=use_bf16,
+            predictor=lambda batches: self.predict_batches(batches, use_bf16=use_bf16), **kwargs
+        )
+
+    def map_scenes(self, images, **kwargs):
+        """
+        Segment many scenes, one scene per worker task, and return the results in the order of `images`.
+
+        Accepts the keyword arguments of `semantic_segmentation_large_image`, except `out_path`.
+        """
+        return list(self._ordered_map(_segment_scene, ((image, kwargs) for image in images)))
+
+    def close(self):
+        """Stop the worker processes."""
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
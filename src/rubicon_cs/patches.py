@@ -0,0 +1,236 @@
+"""
+Patch helpers of the segmentation pipeline: padding, patch extraction, batching and stitching.
+
+The following functions are used to cut an image in 512x512 tiles to feed the model. They need torch,
+which is why they live apart from the fetch helpers of `rubicon_cs.utils` (which still re-exports them).
+"""
+import math
+import queue
+import threading
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# --- Padding ---
+def padded_size(size, patch_size=512, stride=None):
+    """Smallest size >= `size` covered exactly by patches of `patch_size` taken every `stride` pixels."""
+    stride = stride or patch_size
+    return patch_size + max(0, math.ceil((size - patch_size) / stride)) * stride
+
+def pad_to_multiple(image, multiple=512, stride=None):
+    """
+    Pad the image (C, H, W) to the next multiple of `multiple`.
+
+    With a `stride` smaller than `multiple` (overlapping patches), pad to the next size covered
+    by patches of size `multiple` taken every `stride` pixels instead.
+    """
+    _, h, w = image.shape
+    pad_h = padded_size(h, multiple, stride) - h
+    pad_w = padded_size(w, multiple, stride) - w
+    return F.pad(image, (0, pad_w, 0, pad_h)), pad_h, pad_w  # (left, right, top, bottom)
+
+# --- Patch Extraction ---
+def extract_patches(image, patch_size=512, stride=None):
+    """Extract patches from image (C, H, W) in raster order, non-overlapping unless `stride` < `patch_size`."""
+    _, h, w = image.shape
+    stride = stride or patch_size
+    patches = []
+    for i in range(0, h - patch_size + 1, stride):
+        for j in range(0, w - patch_size + 1, stride):
+            patch = image[:, i:i+patch_size, j:j+patch_size]
+            patches.append(((i, j), patch))
+    return patches
+
+# --- Nodata Patches ---
+def find_valid_patches(valid_mask, patch_size=512, stride=None):
+    """
+    Flag which patches of `extract_patches` contain at least one valid pixel.
+
+    valid_mask is the (H, W) bool mask of the unpadded image, padding counts as invalid. Returns a 1D bool
+    tensor in the raster order of `extract_patches`, computed with a single max pooling over the mask.
+    """
+    stride = stride or patch_size
+    h, w = valid_mask.shape
+    mask = F.pad(valid_mask[None, None].float(), (0, padded_size(w, patch_size, stride) - w,
+                                                  0, padded_size(h, patch_size, stride) - h))
+    return (F.max_pool2d(mask, patch_size, stride) > 0).flatten()
+
+# --- Batch Iterator ---
+def iter_patch_batches(patches, batch_size=8, device=None, channels_last=False, prefetch=2):
+    """
+    Group patches from `extract_patches` into (positions, batch) pairs with batch of shape (B, C, H, W).
+
+    Batches are stacked (and moved to `device`) by a background thread up to `prefetch` batches ahead,
+    so the model doesn't wait for the copies. Use prefetch=0 to build them in the calling thread.
+    """
+    def build_batches():
+        for start in range(0, len(patches), batch_size):
+            chunk = patches[start:start + batch_size]
+            batch = torch.stack([patch for _, patch in chunk])
+            if device is not None:
+                batch = batch.to(device, non_blocking=True)
+            if channels_last:
+                batch = batch.contiguous(memory_format=torch.channels_last)
+            yield [position for position, _ in chunk], batch
+
+    if prefetch <= 0:
+        yield from build_batches()
+        return
+
+    batch_queue = queue.Queue(maxsize=prefetch)
+    done = object()
+
+    def producer():
+        try:
+            for item in build_batches():
+                batch_queue.put(item)
+        except BaseException as exception:
+            batch_queue.put(exception)
+            return
+        batch_queue.put(done)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item = batch_queue.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+# --- Stitch Patches Back ---
+def stitch_patches(patches, original_shape, patch_size=512):
+    """Reconstruct the full mask from patch predictions."""
+    C, H, W = original_shape
+    output = torch.zeros((C, H, W))
+    for (i, j), patch in patches:
+        output[:, i:i+patch_size, j:j+patch_size] = patch
+    return output
+
+
+class ClassMapStitcher:
+    """
+    Stitch patch predictions into a uint8 class map as soon as each patch is predicted.
+
+    Each patch is reduced to its argmax (and optionally its max probability) right away, so memory depends
+    on the patch size instead of holding `(num_classes, H, W)` float logits for the whole scene.
+
+    Parameters:
+        shape (tuple): (H, W) of the output class map. Patches may extend past it (padding), the excess is dropped.
+        patch_size (int): Size of the square patches. Default is 512.
+        overlap (int): Number of pixels shared by neighbouring patches. Default is 0.
+        out_path (str): If given, the class map is a memory-mapped .npy file at this path instead of an in-memory array.
+        with_confidence (bool): Also keep the max probability of each pixel, stored as uint8 (probability * 255).
+
+    Notes:
+        - Patches must be added in the raster order of `extract_patches(..., stride=patch_size - overlap)`.
+        - With overlap, class probabilities of neighbouring patches are blended with linear ramps that sum to 1.
+          Blending is only done on the overlap strips: one (num_classes, overlap, W) buffer per patch row
+          boundary and one (num_classes, patch_size, overlap) buffer per column boundary.
+    """
+
+    def __init__(self, shape, patch_size=512, overlap=0, out_path=None, with_confidence=False):
+        if not 0 <= overlap < patch_size:
+            raise ValueError(f"overlap must be in [0, {patch_size}), got {overlap}")
+        self.height, self.width = shape
+        self.patch_size = patch_size
+        self.overlap = overlap
+        self.padded_width = padded_size(self.width, patch_size, patch_size - overlap)
+
+        if out_path is not None:
+            self.class_map = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.uint8, shape=shape)
+        else:
+            self.class_map = np.zeros(shape, dtype=np.uint8)
+        self.confidence = np.zeros(shape, dtype=np.uint8) if with_confidence else None
+
+        # Overlap ramps: a patch's weight goes from 0 to 1 over the overlap shared with its predecessor
+        self._ramp = (np.arange(overlap, dtype=np.float32) + 0.5) / max(overlap, 1)
+        self._row_strip = None  # strip shared with the previous patch row
+        self._next_row_strip = None  # strip shared with the next patch row
+        self._col_strip = None  # strip shared with the previous patch of the row
+
+    def _write(self, row, col, probabilities=None, logits=None):
+        """Write the argmax (and confidence) of a (C, h, w) block at (row, col), clipped to the output shape."""
+        values = probabilities if probabilities is not None else logits
+        h = min(values.shape[1], self.height - row)
+        w = min(values.shape[2], self.width - col)
+        if h <= 0 or w <= 0:
+            return
+        values = values[:, :h, :w]
+        self.class_map[row:row + h, col:col + w] = values.argmax(axis=0)
+        if self.confidence is not None and probabilities is not None:
+            self.confidence[row:row + h, col:col + w] = (probabilities[:, :h, :w].max(axis=0) * 255).astype(np.uint8)
+
+    def add(self, i, j, logits):
+        """Add the (num_classes, patch_size, patch_size) logits of the patch whose top-left corner is (i, j)."""
+        if isinstance(logits, torch.Tensor):
+            logits = logits.detach().float().cpu().numpy()
+
+        P, o = self.patch_size, self.overlap
+        if o == 0:
+            if self.confidence is None:
+                self._write(i, j, logits=logits)
+            else:
+                self._write(i, j, probabilities=_softmax(logits))
+            return
+
+        num_classes = logits.shape[0]
+        if j == 0:
+            self._next_row_strip = np.zeros((num_classes, o, self.padded_width), dtype=np.float32)
+            if self._row_strip is None:
+                self._row_strip = np.zeros_like(self._next_row_strip)
+
+        top = o if i > 0 else 0
+        bottom = o if i + P < self.height else 0
+        left = o if j > 0 else 0
+        right = o if j + P < self.width else 0
+
+        # Separable weights summing to 1 over the patches covering each pixel
+        weight_y = np.ones(P, dtype=np.float32)
+        weight_x = np.ones(P, dtype=np.float32)
+        if top:
+            weight_y[:o] = self._ramp
+        if bottom:
+            weight_y[P - o:] = 1 - self._ramp
+        if left:
+            weight_x[:o] = self._ramp
+        if right:
+            weight_x[P - o:] = 1 - self._ramp
+
+        probabilities = _softmax(logits)
+
+        # Top and bottom strips (full patch width, corners included) go to the row strip buffers
+        if top:
+            self._row_strip[:, :, j:j + P] += probabilities[:, :o] * weight_y[:o, None] * weight_x
+        if bottom:
+            self._next_row_strip[:, :, j:j + P] += probabilities[:, P - o:] * weight_y[P - o:, None] * weight_x
+
+        # Middle rows: left strip is completed with the previous patch, the centre is exclusive to this patch
+        middle = probabilities[:, top:P - bottom]
+        if left:
+            self._col_strip += middle[:, :, :o] * weight_x[:o]
+            self._write(i + top, j, probabilities=self._col_strip)
+        self._write(i + top, j + left, probabilities=middle[:, :, left:P - right])
+        if right:
+            self._col_strip = middle[:, :, P - o:] * weight_x[P - o:]
+
+        # Last patch of the row: the strip shared with the previous row is now complete
+        if j + P >= self.width:
+            if top:
+                self._write(i, 0, probabilities=self._row_strip)
+            self._row_strip, self._next_row_strip = self._next_row_strip, None
+
+    def result(self):
+        """Return the class map, or (class map, confidence) if with_confidence was set."""
+        if isinstance(self.class_map, np.memmap):
+            self.class_map.flush()
+        if self.confidence is None:
+            return self.class_map
+        return self.class_map, self.confidence
+
+
+def _softmax(logits):
+    """Softmax over the first (class) axis of a NumPy array."""
+    exp = np.exp(logits - logits.max(axis=0, keepdims=True))
+    return exp / exp.sum(axis=0, keepdims=True)
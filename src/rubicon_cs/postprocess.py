@@ -0,0 +1,268 @@
+"""
+Post-processing of segmentation class maps (class remapping, colorization, per-class area statistics) and
+rendering of vegetation index bands.
+
+Remapping and colorization are lookup tables indexed by the class map, so each is a single pass over the
+image whatever the number of classes. Statistics are a single `np.bincount`. Every function accepts
+`chunk_rows` to process memory-mapped class maps (e.g. from `ClassMapStitcher(out_path=...)`) by row chunks.
+"""
+import numpy as np
+import rasterio
+
+# Satlas land cover classes, see section two
+SATLAS_LABELS = [
+    "background", "water", "developed", "tree", "shrub", "grass",
+    "crop", "bare", "snow", "wetland", "mangroves", "moss",
+]
+SATLAS_COLORMAP = np.array([
+    [0, 0, 0],          # 0: background
+    [0, 0, 255],        # 1: water
+    [255, 0, 0],        # 2: developed
+    [0, 192, 0],        # 3: tree
+    [200, 170, 120],    # 4: shrub
+    [0, 255, 0],        # 5: grass
+    [255, 255, 0],      # 6: crop
+    [128, 128, 128],    # 7: bare
+    [255, 255, 255],    # 8: snow
+    [0, 255, 255],      # 9: wetland
+    [255, 0, 255],      # 10: mangroves
+    [128, 0, 128],      # 11: moss
+], dtype=np.uint8)
+
+SIMPLIFIED_LABELS = ["Other", "Water", "Vegetation", "Buildings"]
+SIMPLIFIED_COLORMAP = np.array([
+    [0, 0, 0],          # Other
+    [0, 0, 255],        # Water
+    [0, 192, 0],        # Vegetation
+    [255, 0, 0],        # Buildings
+], dtype=np.uint8)
+# Satlas class -> simplified class: water, then tree, shrub, grass, crop, wetland, mangroves and moss, then developed
+SIMPLIFIED_MAPPING = {1: 1, 3: 2, 4: 2, 5: 2, 6: 2, 9: 2, 10: 2, 11: 2, 2: 3}
+
+
+def make_lut(mapping, size=256, default=0, dtype=np.uint8):
+    """Build a lookup table of `size` entries from a {class: new class} dict, other classes map to `default`."""
+    lut = np.full(size, default, dtype=dtype)
+    for source, target in mapping.items():
+        lut[source] = target
+    return lut
+
+
+SIMPLIFIED_LUT = make_lut(SIMPLIFIED_MAPPING)
+
+
+def _full_lut(lut, class_map):
+    """Pad a LUT so that every value of the class map's dtype is a valid index."""
+    lut = np.asarray(lut)
+    if class_map.dtype.kind not in "ui":
+        raise ValueError(f"Class map must be an integer array, got {class_map.dtype}")
+    size = 256 if class_map.dtype.itemsize == 1 else int(class_map.max()) + 1
+    if len(lut) >= size:
+        return lut
+    padded = np.zeros((size,) + lut.shape[1:], dtype=lut.dtype)
+    padded[:len(lut)] = lut
+    return padded
+
+
+def _apply_lut(class_map, lut, out=None, chunk_rows=None):
+    lut = _full_lut(lut, class_map)
+    if out is None:
+        out = np.empty(class_map.shape + lut.shape[1:], dtype=lut.dtype)
+    step = chunk_rows or class_map.shape[0]
+    for row in range(0, class_map.shape[0], step):
+        np.take(lut, class_map[row:row + step], axis=0, out=out[row:row + step])
+    return out
+
+
+def remap_classes(class_map, lut=SIMPLIFIED_LUT, out=None, chunk_rows=None):
+    """
+    Map every class of a class map to a new class in one pass, e.g. the 12 Satlas classes to the simplified ones.
+
+    Parameters:
+        class_map (np.ndarray): (H, W) integer class map, possibly memory-mapped.
+        lut (np.ndarray): Lookup table, new class of each class. Default is `SIMPLIFIED_LUT`.
+        out (np.ndarray): Optional (H, W) output array, e.g. a memmap.
+        chunk_rows (int): Number of rows processed at once. Default processes the whole map at once.
+    """
+    return _apply_lut(class_map, lut, out=out, chunk_rows=chunk_rows)
+
+
+def colorize(class_map, colormap=SATLAS_COLORMAP, remap=None, out=None, chunk_rows=None):
+    """
+    Convert a class map to an RGB image in one pass.
+
+    Parameters:
+        class_map (np.ndarray): (H, W) integer class map, possibly memory-mapped.
+        colormap (np.ndarray): (n_classes, 3) uint8 colors. Default is `SATLAS_COLORMAP`.
+        remap (np.ndarray): Optional class lookup table applied before the colormap, e.g. `SIMPLIFIED_LUT` with
+            `SIMPLIFIED_COLORMAP`. Both are combined in a single table, so the image is still read once.
+        out (np.ndarray): Optional (H, W, 3) uint8 output array.
+        chunk_rows (int): Number of rows processed at once. Default processes the whole map at once.
+
+    Returns:
+        np.ndarray: (H, W, 3) uint8 RGB image.
+    """
+    colormap = np.asarray(colormap, dtype=np.uint8)
+    if remap is not None:
+        colormap = _full_lut(colormap, np.asarray(remap))[np.asarray(remap)]
+    return _apply_lut(class_map, colormap, out=out, chunk_rows=chunk_rows)
+
+
+def pixel_area_hectares(transform, crs, height):
+    """
+    Area in hectares of the pixels of each row of a raster.
+
+    Parameters:
+        transform (affine.Affine): Raster transform.
+        crs: CRS of the raster (rasterio CRS or anything `CRS.from_user_input` accepts). Required, so that
+            pixel sizes in degrees are never taken for metres.
+        height (int): Number of rows of the raster.
+
+    Returns:
+        np.ndarray: (height,) float64 areas. In a projected CRS every row has the same area, in its linear
+        units converted to metres. In a geographic CRS, such as the EPSG:4326 rasters of the fetch functions,
+        each row gets the geodesic area of its pixels on the CRS ellipsoid (the transform must be north-up).
+    """
+    if crs is None:
+        raise ValueError("A CRS is required to compute pixel areas")
+    crs = rasterio.crs.CRS.from_user_input(crs)
+    if not crs.is_geographic:
+        metres_per_unit = crs.linear_units_factor[1]
+        area = abs(transform.a * transform.e - transform.b * transform.d) * metres_per_unit ** 2 / 10_000
+        return np.full(height, area)
+
+    if transform.b or transform.d:
+        raise ValueError("Pixel areas in a geographic CRS require a north-up transform")
+    import pyproj
+
+    geod = pyproj.CRS.from_wkt(crs.to_wkt()).get_geod()
+    west, east = transform.c, transform.c + transform.a
+    areas = np.empty(height)
+    for row in range(height):
+        top = transform.f + row * transform.e
+        bottom = top + transform.e
+        area, _ = geod.polygon_area_perimeter([west, east, east, west], [top, top, bottom, bottom])
+        areas[row] = abs(area) / 10_000
+    return areas
+
+
+def class_counts(class_map, num_classes, nodata=None, chunk_rows=1024):
+    """Number of pixels of each class, ignoring the `nodata` value, with one `np.bincount` per chunk of rows."""
+    counts = np.zeros(num_classes, dtype=np.int64)
+    step = chunk_rows or class_map.shape[0]
+    for row in range(0, class_map.shape[0], step):
+        counts += np.bincount(np.asarray(class_map[row:row + step]).ravel(), minlength=num_classes)[:num_classes]
+    if nodata is not None and 0 <= nodata < num_classes:
+        counts[nodata] = 0
+    return counts
+
+
+def class_areas(class_map, row_areas, num_classes, nodata=None, chunk_rows=1024):
+    """
+    Area of each class, summing the area of the row of each pixel.
+
+    Each chunk of rows is counted with a single `np.bincount` over (row, class) pairs, then weighted by `row_areas`.
+    """
+    areas = np.zeros(num_classes)
+    step = chunk_rows or class_map.shape[0]
+    for row in range(0, class_map.shape[0], step):
+        block = np.minimum(np.asarray(class_map[row:row + step]), num_classes).astype(np.int64)
+        rows = block.shape[0]
+        keys = block + (num_classes + 1) * np.arange(rows)[:, np.newaxis]  # values >= num_classes are dropped
+        counts = np.bincount(keys.ravel(), minlength=rows * (num_classes + 1)).reshape(rows, num_classes + 1)
+        areas += row_areas[row:row + rows] @ counts[:, :num_classes]
+    if nodata is not None and 0 <= nodata < num_classes:
+        areas[nodata] = 0
+    return areas
+
+
+def class_statistics(class_map, transform=None, labels=SATLAS_LABELS, crs=None, nodata=None, chunk_rows=1024):
+    """
+    Per-class pixel counts, areas and fractions of a class map.
+
+    Parameters:
+        class_map (np.ndarray): (H, W) integer class map, possibly memory-mapped.
+        transform (affine.Affine): Raster transform, needed for the areas in hectares.
+        labels (list): Name of each class. Default is `SATLAS_LABELS`, use `SIMPLIFIED_LABELS` for remapped maps.
+        crs: CRS of the raster, required with `transform`. Geographic CRSs get geodesic areas, see
+            `pixel_area_hectares`.
+        nodata (int): Optional class value excluded from the statistics.
+        chunk_rows (int): Number of rows counted at once, which keeps the temporaries in cache. Default is 1024.
+
+    Returns:
+        dict: Mapping of label to {'pixels', 'fraction', 'hectares'}, hectares being None without a transform.
+    """
+    counts = class_counts(class_map, len(labels), nodata=nodata, chunk_rows=chunk_rows)
+    hectares = None
+    if transform is not None:
+        row_areas = pixel_area_hectares(transform, crs, class_map.shape[0])
+        hectares = class_areas(class_map, row_areas, len(labels), nodata=nodata, chunk_rows=chunk_rows)
+    return _statistics(counts, labels, hectares)
+
+
+def class_statistics_for_geotiff(path, labels=SATLAS_LABELS, remap=None, band=1):
+    """
+    Per-class statistics of a class map GeoTIFF, e.g. from `segment_geotiff`, read block by block.
+
+    Parameters:
+        path (str): Class map GeoTIFF.
+        labels (list): Name of each class. Default is `SATLAS_LABELS`.
+        remap (np.ndarray): Optional class lookup table applied before counting, e.g. `SIMPLIFIED_LUT`.
+        band (int): Band to read. Default is 1.
+    """
+    counts = np.zeros(len(labels), dtype=np.int64)
+    hectares = np.zeros(len(labels))
+    with rasterio.open(path) as src:
+        row_areas = pixel_area_hectares(src.transform, src.crs, src.height)
+        for _, window in src.block_windows(band):
+            block = src.read(band, window=window)
+            if remap is not None:
+                if src.nodata is not None:
+                    # Keep nodata pixels out of the remapped classes
+                    block = np.where(block == src.nodata, len(labels), remap_classes(block, remap))
+                else:
+                    block = remap_classes(block, remap)
+            nodata = int(src.nodata) if remap is None and src.nodata is not None else None
+            counts += class_counts(block, len(labels), nodata=nodata)
+            block_row_areas = row_areas[window.row_off:window.row_off + window.height]
+            hectares += class_areas(block, block_row_areas, len(labels), nodata=nodata)
+    return _statistics(counts, labels, hectares)
+
+
+def _statistics(counts, labels, hectares=None):
+    total = counts.sum()
+    return {
+        label: {
+            'pixels': int(count),
+            'fraction': float(count / total) if total else 0.0,
+            'hectares': float(hectares[k]) if hectares is not None else None,
+        }
+        for k, (label, count) in enumerate(zip(labels, counts))
+    }
+
+
+def colormap_lut(cmap='Greens', size=256):
+    """Sample a matplotlib colormap once into a (size, 3) uint8 lookup table, e.g. to render previews without figures."""
+    from matplotlib import colormaps
+
+    return (colormaps[cmap](np.linspace(0, 1, size))[:, :3] * 255).round().astype(np.uint8)
+
+
+def colorize_values(values, lut, vmin=-1.0, vmax=1.0, nodata_color=(255, 255, 255)):
+    """
+    Render a float band, e.g. a vegetation index, to an RGB image with a colormap lookup table.
+
+    Parameters:
+        values (np.ndarray): (H, W) float array.
+        lut (np.ndarray): (n, 3) uint8 colors from `vmin` to `vmax`, see `colormap_lut`.
+        vmin, vmax (float): Value range of the colormap, values outside it are clipped. Default is [-1, 1].
+        nodata_color (tuple): Color of the NaN pixels. Default is white.
+
+    Returns:
+        np.ndarray: (H, W, 3) uint8 RGB image.
+    """
+    scale = (len(lut) - 1) / (vmax - vmin)
+    positions = np.nan_to_num((values - vmin) * scale, nan=0.0)
+    rgb = np.take(lut, np.clip(positions, 0, len(lut) - 1).astype(np.intp), axis=0)
+    rgb[np.isnan(values)] = nodata_color
+    return rgb
@@ -0,0 +1,133 @@
+"""
+Quantized transfer and storage of vegetation indices.
+
+Index values only need about 1e-4 precision, so instead of FLOAT32 the evalscripts can return them as
+scaled integers, `value = q * scale + offset`, with a sentinel for nodata:
+
+    - INT16: scale 1e-4, range [-3.2767, 3.2767], 2x smaller than FLOAT32, error <= 5e-5.
+    - UINT8: 254 steps over the range of the index in `INDEX_RANGES`, 4x smaller, error <= 0.004 ([-1, 1])
+      or 0.006 (SAVI, [-1.5, 1.5]).
+
+Values outside the quantized range saturate at its edge. NDVI, GNDVI, NDRE and SAVI never leave it, but EVI
+and ARVI are unbounded: where their denominator nears 0 (dark water, haze) they reach any value. On the
+vegetation/soil/water/cloud mix of benchmarks/quantization_error.py, about 0.2% (EVI) and 0.3% (ARVI) of
+the pixels saturate in INT16, and 0.8% and 1.5% in UINT8. Keep FLOAT32 if those outliers matter.
+
+The integers can be kept as they are in the output GeoTIFF with the scale/offset and nodata in its
+metadata, and dequantized lazily when the bands are read.
+
+The RGB evalscripts are already quantized: they return values in [0, 1] with the AUTO sample type, which
+Sentinel Hub stretches to UINT8 (`RGB_QUANTIZATION`, error <= 1/510), and their nodata is the dataMask band.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from rubicon_cs.indices import INDEX_FORMULAS
+
+Quantization = namedtuple("Quantization", ["sample_type", "dtype", "scale", "offset", "nodata", "qmin", "qmax"])
+
+QUANTIZATIONS = {
+    'INT16': Quantization("INT16", np.int16, 1e-4, 0.0, -32768, -32767, 32767),
+    'UINT8': Quantization("UINT8", np.uint8, 2 / 254, -1.0, 255, 0, 254),
+}
+
+# Sample type AUTO of the RGB evalscripts: values in [0, 1] are stretched to 0-255, without nodata sentinel
+RGB_QUANTIZATION = Quantization("AUTO", np.uint8, 1 / 255, 0.0, None, 0, 255)
+
+# Range of each index spanned by the UINT8 steps, see the module docstring for EVI and ARVI
+INDEX_RANGES = {
+    'ndvi': (-1.0, 1.0),
+    'evi': (-1.0, 1.0),
+    'gndvi': (-1.0, 1.0),
+    'ndre': (-1.0, 1.0),
+    'savi': (-1.5, 1.5),
+    'arvi': (-1.0, 1.0),
+}
+
+# JavaScript expressions of the indices, matching rubicon_cs.indices.INDEX_FORMULAS
+INDEX_EXPRESSIONS = {
+    'ndvi': "(s.B08 - s.B04) / (s.B08 + s.B04)",
+    'evi': "2.5 * (s.B08 - s.B04) / ((s.B08 + 6.0 * s.B04 - 7.5 * s.B02) + 1.0)",
+    'gndvi': "(s.B08 - s.B03) / (s.B08 + s.B03)",
+    'ndre': "(s.B08 - s.B05) / (s.B08 + s.B05)",
+    'savi': "((s.B08 - s.B04) / (s.B08 + s.B04 + 0.5)) * 1.5",
+    'arvi': "(s.B08 - (2.0 * s.B04 - s.B02)) / (s.B08 + (2.0 * s.B04 - s.B02))",
+}
+
+
+def get_quantization(quantization, veg_index=None):
+    """
+    Return the `Quantization` of 'INT16' or 'UINT8', or pass a `Quantization` through.
+
+    With `veg_index`, the UINT8 steps span the range of the index in `INDEX_RANGES` instead of [-1, 1].
+    """
+    if isinstance(quantization, Quantization):
+        return quantization
+    try:
+        q = QUANTIZATIONS[quantization.upper()]
+    except KeyError:
+        raise ValueError(f"Unknown quantization {quantization}, choose from {list(QUANTIZATIONS)}") from None
+    if veg_index is not None and q.sample_type == 'UINT8':
+        low, high = INDEX_RANGES[veg_index]
+        q = q._replace(scale=(high - low) / (q.qmax - q.qmin), offset=low)
+    return q
+
+
+def build_quantized_index_evalscript(veg_index, quantization='INT16'):
+    """Build an evalscript returning a vegetation index as scaled integers, with the nodata sentinel outside dataMask."""
+    q = get_quantization(quantization, veg_index)
+    band_list = ", ".join(f'"{band}"' for band in INDEX_FORMULAS[veg_index][0])
+    return f"""
+//VERSION=3
+function setup() {{
+    return {{
+        input: [{band_list}, "dataMask"],
+        output: {{
+            bands: 1,
+            sampleType: "{q.sample_type}"
+        }}
+    }};
+}}
+function evaluatePixel(s) {{
+  let value = {INDEX_EXPRESSIONS[veg_index]};
+  if (s.dataMask == 0 || !isFinite(value)) {{
+    return [{q.nodata}];
+  }}
+  return [Math.max({q.qmin}, Math.min({q.qmax}, Math.round((value - {q.offset!r}) / {q.scale!r})))];
+}}
+"""
+
+
+def quantize(values, quantization='INT16'):
+    """
+    Quantize float values like the quantized evalscripts, NaN becoming the nodata sentinel.
+
+    Halves are rounded up, as `Math.round` in the evalscripts.
+    """
+    q = get_quantization(quantization)
+    scaled = np.clip(np.floor((values - q.offset) / q.scale + 0.5), q.qmin, q.qmax)
+    if q.nodata is not None:
+        scaled = np.where(np.isfinite(values), scaled, q.nodata)
+    return scaled.astype(q.dtype)
+
+
+def dequantize(ints, quantization='INT16', out=None):
+    """Convert quantized integers back to float32 values, nodata becoming NaN."""
+    q = get_quantization(quantization)
+    values = np.multiply(ints, np.float32(q.scale), out=out, dtype=np.float32)
+    values += np.float32(q.offset)
+    if q.nodata is not None:
+        values[ints == q.nodata] = np.nan
+    return values
+
+
+def quantized_range(quantization='INT16'):
+    """Return the (low, high) values of the first and last quantization steps."""
+    q = get_quantization(quantization)
+    return q.qmin * q.scale + q.offset, q.qmax * q.scale + q.offset
+
+
+def max_quantization_error(quantization='INT16'):
+    """Largest reconstruction error of values inside the quantized range: half a quantization step."""
+    return get_quantization(quantization).scale / 2
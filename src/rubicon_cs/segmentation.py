@@ -0,0 +1,340 @@
+"""
+Semantic segmentation of large images: patch inference with the model and georeferenced class maps.
+
+This is the torch side of the package, the fetch functions of `rubicon_cs.main` don't import it.
+"""
+import hashlib
+import json
+import os
+import shutil
+from collections import deque
+from functools import partial
+
+import numpy as np
+import rasterio
+import torch
+from rasterio.windows import Window
+
+from rubicon_cs.backends import load_backend
+from rubicon_cs.instrumentation import count, stage
+from rubicon_cs.patches import (
+    ClassMapStitcher, extract_patches, find_valid_patches, iter_patch_batches, pad_to_multiple, stitch_patches
+)
+
+
+# Default scale of each input dtype: 8-bit images like `to_tensor`, Sentinel-2 digital numbers to reflectance
+DEFAULT_INPUT_SCALES = {np.dtype(np.uint8): 1 / 255, np.dtype(np.uint16): 1 / 10000}
+
+# Arguments of `semantic_segmentation_large_image` set by `segment_geotiff` for each window
+_WINDOW_ARGUMENTS = ('output', 'valid_mask', 'with_confidence')
+# Arguments of `semantic_segmentation_large_image` that change the class maps, recorded with the window parts
+_CLASS_MAP_ARGUMENTS = ('patch_size', 'overlap', 'use_bf16', 'background_class')
+
+
+# --- Model Input ---
+def to_model_input(image, channels=None, scale=None, mean=None, std=None):
+    """
+    Turn a (H, W, C) image array, e.g. `fetch_scene(...).image`, into a (C, H, W) float32 model input tensor.
+
+    The tensor shares the memory of a float32 array (`torch.from_numpy`), which is then normalized in place, and
+    the (C, H, W) layout is a view. Integer images (UINT8 RGB, UINT16 bands) need a single float32 copy.
+
+    Parameters:
+        image (np.ndarray): (H, W, C) or (H, W) array. float32 arrays are modified in place.
+        channels (list): Channels to keep, e.g. [0, 1, 2] to drop the dataMask band of 'rgb_optimized'.
+        scale (float): Factor applied first. Default is 1/255 for uint8, 1/10000 for uint16 and 1 otherwise.
+        mean, std (sequence): Optional per-channel normalization, `(x * scale - mean) / std`.
+
+    Returns:
+        torch.Tensor: (C, H, W) float32 tensor.
+    """
+    if image.ndim == 2:
+        image = image[..., np.newaxis]
+    if channels is not None:
+        channels = list(channels)
+        if channels == list(range(channels[0], channels[0] + len(channels))):
+            image = image[..., channels[0]:channels[0] + len(channels)]  # Consecutive channels are a view
+        else:
+            image = image[..., channels]
+    if scale is None:
+        scale = DEFAULT_INPUT_SCALES.get(image.dtype, 1.0)
+
+    if image.dtype != np.float32:
+        image = image.astype(np.float32)
+    tensor = torch.from_numpy(image)  # (H, W, C), the channels are the last axis so (C,) vectors broadcast
+    if scale != 1:
+        tensor.mul_(scale)
+    if mean is not None:
+        tensor.sub_(torch.as_tensor(mean, dtype=torch.float32))
+    if std is not None:
+        tensor.div_(torch.as_tensor(std, dtype=torch.float32))
+    return tensor.permute(2, 0, 1)
+
+
+def valid_mask_from(image, channel=-1):
+    """(H, W) bool tensor of the pixels where the dataMask `channel` of a (H, W, C) image is set."""
+    return torch.from_numpy(image[..., channel] > 0)
+
+
+# --- Full Inference Function ---
+def semantic_segmentation_large_image(image, model, device, patch_size=512, batch_size=8, use_bf16=False,
+                                      channels_last=False, prefetch=2, output='logits', overlap=0, out_path=None,
+                                      with_confidence=False, valid_mask=None, nodata_value=None, background_class=0,
+                                      predictor=None, backend=None):
+    """
+    image: torch tensor of shape (C, H, W)
+    model: segmentation model that takes input of shape (B, C, patch_size, patch_size)
+    batch_size: number of patches per forward pass
+    use_bf16: run the forward pass under bfloat16 autocast (CPU or GPU). Logits are returned as float32 but
+        differ from the float32 forward by up to ~1e-2 relative, so the argmax may change on pixels whose two
+        best classes are within that margin. With use_bf16=False the output matches batch_size=1 up to float
+        rounding (~1e-5).
+    channels_last: convert the model (in place) and the batches to the channels_last memory format, which is
+        faster for convolutions on recent CPUs
+    prefetch: number of batches assembled ahead of the model by a background thread
+    output: 'logits' returns the (num_classes, H, W) float logits. 'class_map' reduces each patch to its argmax
+        as soon as it is predicted and returns a (H, W) uint8 class map (see ClassMapStitcher), so memory
+        no longer grows with num_classes * H * W
+    overlap: pixels shared by neighbouring patches, blended on the overlap strips ('class_map' only)
+    out_path: write the class map to a memory-mapped .npy file at this path ('class_map' only)
+    with_confidence: also return the uint8 max probability map, i.e. (class_map, confidence) ('class_map' only)
+    valid_mask: optional (H, W) bool mask of the valid pixels, e.g. the dataMask alpha channel of the rgb_optimized
+        evalscript. Patches without any valid pixel (nodata or padding) are not run through the model, their number
+        is reported by the `skipped_patches` counter of `rubicon_cs.instrumentation`
+    nodata_value: if valid_mask is None, pixels where every channel equals this value are considered nodata,
+        e.g. 0 for the black borders of the rgb_optimized PNGs. Default None runs the model on every patch
+    background_class: class filled in the skipped patches. For output='logits' their logits are 0 for this class
+        and -100 for the others
+    predictor: optional callable mapping an iterator of (positions, batch) pairs to an iterator of
+        (positions, logits) pairs in the same order, e.g. `InferencePool.predict_batches` to spread the batches
+        over several processes. Default runs `model` in the calling process
+    backend: optional inference backend the model is run with, 'compile', 'torchscript' or 'onnx' (see
+        `rubicon_cs.backends.load_backend`), built for (batch_size, C, patch_size, patch_size) batches. Built
+        artifacts are cached on disk, but to segment many images call `load_backend` once and pass its result
+        as `model`
+    """
+    if output not in ('logits', 'class_map'):
+        raise ValueError(f"output must be 'logits' or 'class_map', got {output}")
+    if output == 'logits' and overlap:
+        raise ValueError("Overlapping patches are only supported with output='class_map'")
+    if backend is not None and backend != 'eager':
+        model = load_backend(backend, model=model, input_shape=(batch_size, image.shape[0], patch_size, patch_size))
+    if model is not None:
+        model.eval()
+        if channels_last:
+            model.to(memory_format=torch.channels_last)
+    image = image.to(device)
+    
+    # 1. Pad
+    stride = patch_size - overlap
+    with stage("pad"):
+        padded_image, pad_h, pad_w = pad_to_multiple(image, patch_size, stride)
+    
+    # 2. Extract patches
+    with stage("extract"):
+        patches = extract_patches(padded_image, patch_size, stride)
+
+    # 3. Flag patches that only contain nodata or padding, they are filled instead of predicted
+    if valid_mask is None and nodata_value is not None:
+        valid_mask = (image != nodata_value).any(dim=0)
+    if valid_mask is not None:
+        is_valid = find_valid_patches(torch.as_tensor(valid_mask, device=device), patch_size, stride).tolist()
+    else:
+        is_valid = [True] * len(patches)
+    if not any(is_valid):
+        is_valid[0] = True  # At least one prediction is needed to know the number of classes
+    n_skipped = is_valid.count(False)
+    count("patches", len(patches))
+    count("skipped_patches", n_skipped)
+
+    # 4. Predict patches by batches, class maps are stitched on the fly
+    predicted_patches = []
+    stitcher = None
+    if output == 'class_map':
+        stitcher = ClassMapStitcher(image.shape[1:], patch_size, overlap, out_path, with_confidence)
+
+    def emit(position, pred):
+        if stitcher is not None:
+            with stage("stitch"):
+                stitcher.add(*position, pred)
+        else:
+            predicted_patches.append((position, pred))
+
+    # Patches are emitted in raster order, skipped ones once the predictions before them are available
+    pending = deque((position, valid) for (position, _), valid in zip(patches, is_valid))
+    predictions = {}
+    fill = None
+    valid_patches = [patch for patch, valid in zip(patches, is_valid) if valid]
+    batches = iter_patch_batches(valid_patches, batch_size, device, channels_last=channels_last, prefetch=prefetch)
+    if predictor is None:
+        predictor = partial(predict_batches, model, use_bf16=use_bf16)
+    for positions, pred in predictor(batches):
+        pred = pred.float().cpu()  # (B, num_classes, H, W)
+        predictions.update(zip(positions, pred))
+        if fill is None:
+            fill = torch.full_like(pred[0], -100.0)
+            fill[background_class] = 0.0
+        while pending and (not pending[0][1] or pending[0][0] in predictions):
+            position, valid = pending.popleft()
+            emit(position, predictions.pop(position) if valid else fill)
+    for position, _ in pending:
+        emit(position, fill)
+
+    if stitcher is not None:
+        return stitcher.result()  # (H_original, W_original) uint8
+    
+    # 5. Stitch prediction
+    _, H_padded, W_padded = padded_image.shape
+    with stage("stitch"):
+        stitched = stitch_patches(predicted_patches, (fill.shape[0], H_padded, W_padded), patch_size)
+
+    # 6. Remove padding
+    if pad_h > 0:
+        stitched = stitched[:, :-pad_h, :]
+    if pad_w > 0:
+        stitched = stitched[:, :, :-pad_w]
+
+    return stitched  # (num_classes, H_original, W_original)
+
+def predict_batches(model, batches, use_bf16=False):
+    """Run the model on each (positions, batch) pair and yield (positions, logits) pairs."""
+    for positions, batch in batches:
+        with torch.inference_mode(), torch.autocast(device_type=batch.device.type, dtype=torch.bfloat16,
+                                                    enabled=use_bf16):
+            with stage("forward"):
+                pred = model(batch)[0].float()
+        yield positions, pred
+
+def segment_geotiff(input_path, output_path, model, device, window_size=4096, bands=(1, 2, 3), scale=1 / 255,
+                    resume=True, backend=None, **segmentation_kwargs):
+    """
+    Segment a GeoTIFF of any size window by window and write the class map as a georeferenced GeoTIFF.
+
+    Parameters:
+        input_path (str): Input GeoTIFF, e.g. an RGB mosaic from the tiled fetch.
+        output_path (str): Output uint8 class map GeoTIFF, tiled and compressed, with the CRS and transform of the input.
+        model, device: See `semantic_segmentation_large_image`.
+        window_size (int): Size of the windows read from the input. Rounded down to a multiple of the patch size
+            so that the patch grid is the same as for the whole image. Default is 4096.
+        bands (tuple): 1-based input bands fed to the model. Default is (1, 2, 3).
+        scale (float): Factor applied to the input values, e.g. 1/255 for 8-bit imagery like `to_tensor`. Default is 1/255.
+        resume (bool): If True and a previous run on the same output was interrupted, keep the windows it
+            completed and only segment the others. Default is True.
+        backend (str): Optional inference backend, 'compile', 'torchscript' or 'onnx', built once for all the
+            windows (see `rubicon_cs.backends.load_backend`). Default runs `model` as is.
+        segmentation_kwargs: Passed to `semantic_segmentation_large_image` (patch_size, batch_size, use_bf16...).
+
+    Notes:
+        - Only one window is held in memory at a time, so memory does not depend on the size of the input.
+        - Nodata pixels of the input (nodata value, alpha band or internal mask) are passed as `valid_mask`.
+        - Each window's class map is saved atomically to its own file in `{output_path}.parts/`, which is what
+          marks it as completed, so a run killed at any point never records a window that isn't on disk.
+          The windows are merged into a temporary GeoTIFF that replaces `output_path` once it is closed, so
+          the output is either absent or complete. The parts need one byte per pixel of disk space.
+        - The parts directory also holds a `manifest.json` of the run (input size and mtime, window size, bands,
+          scale, model weights and class map arguments). Parts left by a run with another manifest are
+          discarded and every window is segmented again.
+    """
+    reserved = [key for key in _WINDOW_ARGUMENTS if key in segmentation_kwargs]
+    if reserved:
+        raise ValueError(f"segment_geotiff sets {reserved} itself, they can't be passed as segmentation_kwargs")
+    patch_size = segmentation_kwargs.get('patch_size', 512)
+    window_size = max(patch_size, window_size // patch_size * patch_size)
+    parts_dir = f"{output_path}.parts"
+    manifest_path = os.path.join(parts_dir, "manifest.json")
+
+    with rasterio.open(input_path) as src:
+        windows = [
+            Window(col, row, min(window_size, src.width - col), min(window_size, src.height - row))
+            for row in range(0, src.height, window_size)
+            for col in range(0, src.width, window_size)
+        ]
+
+        if resume and os.path.exists(output_path) and not os.path.exists(parts_dir):
+            print(f"{output_path} is already complete")
+            return output_path
+        input_stat = os.stat(input_path)
+        manifest = {
+            "input": {"width": src.width, "height": src.height, "size": input_stat.st_size,
+                      "mtime_ns": input_stat.st_mtime_ns},
+            "window_size": window_size,
+            "bands": list(bands),
+            "scale": scale,
+            "model": _model_fingerprint(model, backend),
+            **{key: segmentation_kwargs[key] for key in _CLASS_MAP_ARGUMENTS if key in segmentation_kwargs},
+        }
+        if resume and os.path.exists(parts_dir) and _read_manifest(manifest_path) != manifest:
+            print(f"The window parts of {output_path} come from another configuration, segmenting every window again")
+            resume = False
+        if not resume and os.path.exists(parts_dir):
+            shutil.rmtree(parts_dir)
+        if not os.path.exists(manifest_path):
+            os.makedirs(parts_dir, exist_ok=True)
+            _write_manifest(manifest_path, manifest)
+
+        if backend is not None and backend != 'eager':
+            patch_shape = (len(bands), patch_size, patch_size)
+            model = load_backend(backend, model=model,
+                                 input_shape=(segmentation_kwargs.get('batch_size', 8), *patch_shape))
+
+        for window_idx, window in enumerate(windows):
+            part_path = _window_part_path(parts_dir, window_idx)
+            if os.path.exists(part_path):
+                continue
+            image = torch.from_numpy(src.read(list(bands), window=window).astype(np.float32)) * scale
+            valid_mask = torch.from_numpy(src.dataset_mask(window=window) > 0)
+            class_map = semantic_segmentation_large_image(
+                image, model, device, output='class_map', valid_mask=valid_mask, **segmentation_kwargs
+            )
+            with stage("write"):
+                _save_window_part(part_path, class_map)
+            print(f"Segmented window {window_idx + 1}/{len(windows)}")
+
+        profile = dict(
+            driver="GTiff", width=src.width, height=src.height, count=1, dtype=np.uint8,
+            crs=src.crs, transform=src.transform, tiled=True, blockxsize=512, blockysize=512,
+            compress="deflate", BIGTIFF="IF_SAFER"
+        )
+
+    tmp_path = f"{output_path}.tmp"
+    with stage("write"), rasterio.open(tmp_path, "w", **profile) as dst:
+        for window_idx, window in enumerate(windows):
+            dst.write(np.load(_window_part_path(parts_dir, window_idx), mmap_mode="r"), 1, window=window)
+    os.replace(tmp_path, output_path)
+    shutil.rmtree(parts_dir)
+    return output_path
+
+def _model_fingerprint(model, backend):
+    """Hash of the backend and of the names, shapes and values of the model weights."""
+    digest = hashlib.sha256(str(backend).encode())
+    if isinstance(model, torch.nn.Module):
+        for name, tensor in model.state_dict().items():
+            tensor = tensor.detach().cpu().contiguous()
+            digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+            digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    else:
+        digest.update(f"{type(model).__module__}.{type(model).__qualname__}".encode())
+    return digest.hexdigest()
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _write_manifest(manifest_path, manifest):
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def _window_part_path(parts_dir, window_idx):
+    return os.path.join(parts_dir, f"window_{window_idx:06d}.npy")
+
+def _save_window_part(part_path, class_map):
+    """Atomically save the class map of a window: the part only exists once it is fully written."""
+    tmp_path = f"{part_path}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.save(file, np.asarray(class_map, dtype=np.uint8))
+    os.replace(tmp_path, part_path)
@@ -0,0 +1,462 @@
+"""
+Training data pipeline of the crop type fine-tuning (section three): patch shards, dataset and throughput.
+
+Cutting the source rasters with `extract_patches` at every epoch keeps the CPU busy with padding, slicing and
+stacking instead of feeding the model. `write_patch_shards` does it once: the (image, label) rasters are tiled
+with the geometry of `pad_to_multiple` + `extract_patches` into fixed-shape `.npy` shards, written through
+memory maps, next to an `index.json`. `PatchShardDataset` memory-maps the shards and yields whole batches:
+
+    - a batch of consecutive samples is a `torch.from_numpy` view of the shard, shuffled batches are gathered
+      with one `np.take` per shard into a tensor that worker processes allocate in shared memory;
+    - the sample order and augmentations only depend on (seed, epoch), batches are split between ranks and
+      DataLoader workers, so the batch stream is the same for any number of workers;
+    - flips and 90 degree rotations are applied per batch, one indexing per transform instead of per sample.
+
+`measure_throughput` reports the samples per second of a loader and the fraction of the time spent waiting
+for data, which should stay close to 0 when the training step is the bottleneck.
+
+Usage:
+    write_patch_shards([("munich_0.tif", "munich_0_labels.tif"), (image, label)], "shards/", patch_size=256)
+    dataset = PatchShardDataset("shards/index.json", batch_size=32, shuffle=True, augment=True, seed=0)
+    loader = DataLoader(dataset, batch_size=None, num_workers=4)
+    for epoch in range(epochs):
+        dataset.set_epoch(epoch)
+        stats = measure_throughput(loader, step=train_step)
+"""
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from rubicon_cs.instrumentation import count, stage
+from rubicon_cs.patches import padded_size
+from rubicon_cs.segmentation import DEFAULT_INPUT_SCALES
+
+INDEX_FILE = "index.json"
+
+
+# --- Patch Shards ---
+class _ShardWriter:
+    """Append patches to fixed-capacity memory-mapped shards, the last shard is truncated to its count."""
+
+    def __init__(self, output_dir, shard_size, image_shape, image_dtype, label_dtype):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.image_shape = image_shape
+        self.image_dtype = image_dtype
+        self.label_dtype = label_dtype
+        self.shards = []
+        self._images = self._labels = None
+        self._count = 0
+
+    def _open(self):
+        name = f"shard_{len(self.shards):05d}"
+        self.shards.append({"images": f"{name}_images.npy", "labels": f"{name}_labels.npy", "count": 0})
+        self._images = np.lib.format.open_memmap(os.path.join(self.output_dir, self.shards[-1]["images"]), mode="w+",
+                                                 dtype=self.image_dtype, shape=(self.shard_size, *self.image_shape))
+        self._labels = np.lib.format.open_memmap(os.path.join(self.output_dir, self.shards[-1]["labels"]), mode="w+",
+                                                 dtype=self.label_dtype, shape=(self.shard_size, *self.image_shape[1:]))
+        self._count = 0
+
+    def add(self, image, label):
+        if self._images is None:
+            self._open()
+        self._images[self._count] = image
+        self._labels[self._count] = label
+        self._count += 1
+        self.shards[-1]["count"] = self._count
+        if self._count == self.shard_size:
+            self._close()
+
+    def _close(self):
+        self._images.flush()
+        self._labels.flush()
+        images, labels, n = self._images, self._labels, self._count
+        self._images = self._labels = None
+        if n < self.shard_size:
+            # Rewrite the partial last shard at its size, so every shard row is a sample
+            for key, array in (("images", images), ("labels", labels)):
+                path = os.path.join(self.output_dir, self.shards[-1][key])
+                np.save(path + ".tmp.npy", array[:n])
+                os.replace(path + ".tmp.npy", path)
+
+    def close(self):
+        if self._images is not None:
+            self._close()
+        return self.shards
+
+
+def _iter_row_strips(source, patch_size, stride, image_dtype, ignore_index):
+    """
+    Yield (row, image strip, label strip) of `patch_size` rows for each patch row of `extract_patches`.
+
+    The strips cover the padded width of `pad_to_multiple`, padding is 0 in the image and `ignore_index` in the
+    label. GeoTIFF sources are read one strip window at a time, arrays are sliced.
+    """
+    image, label = source
+    if isinstance(image, (str, os.PathLike)):
+        import rasterio
+        from rasterio.windows import Window
+
+        with rasterio.open(image) as image_file, rasterio.open(label) as label_file:
+            height, width = image_file.height, image_file.width
+            channels = image_file.count
+
+            def read_image(row, rows):
+                return image_file.read(window=Window(0, row, width, rows))
+
+            def read_label(row, rows):
+                return label_file.read(1, window=Window(0, row, width, rows))
+
+            yield from _strips(channels, height, width, read_image, read_label, patch_size, stride, image_dtype,
+                               ignore_index)
+    else:
+        channels, height, width = image.shape
+        if label.shape != (height, width):
+            raise ValueError(f"label shape {label.shape} does not match image shape {image.shape}")
+        yield from _strips(channels, height, width, lambda row, rows: image[:, row:row + rows],
+                           lambda row, rows: label[row:row + rows], patch_size, stride, image_dtype, ignore_index)
+
+
+def _strips(channels, height, width, read_image, read_label, patch_size, stride, image_dtype, ignore_index):
+    padded_height = padded_size(height, patch_size, stride)
+    padded_width = padded_size(width, patch_size, stride)
+    image_strip = np.zeros((channels, patch_size, padded_width), dtype=image_dtype)
+    label_strip = np.full((patch_size, padded_width), ignore_index, dtype=np.int64)
+    for row in range(0, padded_height - patch_size + 1, stride):
+        rows = max(0, min(patch_size, height - row))
+        image_strip[:, :rows, :width] = read_image(row, rows)
+        image_strip[:, rows:] = 0
+        label_strip[:rows, :width] = read_label(row, rows)
+        label_strip[rows:] = ignore_index
+        yield row, image_strip, label_strip
+
+
+def write_patch_shards(sources, output_dir, patch_size=256, stride=None, shard_size=1024, image_dtype=None,
+                       label_dtype=np.uint8, ignore_index=255, skip_unlabeled=True, names=None):
+    """
+    Tile (image, label) rasters into memory-mapped patch shards for `PatchShardDataset`.
+
+    Patches follow `pad_to_multiple(image, patch_size, stride)` + `extract_patches(image, patch_size, stride)`:
+    the same positions, in raster order, with zero padding. Shards hold `shard_size` patches as
+    `shard_XXXXX_images.npy` (N, C, P, P) and `shard_XXXXX_labels.npy` (N, P, P); `positions.npy` keeps the
+    (source, row, col) of every patch and `index.json` describes the whole set.
+
+    Parameters:
+        sources (iterable): (image, label) pairs, either (C, H, W) and (H, W) arrays or paths of GeoTIFF files
+            (all image bands, first label band). GeoTIFFs are read one patch row at a time.
+        output_dir (str): Directory of the shards, created if needed.
+        patch_size (int): Size of the square patches. Default is 256.
+        stride (int): Distance between patches, default `patch_size` (no overlap).
+        shard_size (int): Number of patches per shard file. Default is 1024.
+        image_dtype: Storage dtype of the images. Default is the dtype of the first source, e.g. uint16 Sentinel-2
+            digital numbers, which halves the I/O compared to float32.
+        label_dtype: Storage dtype of the labels. Default is uint8.
+        ignore_index (int): Label of the padding, to be ignored by the loss. Default is 255.
+        skip_unlabeled (bool): Don't store patches whose pixels are all `ignore_index`. Default is True.
+        names (list): Optional names of the sources stored in the index, default their paths or positions.
+
+    Returns:
+        str: Path of the index file.
+    """
+    stride = stride or patch_size
+    os.makedirs(output_dir, exist_ok=True)
+    writer = None
+    positions = []
+    source_names = []
+    skipped = 0
+
+    for source_id, source in enumerate(sources):
+        image = source[0]
+        if isinstance(image, (str, os.PathLike)):
+            source_names.append(names[source_id] if names else os.fspath(image))
+        else:
+            source_names.append(names[source_id] if names else f"source_{source_id}")
+        if image_dtype is None and not isinstance(image, (str, os.PathLike)):
+            image_dtype = image.dtype
+        elif image_dtype is None:
+            import rasterio
+
+            with rasterio.open(image) as file:
+                image_dtype = np.dtype(file.dtypes[0])
+
+        with stage("tile", source=source_names[-1]):
+            for row, image_strip, label_strip in _iter_row_strips(source, patch_size, stride, image_dtype,
+                                                                  ignore_index):
+                if writer is None:
+                    writer = _ShardWriter(output_dir, shard_size, (image_strip.shape[0], patch_size, patch_size),
+                                          np.dtype(image_dtype), np.dtype(label_dtype))
+                for col in range(0, image_strip.shape[2] - patch_size + 1, stride):
+                    label = label_strip[:, col:col + patch_size]
+                    if skip_unlabeled and (label == ignore_index).all():
+                        skipped += 1
+                        continue
+                    writer.add(image_strip[:, :, col:col + patch_size], label)
+                    positions.append((source_id, row, col))
+
+    if writer is None:
+        raise ValueError("sources is empty")
+    shards = writer.close()
+    count("patches", len(positions))
+    count("skipped_patches", skipped)
+    np.save(os.path.join(output_dir, "positions.npy"), np.asarray(positions, dtype=np.int32).reshape(-1, 3))
+
+    index = {
+        "patch_size": patch_size,
+        "stride": stride,
+        "channels": writer.image_shape[0],
+        "image_dtype": writer.image_dtype.str,
+        "label_dtype": writer.label_dtype.str,
+        "ignore_index": ignore_index,
+        "num_samples": len(positions),
+        "skipped_unlabeled": skipped,
+        "shards": shards,
+        "positions": "positions.npy",
+        "sources": source_names,
+    }
+    index_path = os.path.join(output_dir, INDEX_FILE)
+    with open(index_path, "w") as file:
+        json.dump(index, file, indent=2)
+    return index_path
+
+
+# --- Augmentations ---
+def augment_batch(images, labels, generator, flips=True, rotations=True):
+    """
+    Apply a random flip and 90 degree rotation to each (image, label) of a batch, in place.
+
+    Each sample draws one of the 8 symmetries of the square (4 without flips, 2 without rotations) and the
+    samples that drew the same one are transformed together, so a batch costs at most 8 indexing operations.
+    They run on NumPy views of the tensors, which support every storage dtype (torch can't index_put uint16).
+
+    Parameters:
+        images (torch.Tensor): (B, C, P, P) CPU batch.
+        labels (torch.Tensor): (B, P, P) CPU batch.
+        generator (np.random.Generator): Source of the random draws.
+
+    Returns:
+        tuple: (images, labels)
+    """
+    ops = (generator.integers(0, 4, len(images)) if rotations else np.zeros(len(images), dtype=np.int64))
+    if flips:
+        ops = ops + 4 * generator.integers(0, 2, len(images))
+    for op in np.unique(ops):
+        if op == 0:
+            continue
+        selected = np.flatnonzero(ops == op)
+        for batch in (images.numpy(), labels.numpy()):
+            transformed = batch[selected]
+            if op >= 4:
+                transformed = transformed[..., ::-1]
+            if op % 4:
+                transformed = np.rot90(transformed, op % 4, axes=(-2, -1))
+            batch[selected] = transformed
+    return images, labels
+
+
+# --- Dataset ---
+class PatchShardDataset(torch.utils.data.IterableDataset):
+    """
+    Batches of (images, labels) read from the memory-mapped shards of `write_patch_shards`.
+
+    Use with `DataLoader(dataset, batch_size=None, num_workers=N)`: the dataset already yields batches. Call
+    `set_epoch(epoch)` before each epoch (workers must not be persistent for them to see it).
+
+    Parameters:
+        index_path (str): Path of the `index.json` file, or of its directory.
+        batch_size (int): Samples per batch. Default is 16.
+        shuffle (bool): Shuffle the samples at each epoch. Default is False (e.g. for validation).
+        augment (bool): Apply random flips and 90 degree rotations (`augment_batch`). Default is False.
+        seed (int): Seed of the shuffling and augmentations. Default is 0.
+        drop_last (bool): Drop the last incomplete batch. Default is True when shuffling.
+        as_float (bool): Return float32 images and int64 labels, ready for the model and
+            `CrossEntropyLoss(ignore_index=...)`. With False, the storage dtypes are kept to convert on the GPU.
+        scale (float): Factor applied to the float images. Default depends on the storage dtype like
+            `to_model_input` (1/10000 for uint16).
+        mean, std (sequence): Optional per-channel normalization, `(x * scale - mean) / std`.
+        rank, world_size (int): Shard of the batches for distributed training. Default is the
+            `torch.distributed` rank and world size if initialized, else the whole dataset.
+
+    Notes:
+        - The batch plan only depends on (seed, epoch): rank r gets the batches r, r + world_size, ... of the
+          plan, and DataLoader worker w of `num_workers` the batches w, w + num_workers, ... of its rank, which
+          the DataLoader yields back in order. Augmentations are seeded per batch, so the batches are identical
+          for any `num_workers`.
+        - Without shuffling, a batch of consecutive samples of one shard is a view of the memory map (zero copy).
+    """
+
+    def __init__(self, index_path, batch_size=16, shuffle=False, augment=False, seed=0, drop_last=None,
+                 as_float=True, scale=None, mean=None, std=None, rank=None, world_size=None):
+        if os.path.isdir(index_path):
+            index_path = os.path.join(index_path, INDEX_FILE)
+        with open(index_path) as file:
+            self.index = json.load(file)
+        self.directory = os.path.dirname(index_path)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+        self.seed = seed
+        self.drop_last = shuffle if drop_last is None else drop_last
+        self.as_float = as_float
+        self.scale = DEFAULT_INPUT_SCALES.get(np.dtype(self.index["image_dtype"]), 1) if scale is None else scale
+        self.mean = None if mean is None else torch.as_tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+        self.std = None if std is None else torch.as_tensor(std, dtype=torch.float32).view(-1, 1, 1)
+        if rank is None or world_size is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            rank = torch.distributed.get_rank() if distributed else 0
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        counts = [shard["count"] for shard in self.index["shards"]]
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self._shards = None  # opened lazily, in each worker process
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    @property
+    def num_samples(self):
+        return int(self.offsets[-1])
+
+    def set_epoch(self, epoch):
+        """Set the epoch of the shuffling and augmentations."""
+        self.epoch = epoch
+
+    def _open_shards(self):
+        if self._shards is None:
+            # Copy-on-write maps: writable for torch.from_numpy, the file is never modified
+            self._shards = [
+                (np.load(os.path.join(self.directory, shard["images"]), mmap_mode="c"),
+                 np.load(os.path.join(self.directory, shard["labels"]), mmap_mode="c"))
+                for shard in self.index["shards"]
+            ]
+        return self._shards
+
+    def batch_plan(self, epoch=None):
+        """Return the sample indices of each batch of the epoch, over all ranks."""
+        epoch = self.epoch if epoch is None else epoch
+        order = np.arange(self.num_samples)
+        if self.shuffle:
+            order = np.random.default_rng((self.seed, epoch)).permutation(self.num_samples)
+        stop = self.num_samples - self.num_samples % self.batch_size if self.drop_last else self.num_samples
+        # Sorted batches read the shards sequentially, the order inside a batch doesn't matter for training
+        return [np.sort(order[start:start + self.batch_size]) for start in range(0, stop, self.batch_size)]
+
+    def __len__(self):
+        """Number of batches of this rank."""
+        return len(range(self.rank, len(self.batch_plan()), self.world_size))
+
+    def sample(self, i):
+        """Return the (image, label) views of sample `i` in the storage dtypes, without copy."""
+        shard = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        images, labels = self._open_shards()[shard]
+        local = i - self.offsets[shard]
+        return torch.from_numpy(images[local]), torch.from_numpy(labels[local])
+
+    def load_batch(self, indices, batch_index=0, epoch=None):
+        """Read the samples `indices` (sorted) and return the (images, labels) batch."""
+        shards = self._open_shards()
+        shard_ids = np.searchsorted(self.offsets, indices, side="right") - 1
+        local = indices - self.offsets[shard_ids]
+
+        view = bool(shard_ids[0] == shard_ids[-1] and local[-1] - local[0] == len(indices) - 1)
+        if view:
+            images, labels = shards[shard_ids[0]]
+            images = torch.from_numpy(images[local[0]:local[-1] + 1])
+            labels = torch.from_numpy(labels[local[0]:local[-1] + 1])
+        else:
+            first_images, first_labels = shards[0]
+            images = self._empty((len(indices), *first_images.shape[1:]), first_images.dtype)
+            labels = self._empty((len(indices), *first_labels.shape[1:]), first_labels.dtype)
+            images_out, labels_out = images.numpy(), labels.numpy()
+            start = 0
+            for shard in np.unique(shard_ids):
+                selected = local[shard_ids == shard]
+                stop = start + len(selected)
+                np.take(shards[shard][0], selected, axis=0, out=images_out[start:stop])
+                np.take(shards[shard][1], selected, axis=0, out=labels_out[start:stop])
+                start = stop
+
+        # Augment in the storage dtype (fewer bytes to move). Views of the memory map are copied before any
+        # in-place change, which would otherwise persist for the next epochs.
+        if self.augment:
+            if view:
+                images, labels = images.clone(), labels.clone()
+                view = False
+            epoch = self.epoch if epoch is None else epoch
+            augment_batch(images, labels, np.random.default_rng((self.seed, epoch, batch_index)))
+        if self.as_float:
+            images = images.to(torch.float32, copy=view).mul_(self.scale)
+            if self.mean is not None:
+                images.sub_(self.mean)
+            if self.std is not None:
+                images.div_(self.std)
+            labels = labels.to(torch.int64, copy=view)
+        return images, labels
+
+    @staticmethod
+    def _empty(shape, dtype):
+        """Batch buffer, in shared memory inside a DataLoader worker so it is sent to the main process without copy."""
+        if torch.utils.data.get_worker_info() is None:
+            return torch.from_numpy(np.empty(shape, dtype=dtype))
+        return torch.empty(shape, dtype=torch.from_numpy(np.empty(0, dtype=dtype)).dtype).share_memory_()
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        plan = self.batch_plan()
+        for batch_index in range(self.rank + self.world_size * worker_id, len(plan), self.world_size * num_workers):
+            yield self.load_batch(plan[batch_index], batch_index)
+
+
+# --- Throughput ---
+def measure_throughput(batches, step=None, max_batches=None, warmup=1):
+    """
+    Iterate over `batches` (e.g. a DataLoader), run `step(images, labels)` on each and report the throughput.
+
+    Parameters:
+        batches (iterable): (images, labels) batches.
+        step (callable): Optional training step. Without it, only the data loading is measured.
+        max_batches (int): Stop after this many batches. Default is all of them.
+        warmup (int): Number of first batches excluded from the timings (worker start-up). Default is 1.
+
+    Returns:
+        dict: batches, samples, seconds, samples_per_second, data_wait_seconds, step_seconds and
+        data_wait_fraction, the fraction of the time waiting for data (close to 0 when bounded by compute).
+    """
+    stats = {"batches": 0, "samples": 0, "data_wait_seconds": 0.0, "step_seconds": 0.0}
+    iterator = iter(batches)
+    start = None
+    seen = 0
+    while max_batches is None or seen < max_batches:
+        wait_start = time.perf_counter()
+        with stage("load_batch"):
+            try:
+                images, labels = next(iterator)
+            except StopIteration:
+                break
+        step_start = time.perf_counter()
+        if step is not None:
+            with stage("train_step"):
+                step(images, labels)
+        end = time.perf_counter()
+        seen += 1
+        if seen <= warmup:
+            continue
+        if start is None:
+            start = wait_start
+        stats["batches"] += 1
+        stats["samples"] += len(images)
+        stats["data_wait_seconds"] += step_start - wait_start
+        stats["step_seconds"] += end - step_start
+        count("training_samples", len(images))
+
+    stats["seconds"] = time.perf_counter() - start if start is not None else 0.0
+    stats["samples_per_second"] = stats["samples"] / stats["seconds"] if stats["seconds"] else 0.0
+    stats["data_wait_fraction"] = stats["data_wait_seconds"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
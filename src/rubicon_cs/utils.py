@@ -1,12 +1,27 @@
 import rasterio
-import matplotlib.pyplot as plt
-from datetime import timedelta, datetime
+from rasterio.windows import Window
+from sentinelhub import BBox
 from sentinelhub.geo_utils import bbox_to_dimensions
-import torch
-import torch.nn.functional as F
 import math
 
-def display_geotiff(tiff_path, ncols=2, cmap='Greens'):
+from rubicon_cs.catalog import get_acquisition_dates, get_acquisition_index, search_window
+from rubicon_cs.writers import read_overview
+
+# The patch helpers need torch, they are loaded from rubicon_cs.patches on first access only
+_PATCH_HELPERS = {
+    'padded_size', 'pad_to_multiple', 'extract_patches', 'find_valid_patches', 'iter_patch_batches',
+    'stitch_patches', 'ClassMapStitcher',
+}
+
+
+def __getattr__(name):
+    if name in _PATCH_HELPERS:
+        from rubicon_cs import patches
+        return getattr(patches, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def display_geotiff(tiff_path, ncols=2, cmap='Greens', max_size=None):
     """
     Display the individual bands of a GeoTIFF file using matplotlib.
 
@@ -14,11 +29,16 @@ def display_geotiff(tiff_path, ncols=2, cmap='Greens'):
         tiff_path (str): Path to the GeoTIFF file.
         ncols (int): Number of columns in the subplot layout. Default is 2.
         cmap (str): Matplotlib colormap used to render the bands. Default is 'Greens'.
+        max_size (int): If set, bands are read downsampled to at most max_size pixels per side, which only
+            reads the overviews of a Cloud-Optimized GeoTIFF. Default is None (full resolution).
 
     Notes:
         - Displays each band in a subplot.
-        - Tries to retrieve the acquisition date from the band's metadata and uses it in the title.
+        - Tries to retrieve the acquisition date (and index, for multi-index files) from the band's metadata
+          and uses it in the title.
     """
+    import matplotlib.pyplot as plt
+
     with rasterio.open(tiff_path) as tiff:
 
         nrows = (tiff.count // ncols) + (1 if tiff.count % ncols != 0 else 0)
@@ -31,14 +51,16 @@ def display_geotiff(tiff_path, ncols=2, cmap='Greens'):
         # Loop through each band and plot it
         for i in range(tiff.count):
             # Read the data for the current band
-            band_data = tiff.read(i + 1)
+            band_data = read_overview(tiff, i + 1, max_size)
             
             # Retrieve the acquisition date for the current band
             band_metadata = tiff.tags(i + 1)
             acquisition_date = band_metadata.get("DATE", "No date available")
+            # Multi-index files (see geotiff_for_veg_indices) store the index of each band in its tags
+            index_name = band_metadata.get("INDEX", tiff_path.split('.tif')[-2].split('_')[-1])
             
             im = axes[i].imshow(band_data, cmap=cmap, vmin=-1, vmax=1)
-            axes[i].set_title(f"{tiff_path.split('.tif')[-2].split('_')[-1].upper()} Index in AOI on {acquisition_date}", fontsize=10)    
+            axes[i].set_title(f"{index_name.upper()} Index in AOI on {acquisition_date}", fontsize=10)    
             axes[i].axis('off')  # Turn off the axis
             fig.colorbar(im, ax=axes[i], orientation='horizontal', shrink=0.7, pad=0.05)
 
@@ -46,47 +68,61 @@ def display_geotiff(tiff_path, ncols=2, cmap='Greens'):
         plt.show()
 
 
-def find_nearest_available_date(catalog, data_collection, geometry, target_date, max_days=30, cloud_cover_limit=20):
+def find_nearest_available_date(catalog, data_collection, geometry, target_date, max_days=30, cloud_cover_limit=20,
+                                cache=None):
     """
     Find the nearest available date with imagery that meets cloud cover requirements.
 
     Parameters:
         catalog: A STAC catalog or API object with a `.search()` method.
         data_collection: The dataset or collection to search (e.g., Sentinel-2).
-        geometry (dict or shapely geometry): The area of interest (AOI).
+        geometry (Geometry): The area of interest (AOI).
         target_date (str): The preferred date in "YYYY-MM-DD" format.
         max_days (int): The maximum number of days before/after the target date to search. Default is 30.
         cloud_cover_limit (int): The maximum allowed cloud cover percentage. Default is 20%.
+        cache (ResponseCache): Optional persistent cache for the catalog search.
 
     Returns:
-        str: The nearest valid acquisition date as "YYYY-MM-DD".
+        str: The nearest valid acquisition date as "YYYY-MM-DD". On a tie the later date is returned.
 
     Raises:
         Exception: If no valid imagery is found within ±`max_days`.
+
+    Notes:
+        - The whole ±`max_days` window is searched with a single catalog query whose results are memoized
+          per AOI, collection and cloud cover limit, so later lookups within the window need no request.
     """
-    time_window = 0
-    target_date = datetime.strptime(target_date, "%Y-%m-%d")
-    while time_window <= max_days:
-        for delta in [time_window, -time_window]:  # Check both future and past
-            search_date = target_date + timedelta(days=delta)
-            search_time = (search_date.strftime("%Y-%m-%d"), search_date.strftime("%Y-%m-%d"))
-            
-            # Perform the search query to check if there are images for the date
-            search_iterator = catalog.search(
-                data_collection,
-                geometry=geometry,
-                time=search_time,
-                filter=f'eo:cloud_cover < {cloud_cover_limit}',
-                fields={"include": ["properties.datetime"], "exclude": []}
-            )
-            
-            results = list(search_iterator)
-            if results:
-                return results[0]["properties"]["datetime"][:10]  # Return the date in yyyy-mm-dd format
-        time_window += 1  # Increase the window and try again
+    get_acquisition_dates(
+        catalog, geometry, search_window(target_date, max_days), cloud_cover_limit=cloud_cover_limit,
+        data_collection=data_collection, cache=cache
+    )
+    index = get_acquisition_index(geometry, data_collection, cloud_cover_limit)
+    nearest_date = index.nearest(target_date, max_days)
+    if nearest_date is not None:
+        return nearest_date
 
     # If no results are found after searching ±max_days
-    raise Exception(f"No valid acquisitions found within ±{max_days} days of {target_date.strftime('%Y-%m-%d')}")
+    raise Exception(f"No valid acquisitions found within ±{max_days} days of {target_date}")
+
+def find_nearest_available_dates(catalog, data_collection, geometry, target_dates, max_days=30, cloud_cover_limit=20,
+                                 cache=None):
+    """
+    Find the nearest available date of several target dates with a single catalog query.
+
+    Parameters:
+        target_dates (list): Preferred dates in "YYYY-MM-DD" format.
+        Other parameters are the same as for `find_nearest_available_date`.
+
+    Returns:
+        dict: Mapping of each target date to its nearest valid acquisition date, or None if there is none within ±`max_days`.
+    """
+    windows = [search_window(target_date, max_days) for target_date in target_dates]
+    get_acquisition_dates(
+        catalog, geometry, (min(w[0] for w in windows), max(w[1] for w in windows)),
+        cloud_cover_limit=cloud_cover_limit, data_collection=data_collection, cache=cache
+    )
+    index = get_acquisition_index(geometry, data_collection, cloud_cover_limit)
+    return {target_date: index.nearest(target_date, max_days) for target_date in target_dates}
 
 def get_scaled_dimensions(geometry, max_dim=2500):
     """
@@ -99,32 +135,49 @@ def get_scaled_dimensions(geometry, max_dim=2500):
         height *= scale_factor
     return int(width), int(height)
 
+def get_tile_grid(geometry, max_dim=2500, resolution=10):
+    """
+    Split the AOI bounding box into a grid of tiles that each fit within the Sentinel Hub size limit.
+
+    Parameters:
+        geometry (Geometry): The area of interest (AOI) as a sentinelhub Geometry.
+        max_dim (int): Maximum width/height in pixels of a single tile. Default is 2500.
+        resolution (int): Target resolution in meters. Default is 10 (native Sentinel-2 resolution).
+
+    Returns:
+        tuple: (width, height, tiles) where width and height are the dimensions of the full mosaic in pixels
+        and tiles is a list of (Window, BBox) pairs. Tiles that don't intersect the AOI polygon are skipped.
+
+    Notes:
+        - Tile edges are computed in pixel space so that adjacent tiles share their borders exactly
+          and the mosaic has the same grid as a single request over the whole bbox would have.
+    """
+    bbox = geometry.bbox
+    width, height = bbox_to_dimensions(bbox, (resolution, resolution))
+    n_cols = math.ceil(width / max_dim)
+    n_rows = math.ceil(height / max_dim)
+
+    col_edges = [round(k * width / n_cols) for k in range(n_cols + 1)]
+    row_edges = [round(k * height / n_rows) for k in range(n_rows + 1)]
+    x_res = (bbox.max_x - bbox.min_x) / width
+    y_res = (bbox.max_y - bbox.min_y) / height
+
+    tiles = []
+    for row_start, row_stop in zip(row_edges[:-1], row_edges[1:]):
+        for col_start, col_stop in zip(col_edges[:-1], col_edges[1:]):
+            # Rows are counted from the top of the image, i.e. from max_y
+            tile_bbox = BBox(
+                (
+                    bbox.min_x + col_start * x_res,
+                    bbox.max_y - row_stop * y_res,
+                    bbox.min_x + col_stop * x_res,
+                    bbox.max_y - row_start * y_res,
+                ),
+                crs=bbox.crs,
+            )
+            if not geometry.geometry.intersects(tile_bbox.geometry):
+                continue
+            window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+            tiles.append((window, tile_bbox))
+    return width, height, tiles
 
-#The following functions are used to cut my image in 512x512 tiles to feed my model
-# --- Padding ---
-def pad_to_multiple(image, multiple=512):
-    """Pad the image (C, H, W) to the next multiple of `multiple`."""
-    _, h, w = image.shape
-    pad_h = (math.ceil(h / multiple) * multiple) - h
-    pad_w = (math.ceil(w / multiple) * multiple) - w
-    return F.pad(image, (0, pad_w, 0, pad_h)), pad_h, pad_w  # (left, right, top, bottom)
-
-# --- Patch Extraction ---
-def extract_patches(image, patch_size=512):
-    """Extract non-overlapping patches from image (C, H, W)."""
-    _, h, w = image.shape
-    patches = []
-    for i in range(0, h, patch_size):
-        for j in range(0, w, patch_size):
-            patch = image[:, i:i+patch_size, j:j+patch_size]
-            patches.append(((i, j), patch))
-    return patches
-
-# --- Stitch Patches Back ---
-def stitch_patches(patches, original_shape, patch_size=512):
-    """Reconstruct the full mask from patch predictions."""
-    C, H, W = original_shape
-    output = torch.zeros((C, H, W))
-    for (i, j), patch in patches:
-        output[:, i:i+patch_size, j:j+patch_size] = patch
-    return output
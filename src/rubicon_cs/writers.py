@@ -0,0 +1,107 @@
+"""
+Streaming writer for vegetation index time series stored as Cloud-Optimized GeoTIFFs.
+"""
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+
+@contextmanager
+def open_cog_writer(path, width, height, count, dtype, crs, transform, nodata=None, compress="deflate",
+                    blocksize=512, overviews=True):
+    """
+    Open a GeoTIFF for band-by-band (or window-by-window) writing and save it as a Cloud-Optimized GeoTIFF on close.
+
+    Bands are written as soon as they are available into a tiled scratch file next to `path`, so nothing
+    has to be kept in memory. When the context exits, the scratch file is copied with GDAL's COG driver
+    into a tiled, compressed file with internal overviews and then removed.
+
+    Parameters:
+        path (str): Output path.
+        width, height, count (int): Raster size and number of bands.
+        dtype: Data type of the bands, e.g. np.float32.
+        crs, transform: Georeferencing of the raster.
+        nodata: Optional nodata value.
+        compress (str): 'deflate', 'zstd' (if supported by the GDAL build) or 'none'. A predictor suited
+            to the data type is always used with compression. Default is 'deflate'.
+        blocksize (int): Size of the internal tiles. Default is 512.
+        overviews (bool): Whether to build internal overviews. Default is True.
+
+    Yields:
+        rasterio dataset opened in write mode. Band tags, scales and offsets set on it are kept in the final file.
+    """
+    scratch_path = f"{path}.partial.tif"
+    try:
+        # The scratch file is tiled but uncompressed: windows written by the tiled fetch don't have to be
+        # aligned on the internal tiles, and rewriting compressed tiles would bloat the file
+        with rasterio.open(
+            scratch_path, "w",
+            driver="GTiff",
+            width=width,
+            height=height,
+            count=count,
+            dtype=dtype,
+            crs=crs,
+            transform=transform,
+            nodata=nodata,
+            tiled=True,
+            blockxsize=blocksize,
+            blockysize=blocksize,
+            BIGTIFF="IF_SAFER",
+        ) as dst:
+            yield dst
+
+        creation_options = dict(
+            blocksize=blocksize,
+            overviews="AUTO" if overviews else "NONE",
+            overview_resampling="AVERAGE",
+            BIGTIFF="IF_SAFER",
+        )
+        if compress and compress.lower() != "none":
+            creation_options.update(compress=compress.upper(), predictor="YES")
+        rasterio.shutil.copy(scratch_path, path, driver="COG", **creation_options)
+    finally:
+        if os.path.exists(scratch_path):
+            os.remove(scratch_path)
+
+
+def read_overview(tiff, band, max_size=1024):
+    """
+    Read a band downsampled so that its largest side is at most `max_size` pixels.
+
+    GDAL serves such decimated reads from the internal overviews of a COG, so only a small part of the file is read.
+
+    Parameters:
+        tiff: Open rasterio dataset.
+        band (int): 1-based band index.
+        max_size (int): Maximum width/height of the returned array. None reads the full resolution band.
+    """
+    if max_size is None or max(tiff.width, tiff.height) <= max_size:
+        return read_band(tiff, band)
+    scale = max_size / max(tiff.width, tiff.height)
+    out_shape = (max(1, int(tiff.height * scale)), max(1, int(tiff.width * scale)))
+    return read_band(tiff, band, out_shape=out_shape, resampling=Resampling.average)
+
+
+def read_band(tiff, band, **kwargs):
+    """
+    Read a band, dequantizing the integer bands of quantized files (see rubicon_cs.quantize) to float32.
+
+    The scale/offset of the band are applied and its nodata pixels become NaN. Other bands are returned as stored.
+    Keyword arguments are passed to `tiff.read`, e.g. `window`.
+    """
+    scale, offset = tiff.scales[band - 1], tiff.offsets[band - 1]
+    if np.dtype(tiff.dtypes[band - 1]).kind not in "iu" or (scale, offset) == (1.0, 0.0):
+        return tiff.read(band, **kwargs)
+    data = tiff.read(band, masked=True, **kwargs)
+    return (data.astype(np.float32) * np.float32(scale) + np.float32(offset)).filled(np.nan)
+
+
+def read_band_dates(path):
+    """Return the DATE tag of each band of a GeoTIFF, in band order."""
+    with rasterio.open(path) as tiff:
+        return [tiff.tags(band).get("DATE") for band in range(1, tiff.count + 1)]
@@ -0,0 +1,27 @@
+import torch
+
+from rubicon_cs import backends
+from rubicon_cs.segmentation import semantic_segmentation_large_image
+
+
+class SmallSegmentationModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.conv = torch.nn.Conv2d(3, 4, 3, padding=1)
+
+    def forward(self, x):
+        return self.conv(x), None
+
+
+def test_torchscript_backend_matches_eager_with_partial_last_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(backends, "DEFAULT_CACHE_DIR", str(tmp_path))
+    model = SmallSegmentationModel()
+    image = torch.rand(3, 200, 130)  # 12 patches of 64 px: batches of 5, 5 and 2
+
+    expected = semantic_segmentation_large_image(image, model, "cpu", patch_size=64, batch_size=5)
+    actual = semantic_segmentation_large_image(image, model, "cpu", patch_size=64, batch_size=5,
+                                               backend="torchscript")
+
+    torch.testing.assert_close(actual, expected, atol=1e-4, rtol=1e-4)
+    assert len(list(tmp_path.glob("torchscript-*.pt"))) == 1
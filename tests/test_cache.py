@@ -0,0 +1,33 @@
+import os
+
+from rubicon_cs.cache import ResponseCache
+
+
+def test_get_returns_entries_evicted_after_they_were_read(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path)
+    cache.put("ab" * 32, b"response")
+
+    def evicted(path, *args, **kwargs):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(os, "utime", evicted)
+    assert cache.get("ab" * 32) == b"response"
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert cache.get("cd" * 32) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_overwrites_are_counted_once_in_the_size(tmp_path):
+    cache = ResponseCache(tmp_path, max_bytes=25)
+    cache.put("ab" * 32, b"x" * 10)
+    cache.put("cd" * 32, b"y" * 10)
+    for _ in range(3):
+        cache.put("ab" * 32, b"z" * 10)
+    assert cache._size == 20 == sum(size for _, size, _ in cache._entries())
+    assert cache.get("cd" * 32) == b"y" * 10
+    assert cache.get("ab" * 32) == b"z" * 10
+
+
+def test_cache_dir_expands_user(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    assert ResponseCache("~/responses").cache_dir == str(tmp_path / "responses")
@@ -0,0 +1,89 @@
+from datetime import date, timedelta
+
+from sentinelhub import CRS, Geometry
+from shapely.geometry import box
+
+from rubicon_cs.catalog import AcquisitionIndex, get_acquisition_dates, search_window
+from rubicon_cs.instrumentation import recording
+
+
+class FakeCatalog:
+    def __init__(self, dates):
+        self.dates = dates
+        self.searches = []
+
+    def search(self, data_collection, geometry, time, **kwargs):
+        self.searches.append(time)
+        start, end = time
+        return [{"properties": {"datetime": f"{day}T10:30:00Z"}} for day in self.dates if start <= day <= end]
+
+
+def make_geometry(offset):
+    # A distinct AOI per test, as acquisition indexes are memoized for the whole process
+    return Geometry(box(offset, 45.0, offset + 0.01, 45.01), CRS.WGS84)
+
+
+def test_adjacent_and_overlapping_windows_merge():
+    index = AcquisitionIndex()
+    index.add("2024-09-01", "2024-09-10", ["2024-09-03"])
+    index.add("2024-09-11", "2024-09-20", ["2024-09-13"])
+    index.add("2024-09-25", "2024-09-30", [])
+    index.add("2024-09-28", "2024-10-05", ["2024-10-02"])
+
+    assert index.intervals == [("2024-09-01", "2024-09-20"), ("2024-09-25", "2024-10-05")]
+    assert index.covers("2024-09-05", "2024-09-15")
+    assert not index.covers("2024-09-15", "2024-09-26")
+    assert index.dates == ["2024-09-03", "2024-09-13", "2024-10-02"]
+
+
+def test_adjacent_windows_merge_across_month_ends():
+    index = AcquisitionIndex()
+    index.add("2024-03-01", "2024-03-31", [])
+    index.add("2024-02-01", "2024-02-29", [])
+
+    assert index.intervals == [("2024-02-01", "2024-03-31")]
+
+
+def test_empty_window_registers_dates_only():
+    index = AcquisitionIndex()
+    index.add("2024-09-10", "2024-09-09", ["2024-09-10"])
+
+    assert index.intervals == []
+    assert index.dates == ["2024-09-10"]
+    assert not index.covers("2024-09-10", "2024-09-10")
+
+
+def test_nearest_prefers_later_date_on_tie():
+    index = AcquisitionIndex()
+    index.add("2024-09-01", "2024-09-30", ["2024-09-08", "2024-09-12", "2024-09-25"])
+
+    assert index.nearest("2024-09-10", 5) == "2024-09-12"
+    assert index.nearest("2024-09-09", 5) == "2024-09-08"
+    assert index.nearest("2024-09-18", 5) is None
+    assert index.dates_between(*search_window("2024-09-10", 2)) == ["2024-09-08", "2024-09-12"]
+
+
+def test_searched_windows_are_answered_locally():
+    catalog = FakeCatalog(["2024-09-03", "2024-09-13", "2024-09-23"])
+    geometry = make_geometry(1.0)
+
+    with recording() as recorder:
+        first = get_acquisition_dates(catalog, geometry, ("2024-09-01", "2024-09-10"))
+        second = get_acquisition_dates(catalog, geometry, ("2024-09-11", "2024-09-20"))
+        inside = get_acquisition_dates(catalog, geometry, ("2024-09-02", "2024-09-15"))
+
+    assert (first, second, inside) == (["2024-09-03"], ["2024-09-13"], ["2024-09-03", "2024-09-13"])
+    assert catalog.searches == [("2024-09-01", "2024-09-10"), ("2024-09-11", "2024-09-20")]
+    assert recorder.stages[("catalog_search", ())][0] == 2
+
+
+def test_windows_reaching_today_are_searched_again():
+    today = date.today()
+    catalog = FakeCatalog([(today - timedelta(days=3)).isoformat()])
+    geometry = make_geometry(2.0)
+    window = ((today - timedelta(days=5)).isoformat(), today.isoformat())
+
+    assert get_acquisition_dates(catalog, geometry, window) == catalog.dates
+    catalog.dates.append(today.isoformat())
+    assert get_acquisition_dates(catalog, geometry, window) == catalog.dates
+    assert len(catalog.searches) == 2
@@ -0,0 +1,133 @@
+import json
+
+import pytest
+
+from rubicon_cs import cli
+
+AOI = {"type": "Polygon", "coordinates": [[[2.30, 48.80], [2.31, 48.80], [2.31, 48.81], [2.30, 48.81], [2.30, 48.80]]]}
+OTHER_AOI = {"type": "Polygon", "coordinates": [[[3.30, 48.80], [3.31, 48.80], [3.31, 48.81], [3.30, 48.81], [3.30, 48.80]]]}
+
+
+def write_manifest(path, jobs):
+    path.write_text("".join(json.dumps(job) + "\n" for job in jobs))
+    return str(path)
+
+
+def test_manifest_jobs_are_normalized(tmp_path):
+    aoi_path = tmp_path / "aoi.geojson"
+    aoi_path.write_text(json.dumps({"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": AOI}]}))
+    manifest = write_manifest(tmp_path / "jobs.jsonl", [
+        {"id": "a", "aoi": str(aoi_path), "date_range": ["2024-08-20", "2024-09-10"], "index": "NDVI"},
+        {"aoi": {"type": "Feature", "geometry": AOI}, "date_range": ["2024-08-20", "2024-09-10"],
+         "indices": ["ndvi", "gndvi"], "cloud_cover_limit": 10, "output_dir": "out"},
+    ])
+
+    first, second = cli.read_manifest(manifest)
+
+    assert first == {"id": "a", "aoi": AOI, "date_range": ["2024-08-20", "2024-09-10"], "indices": ["ndvi"],
+                     "cloud_cover_limit": 20, "output_dir": cli.DEFAULT_OUTPUT_DIR, "tiled": False}
+    assert second["aoi"] == AOI and second["indices"] == ["ndvi", "gndvi"] and second["cloud_cover_limit"] == 10
+    # Ids default to a hash of the job, stable across reads
+    assert second["id"] == cli.read_manifest(manifest)[1]["id"]
+
+
+def test_manifest_errors(tmp_path):
+    job = {"id": "a", "aoi": AOI, "date_range": ["2024-08-20", "2024-09-10"], "index": "ndvi"}
+    missing = write_manifest(tmp_path / "missing.jsonl", [{"aoi": AOI, "index": "ndvi"}])
+    duplicate = write_manifest(tmp_path / "duplicate.jsonl", [job, job])
+
+    with pytest.raises(ValueError, match="missing.jsonl:1: missing job field 'date_range'"):
+        cli.read_manifest(missing)
+    with pytest.raises(ValueError, match="Duplicate job ids"):
+        cli.read_manifest(duplicate)
+
+
+def test_plan_groups_jobs_by_aoi_then_fetch():
+    jobs = [
+        {"id": "1", "aoi": AOI, "date_range": ["2024-08-01", "2024-08-31"], "indices": ["ndvi"],
+         "cloud_cover_limit": 20, "output_dir": "out", "tiled": False},
+        {"id": "2", "aoi": AOI, "date_range": ["2024-08-01", "2024-08-31"], "indices": ["gndvi", "ndvi"],
+         "cloud_cover_limit": 20, "output_dir": "out", "tiled": False},
+        {"id": "3", "aoi": AOI, "date_range": ["2024-08-15", "2024-09-15"], "indices": ["evi"],
+         "cloud_cover_limit": 20, "output_dir": "out", "tiled": False},
+        {"id": "4", "aoi": AOI, "date_range": ["2024-08-01", "2024-08-31"], "indices": ["ndvi"],
+         "cloud_cover_limit": 50, "output_dir": "out", "tiled": False},
+        {"id": "5", "aoi": OTHER_AOI, "date_range": ["2024-08-01", "2024-08-31"], "indices": ["ndvi"],
+         "cloud_cover_limit": 20, "output_dir": "out", "tiled": False},
+    ]
+
+    plan = cli.plan_jobs(jobs)
+
+    assert [[[job["id"] for job in fetch["jobs"]] for fetch in unit["fetches"]] for unit in plan] == [
+        [["1", "2"], ["3"]], [["4"]], [["5"]]
+    ]
+    unit = plan[0]
+    assert unit["date_span"] == ["2024-08-01", "2024-09-15"]
+    assert unit["bands"] == cli.required_bands(["evi", "gndvi", "ndvi"])
+    assert [fetch["indices"] for fetch in unit["fetches"]] == [["gndvi", "ndvi"], ["evi"]]
+
+
+@pytest.fixture
+def fake_fetches(monkeypatch):
+    """Replace Sentinel Hub by fakes, recording the fetched (date_range, indices) and failing on demand."""
+    calls = {"fetches": [], "searches": [], "fail": set()}
+
+    class FakeClient:
+        catalog = object()
+
+        @classmethod
+        def from_secrets(cls, cache=None):
+            return cls()
+
+    def get_acquisition_dates(catalog, geometry, time_interval, cloud_cover_limit, cache=None):
+        calls["searches"].append(list(time_interval))
+
+    def geotiff_for_veg_indices(aoi, date_range, veg_indices, **kwargs):
+        calls["fetches"].append((tuple(date_range), tuple(veg_indices)))
+        if tuple(date_range) in calls["fail"]:
+            raise RuntimeError("download failed")
+
+    monkeypatch.setattr(cli, "resolve_cache", lambda cache: None)
+    monkeypatch.setattr(cli, "RateLimitedDownloadClient", FakeClient)
+    monkeypatch.setattr(cli, "get_acquisition_dates", get_acquisition_dates)
+    monkeypatch.setattr(cli, "geotiff_for_veg_indices", geotiff_for_veg_indices)
+    return calls
+
+
+def test_batch_resumes_failed_jobs_only(tmp_path, fake_fetches):
+    manifest = write_manifest(tmp_path / "jobs.jsonl", [
+        {"id": "august", "aoi": AOI, "date_range": ["2024-08-01", "2024-08-31"], "index": "ndvi",
+         "output_dir": str(tmp_path / "out")},
+        {"id": "august-gndvi", "aoi": AOI, "date_range": ["2024-08-01", "2024-08-31"], "index": "gndvi",
+         "output_dir": str(tmp_path / "out")},
+        {"id": "september", "aoi": AOI, "date_range": ["2024-09-01", "2024-09-30"], "index": "ndvi",
+         "output_dir": str(tmp_path / "out")},
+    ])
+    status_path = tmp_path / "jobs.status.jsonl"
+    fake_fetches["fail"].add(("2024-09-01", "2024-09-30"))
+
+    assert cli.run_batch(manifest, jobs=2) == {"skipped": 0, "ok": 2, "failed": 1}
+    assert fake_fetches["searches"] == [["2024-08-01", "2024-09-30"]]
+    assert sorted(fake_fetches["fetches"]) == [
+        (("2024-08-01", "2024-08-31"), ("gndvi", "ndvi")), (("2024-09-01", "2024-09-30"), ("ndvi",))
+    ]
+    statuses = cli.read_status(str(status_path))
+    assert statuses["august"]["outputs"] == [f"{tmp_path / 'out'}/2024-08-01_2024-08-31_ndvi.tif"]
+    assert statuses["september"]["status"] == "failed" and "download failed" in statuses["september"]["error"]
+
+    fake_fetches["fail"].clear()
+    fake_fetches["fetches"].clear()
+    assert cli.run_batch(manifest) == {"skipped": 2, "ok": 1, "failed": 0}
+    assert fake_fetches["fetches"] == [(("2024-09-01", "2024-09-30"), ("ndvi",))]
+    assert cli.run_batch(manifest) == {"skipped": 3, "ok": 0, "failed": 0}
+    assert cli.read_status(str(status_path))["september"]["status"] == "ok"
+
+
+def test_dry_run_fetches_nothing(tmp_path, fake_fetches):
+    manifest = write_manifest(tmp_path / "jobs.jsonl", [
+        {"id": "august", "aoi": AOI, "date_range": ["2024-08-01", "2024-08-31"], "index": "ndvi"},
+    ])
+
+    assert cli.run_batch(manifest, dry_run=True) == {"skipped": 0, "ok": 0, "failed": 0}
+    assert fake_fetches["fetches"] == [] and fake_fetches["searches"] == []
+    assert not (tmp_path / "jobs.status.jsonl").exists()
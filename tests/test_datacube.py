@@ -0,0 +1,62 @@
+import json
+
+import numpy as np
+import pytest
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+pytest.importorskip("xarray")
+pytest.importorskip("zarr")
+pytest.importorskip("dask")
+
+from rubicon_cs.datacube import (  # noqa: E402
+    datacube_transform, open_datacube, open_zarr_writer, pixel_history, read_date, read_window,
+)
+
+DATES = ["2024-09-01", "2024-09-06", "2024-09-11"]
+TRANSFORM = from_origin(600000.0, 5400000.0, 10.0, 10.0)
+
+
+def write_datacube(path, values):
+    """Write each date as four tiles that are not aligned on the (2, 16, 16) chunks."""
+    with open_zarr_writer(path, 40, 30, DATES, np.float32, CRS.from_epsg(32631), TRANSFORM, variable="ndvi",
+                          chunks=(2, 16, 16)) as writer:
+        for band, date_values in enumerate(values, start=1):
+            for row, col in ((0, 0), (0, 20), (15, 0), (15, 20)):
+                window = Window(col, row, 20, 15)
+                writer.write(date_values[row:row + 15, col:col + 20], band, window=window)
+            writer.update_tags(band, DATE=DATES[band - 1])
+
+
+def test_datacube_round_trip(tmp_path):
+    values = np.random.default_rng(0).random((3, 30, 40)).astype(np.float32)
+    values[1, :10] = np.nan
+    path = str(tmp_path / "ndvi.zarr")
+    write_datacube(path, values)
+
+    ds = open_datacube(path)
+    assert datacube_transform(ds) == TRANSFORM
+    assert json.loads(ds.attrs["band_tags"])["2024-09-06"] == {"DATE": "2024-09-06"}
+    np.testing.assert_allclose(ds["valid_fraction"].values, [1, 2 / 3, 1])
+
+    np.testing.assert_array_equal(read_date(ds, "2024-09-06").values, values[1])
+    window = Window(5, 8, 12, 10)
+    np.testing.assert_array_equal(read_window(ds, window).values, values[:, 8:18, 5:17])
+    np.testing.assert_array_equal(read_window(ds, window, time=slice("2024-09-05", "2024-09-30")).values,
+                                  values[1:, 8:18, 5:17])
+    # Pixel (row 12, col 7), by the coordinates of its center
+    x, y = TRANSFORM @ (7.5, 12.5)
+    np.testing.assert_array_equal(pixel_history(ds, x, y).values, values[:, 12, 7])
+
+
+def test_datacube_metadata_is_written_when_the_body_fails(tmp_path):
+    path = str(tmp_path / "ndvi.zarr")
+    with pytest.raises(RuntimeError):
+        with open_zarr_writer(path, 40, 30, DATES, np.float32, CRS.from_epsg(32631), TRANSFORM) as writer:
+            writer.write(np.ones((30, 40), dtype=np.float32), 1)
+            raise RuntimeError("download failed")
+
+    ds = open_datacube(path)
+    assert "band_tags" in ds.attrs
+    np.testing.assert_allclose(ds["valid_fraction"].values, [1, 0, 0])
@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+import requests
+from sentinelhub import SHConfig
+from sentinelhub.download.models import DownloadRequest
+from sentinelhub.exceptions import DownloadFailedException
+
+from rubicon_cs import download
+from rubicon_cs.download import RateLimitedDownloadClient, _InstrumentedSession, iter_downloads
+
+
+def fetch_token(session, request):
+    """Token of a fake OAuth server, counting the fetches in `fetch_token.calls`."""
+    fetch_token.calls += 1
+    return {"access_token": "token", "expires_at": time.time() + 3600}
+
+
+def make_client(delays):
+    """Client answering the request of URL .../i with the bytes of i after delays[i] seconds, without network."""
+    client = RateLimitedDownloadClient(config=SHConfig(), max_attempts=1)
+    threads = set()
+
+    def do_download(request):
+        threads.add(threading.get_ident())
+        index = int(request.url.rsplit("/", 1)[1])
+        time.sleep(delays[index])
+        response = requests.Response()
+        response.status_code = 200 if index >= 0 else 500
+        response._content = str(index).encode()
+        return response
+
+    client._do_download = do_download
+    client.download = None  # iter_downloads must not go through the per-call thread pool of `download`
+    return client, threads
+
+
+def make_requests(count):
+    return [DownloadRequest(url=f"https://services.sentinel-hub.com/api/v1/process/{i}") for i in range(count)]
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_iter_downloads_yields_every_request(ordered):
+    delays = [0.2, 0.0, 0.0, 0.1, 0.0, 0.0]
+    client, threads = make_client(delays)
+
+    results = list(iter_downloads(make_requests(len(delays)), client, max_workers=3, ordered=ordered))
+    assert sorted(results) == [(i, str(i).encode()) for i in range(len(delays))]
+    if ordered:
+        assert [index for index, _ in results] == list(range(len(delays)))
+    else:
+        assert results[-1][0] == 0  # the slow first response doesn't hold back the others
+    assert len(threads) <= 3
+
+
+def test_iter_downloads_raises_failed_downloads():
+    client, _ = make_client({-1: 0.0})
+    with pytest.raises(DownloadFailedException):
+        list(iter_downloads([DownloadRequest(url="https://services.sentinel-hub.com/api/v1/process/-1")], client))
+
+
+def test_threads_share_one_client_session_and_token(monkeypatch):
+    fetch_token.calls = 0
+    monkeypatch.setattr(_InstrumentedSession, "_fetch_token", fetch_token)
+    client = RateLimitedDownloadClient(config=SHConfig(sh_client_id="id", sh_client_secret="secret"), max_attempts=1)
+    authorizations = []
+
+    def request(method, url, json=None, headers=None, timeout=None):
+        authorizations.append(headers["Authorization"])
+        response = requests.Response()
+        response.status_code = 200
+        response._content = url.rsplit("/", 1)[1].encode()
+        return response
+
+    monkeypatch.setattr(client.http_session, "request", request)
+    download_requests = [DownloadRequest(url=f"https://services.sentinel-hub.com/api/v1/process/{i}",
+                                         use_session=True) for i in range(5)]
+    results = [None] * 4
+
+    def run(thread_index):
+        results[thread_index] = client.download(download_requests, max_threads=2)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [[str(i).encode() for i in range(5)]] * 4
+    assert authorizations == ["Bearer token"] * 20
+    assert fetch_token.calls == 1
+
+
+def test_copies_share_connections_session_and_catalog(monkeypatch):
+    fetch_token.calls = 0
+    monkeypatch.setattr(_InstrumentedSession, "_fetch_token", fetch_token)
+    client = RateLimitedDownloadClient(config=SHConfig(sh_client_id="id", sh_client_secret="secret"))
+    cache = object()
+
+    copy = client.with_cache(cache)
+
+    assert copy is not client and copy.cache is cache and client.cache is None
+    assert client.with_cache(None) is client
+    assert copy.http_session is client.http_session and copy.request_bucket is client.request_bucket
+    assert copy.get_session() is client.get_session()
+    assert copy.catalog is client.catalog
+    assert client.catalog.client.cache is None and client.catalog.client.get_session() is client.get_session()
+    assert fetch_token.calls == 1
+
+
+def test_default_client_is_built_once(monkeypatch):
+    monkeypatch.setattr(download, "_default_client", None)
+    monkeypatch.setenv("SH_CLIENT_ID", "id")
+    monkeypatch.setenv("SH_CLIENT_SECRET", "secret")
+    cache = object()
+
+    first = download.get_default_client()
+    second = download.get_default_client(cache)
+
+    assert first is download.get_default_client()
+    assert first.config.sh_client_id == "id" and first.config.sh_client_secret == "secret"
+    assert second.cache is cache and second.http_session is first.http_session
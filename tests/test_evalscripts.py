@@ -0,0 +1,34 @@
+import pytest
+
+from rubicon_cs.evalscripts import build_bands_evalscript
+
+# Script of build_bands_evalscript(["B02", "B04", "B08"]) before the sample_type option, which keys the
+# cached FLOAT32 band responses
+FLOAT32_BANDS_EVALSCRIPT = """
+//VERSION=3
+function setup() {
+    return {
+        input: ["B02", "B04", "B08", "dataMask"],
+        output: {
+            bands: 4,
+            sampleType: "FLOAT32"
+        }
+    };
+}
+function evaluatePixel(sample) {
+  return [sample.B02, sample.B04, sample.B08, sample.dataMask];
+}
+"""
+
+
+def test_float32_bands_evalscript_is_unchanged():
+    assert build_bands_evalscript(["B02", "B04", "B08"]) == FLOAT32_BANDS_EVALSCRIPT
+    assert build_bands_evalscript(["B02", "B04", "B08"], "FLOAT32") == FLOAT32_BANDS_EVALSCRIPT
+
+
+def test_uint16_bands_evalscript_requests_digital_numbers():
+    evalscript = build_bands_evalscript(["B04", "B08"], "UINT16")
+    assert 'input: [{ bands: ["B04", "B08", "dataMask"], units: "DN" }]' in evalscript
+    assert 'sampleType: "UINT16"' in evalscript
+    with pytest.raises(ValueError):
+        build_bands_evalscript(["B04"], "UINT8")
@@ -0,0 +1,24 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src"
+
+
+# Same modules as the TARGETS of benchmarks/import_time.py, without the timing budgets
+@pytest.mark.parametrize("module, forbidden", [
+    ("rubicon_cs.config", ("torch", "streamlit", "sentinelhub")),
+    ("rubicon_cs.main", ("torch", "streamlit", "matplotlib")),
+    ("rubicon_cs.cli", ("torch", "streamlit", "matplotlib")),
+    ("rubicon_cs.postprocess", ("torch", "streamlit", "sentinelhub")),
+    ("rubicon_cs.segmentation", ("streamlit", "sentinelhub")),
+])
+def test_entry_points_do_not_import_heavy_modules(module, forbidden):
+    probe = f"import sys, {module}; loaded = [name for name in {forbidden!r} if name in sys.modules]; " \
+            "assert not loaded, loaded"
+    result = subprocess.run([sys.executable, "-c", probe], env={**os.environ, "PYTHONPATH": str(SRC_DIR)},
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
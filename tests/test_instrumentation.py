@@ -0,0 +1,66 @@
+import json
+import time
+
+import requests
+from sentinelhub import SHConfig
+from sentinelhub.download.models import DownloadRequest
+
+from rubicon_cs.download import RateLimitedDownloadClient, _InstrumentedSession
+from rubicon_cs.instrumentation import recording
+
+
+def process_request(date):
+    time_range = {"from": f"{date}T00:00:00Z", "to": f"{date}T23:59:59Z"}
+    return DownloadRequest(url="https://services.sentinel-hub.com/api/v1/process",
+                           post_values={"input": {"data": [{"dataFilter": {"timeRange": time_range}}]}})
+
+
+def fake_response(status_code, content=b""):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    return response
+
+
+def test_download_bytes_and_retries_are_labelled_with_the_date(tmp_path):
+    client = RateLimitedDownloadClient(config=SHConfig(), backoff_factor=0)
+    responses = {"2024-09-01": [fake_response(429), fake_response(200, b"x" * 10)],
+                 "2024-09-06": [fake_response(200, b"x" * 3)]}
+    client._do_download = lambda request: responses[request.post_values["input"]["data"][0]["dataFilter"]
+                                                    ["timeRange"]["from"][:10]].pop(0)
+
+    metrics_path, log_path = tmp_path / "metrics.prom", tmp_path / "events.jsonl"
+    with recording(log_path=str(log_path), metrics_path=str(metrics_path)):
+        client.download([process_request("2024-09-01"), process_request("2024-09-06")], max_threads=1)
+
+    metrics = metrics_path.read_text().splitlines()
+    assert 'rubicon_cs_download_bytes_total{date="2024-09-01"} 10' in metrics
+    assert 'rubicon_cs_download_bytes_total{date="2024-09-06"} 3' in metrics
+    assert 'rubicon_cs_download_retries_total{date="2024-09-01"} 1' in metrics
+
+    counters = [event for event in map(json.loads, log_path.read_text().splitlines())
+                if event.get("type") == "counter"]
+    assert {(event["name"], event["labels"]["date"], event["value"]) for event in counters
+            if event["name"] in ("download_bytes", "download_retries")} == {
+        ("download_bytes", "2024-09-01", 10), ("download_bytes", "2024-09-06", 3),
+        ("download_retries", "2024-09-01", 1)}
+
+
+def test_oauth_stage_only_times_token_fetches(monkeypatch):
+    tokens = []
+
+    def fetch_token(session, request):
+        tokens.append({"access_token": "token", "expires_at": time.time() + (3600 if len(tokens) else 60)})
+        return tokens[-1]
+
+    monkeypatch.setattr(_InstrumentedSession, "_fetch_token", fetch_token)
+    client = RateLimitedDownloadClient(config=SHConfig(sh_client_id="id", sh_client_secret="secret"),
+                                       refresh_before_expiry=120)
+    request = DownloadRequest(url="https://services.sentinel-hub.com/api/v1/process", use_session=True)
+
+    with recording() as recorder:
+        for _ in range(5):
+            assert client._prepare_headers(request)["Authorization"] == "Bearer token"
+    # The first token expires within refresh_before_expiry and is refreshed once, the others are cached lookups
+    assert len(tokens) == 2
+    assert recorder.stages[("oauth", ())][0] == 2
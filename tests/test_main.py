@@ -0,0 +1,10 @@
+from rubicon_cs.main import store_key
+
+AOI = {"type": "Polygon", "coordinates": [[[2.0, 49.0], [2.01, 49.0], [2.01, 49.01], [2.0, 49.0]]]}
+
+
+def test_store_key_is_stable():
+    # Pinned: a new value would orphan the stores written by update_veg_index_store
+    assert store_key(AOI, 20) == "7ed362484c75"
+    assert store_key(dict(reversed(AOI.items())), 20) == "7ed362484c75"
+    assert store_key(AOI, 30) != store_key(AOI, 20)
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+import torch
+
+from rubicon_cs.patches import ClassMapStitcher, extract_patches, iter_patch_batches, pad_to_multiple, stitch_patches
+
+PATCH_SIZE = 32
+NUM_CLASSES = 4
+
+
+def make_logits(height, width, overlap, seed=0):
+    """Logits of a whole scene, padded and cut into patches like the segmentation pipeline does."""
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn((NUM_CLASSES, height, width), generator=generator)
+    padded, _, _ = pad_to_multiple(logits, PATCH_SIZE, stride=PATCH_SIZE - overlap)
+    return logits, extract_patches(padded, PATCH_SIZE, stride=PATCH_SIZE - overlap)
+
+
+def stitch(patches, shape, overlap=0, **kwargs):
+    stitcher = ClassMapStitcher(shape, PATCH_SIZE, overlap, **kwargs)
+    for (i, j), patch in patches:
+        stitcher.add(i, j, patch)
+    return stitcher.result()
+
+
+def test_without_overlap_matches_argmax_of_stitched_logits():
+    logits, patches = make_logits(70, 90, overlap=0)
+    padded_shape = (NUM_CLASSES, *pad_to_multiple(logits, PATCH_SIZE)[0].shape[1:])
+    expected = stitch_patches(patches, padded_shape, PATCH_SIZE).argmax(dim=0)[:70, :90].numpy()
+
+    class_map = stitch(patches, (70, 90))
+
+    assert class_map.dtype == np.uint8
+    np.testing.assert_array_equal(class_map, expected)
+
+
+@pytest.mark.parametrize("shape", [(70, 90), (32, 32), (33, 100), (56, 56)])
+def test_overlap_blending_keeps_consistent_predictions(shape):
+    # Neighbouring patches agree on their overlap, so any convex blend gives back the scene's argmax
+    logits, patches = make_logits(*shape, overlap=8)
+    probabilities = torch.softmax(logits, dim=0).numpy()
+
+    class_map, confidence = stitch(patches, shape, overlap=8, with_confidence=True)
+
+    np.testing.assert_array_equal(class_map, probabilities.argmax(axis=0))
+    expected_confidence = (probabilities.max(axis=0) * 255).astype(np.int16)
+    assert np.abs(confidence.astype(np.int16) - expected_confidence).max() <= 1
+
+
+def test_overlap_blends_disagreeing_patches_with_ramps():
+    # Two patches side by side that predict different classes: the class switches halfway through the overlap
+    first = torch.zeros((2, PATCH_SIZE, PATCH_SIZE))
+    first[0] = 5
+    second = torch.zeros((2, PATCH_SIZE, PATCH_SIZE))
+    second[1] = 5
+
+    class_map = stitch([((0, 0), first), ((0, 24), second)], (PATCH_SIZE, 56), overlap=8)
+
+    assert (class_map[:, :28] == 0).all()
+    assert (class_map[:, 28:] == 1).all()
+
+
+def test_class_map_can_be_memory_mapped(tmp_path):
+    logits, patches = make_logits(70, 90, overlap=8)
+    out_path = tmp_path / "class_map.npy"
+
+    class_map = stitch(patches, (70, 90), overlap=8, out_path=str(out_path))
+
+    assert isinstance(class_map, np.memmap)
+    np.testing.assert_array_equal(np.load(out_path), stitch(patches, (70, 90), overlap=8))
+
+
+def test_overlap_must_be_smaller_than_patches():
+    with pytest.raises(ValueError):
+        ClassMapStitcher((64, 64), PATCH_SIZE, overlap=PATCH_SIZE)
+
+
+def test_prefetched_batches_keep_order():
+    _, patches = make_logits(100, 100, overlap=0)
+
+    prefetched = list(iter_patch_batches(patches, batch_size=3, prefetch=2, channels_last=True))
+    inline = list(iter_patch_batches(patches, batch_size=3, prefetch=0))
+
+    assert [positions for positions, _ in prefetched] == [positions for positions, _ in inline]
+    assert [position for positions, _ in prefetched for position in positions] == [p for p, _ in patches]
+    for (_, batch), (_, expected) in zip(prefetched, inline):
+        assert batch.is_contiguous(memory_format=torch.channels_last)
+        torch.testing.assert_close(batch, expected)
+
+
+def test_prefetch_errors_reach_the_caller():
+    patches = [((0, 0), torch.zeros((1, 4, 4))), ((0, 4), torch.zeros((1, 5, 5)))]
+
+    with pytest.raises(RuntimeError):
+        list(iter_patch_batches(patches, batch_size=2, prefetch=2))
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import from_origin
+
+from rubicon_cs.postprocess import class_statistics, class_statistics_for_geotiff, pixel_area_hectares
+
+WGS84_TRANSFORM = from_origin(2.0, 49.0, 1e-4, 1e-4)
+
+
+def test_geographic_pixel_area_matches_equal_area_projection():
+    lons, lats = [2.0, 2.0001, 2.0001, 2.0], [49.0, 49.0, 48.9999, 48.9999]
+    x, y = map(np.array, Transformer.from_crs("EPSG:4326", "EPSG:3035", always_xy=True).transform(lons, lats))
+    expected = 0.5 * abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1))) / 10_000
+
+    assert pixel_area_hectares(WGS84_TRANSFORM, "EPSG:4326", 1)[0] == pytest.approx(expected, rel=1e-4)
+    np.testing.assert_allclose(pixel_area_hectares(from_origin(0, 0, 10, 10), "EPSG:32631", 2), [0.01, 0.01])
+
+
+def test_areas_require_a_crs():
+    with pytest.raises(ValueError):
+        class_statistics(np.zeros((4, 4), dtype=np.uint8), WGS84_TRANSFORM)
+
+
+def test_geotiff_statistics_of_a_wgs84_class_map(tmp_path):
+    class_map = np.random.default_rng(0).integers(0, 12, (600, 500)).astype(np.uint8)
+    path = tmp_path / "class_map.tif"
+    with rasterio.open(path, "w", driver="GTiff", height=600, width=500, count=1, dtype="uint8", crs="EPSG:4326",
+                       transform=WGS84_TRANSFORM, tiled=True, blockxsize=256, blockysize=256) as dst:
+        dst.write(class_map, 1)
+
+    statistics = class_statistics_for_geotiff(path)
+    in_memory = class_statistics(class_map, WGS84_TRANSFORM, crs="EPSG:4326")
+    total = pixel_area_hectares(WGS84_TRANSFORM, "EPSG:4326", 600).sum() * 500
+
+    assert sum(stats["hectares"] for stats in statistics.values()) == pytest.approx(total)
+    for label, stats in statistics.items():
+        assert stats["pixels"] == in_memory[label]["pixels"]
+        assert stats["hectares"] == pytest.approx(in_memory[label]["hectares"])
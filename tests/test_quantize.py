@@ -0,0 +1,89 @@
+import json
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from rubicon_cs.evalscripts import INDEX_DICT
+from rubicon_cs.indices import INDEX_FORMULAS, compute_indices, required_bands
+from rubicon_cs.quantize import (
+    INDEX_RANGES, QUANTIZATIONS, Quantization, RGB_QUANTIZATION, build_quantized_index_evalscript, dequantize, get_quantization,
+    max_quantization_error, quantize, quantized_range,
+)
+
+BANDS = required_bands(list(INDEX_FORMULAS))
+# Reflectances of B02, B03, B04, B05 and B08 of vegetation, bare soil, water and cloud
+ENDMEMBERS = np.array([
+    [0.03, 0.07, 0.04, 0.12, 0.40],
+    [0.10, 0.14, 0.18, 0.22, 0.28],
+    [0.06, 0.05, 0.03, 0.02, 0.01],
+    [0.45, 0.45, 0.45, 0.46, 0.50],
+])
+# Largest fraction of saturated values on the endmember mix, see the rubicon_cs.quantize docstring
+MAX_CLIPPED = {'INT16': 0.005, 'UINT8': 0.02}
+
+
+@pytest.fixture(scope="module")
+def reflectances():
+    rng = np.random.default_rng(1)
+    stack = rng.dirichlet(np.full(len(ENDMEMBERS), 0.3), 10_000) @ ENDMEMBERS
+    stack = stack * rng.normal(1.0, 0.1, stack.shape) + rng.normal(0.0, 0.005, stack.shape)
+    data_mask = (rng.random(len(stack)) > 0.05).astype(np.float32)
+    return np.clip(stack, 0.0, None).astype(np.float32), data_mask
+
+
+def run_evalscript(evalscript, stack, data_mask):
+    """Outputs of the evalscript's evaluatePixel on each pixel, run with Node.js."""
+    node = shutil.which("node")
+    if node is None:
+        pytest.skip("Node.js is needed to run the evalscripts")
+    samples = [{**dict(zip(BANDS, map(float, pixel))), "dataMask": float(mask)} for pixel, mask in zip(stack, data_mask)]
+    script = (evalscript + "\nconst samples = JSON.parse(require('fs').readFileSync(0, 'utf8'));\n"
+              "process.stdout.write(JSON.stringify(samples.map((sample) => evaluatePixel(sample))));\n")
+    result = subprocess.run([node, "-e", script], input=json.dumps(samples), capture_output=True, text=True,
+                            check=True)
+    return np.array(json.loads(result.stdout), dtype=np.float64)
+
+
+@pytest.mark.parametrize("quantization", list(QUANTIZATIONS))
+@pytest.mark.parametrize("veg_index", list(INDEX_FORMULAS))
+def test_index_reconstruction_error(reflectances, veg_index, quantization):
+    stack, data_mask = reflectances
+    values = compute_indices(stack[np.newaxis], BANDS, [veg_index], data_mask=data_mask[np.newaxis])[veg_index][0]
+    q = get_quantization(quantization, veg_index)
+    ints = quantize(values, q)
+    restored = dequantize(ints, q)
+
+    low, high = quantized_range(q)
+    if quantization == 'UINT8':
+        assert (low, high) == pytest.approx(INDEX_RANGES[veg_index])
+    finite = np.isfinite(values)
+    in_range = finite & (values >= low) & (values <= high)
+    assert np.abs(restored[in_range] - values[in_range]).max() <= max_quantization_error(q) + 1e-6
+    np.testing.assert_allclose(restored[finite & ~in_range], np.where(values > high, high, low)[finite & ~in_range],
+                               atol=1e-6)
+    assert 1 - in_range.sum() / finite.sum() <= MAX_CLIPPED[quantization]
+    np.testing.assert_array_equal(np.isnan(restored), ~finite)
+
+    # The evalscript returns the same integers, up to a step on rounding ties between float32 and float64
+    outputs = run_evalscript(build_quantized_index_evalscript(veg_index, quantization), stack, data_mask)[:, 0]
+    np.testing.assert_array_equal(outputs == q.nodata, ints == q.nodata)
+    assert np.abs(outputs - ints).max() <= 1
+    assert (outputs == ints).mean() > 0.99
+
+
+def test_quantize_rounds_halves_up_like_the_evalscripts():
+    q = Quantization("INT16", np.int16, 0.5, 0.0, -32768, -32767, 32767)
+    np.testing.assert_array_equal(quantize(np.array([0.25, -0.25, 0.75, -0.75, np.nan]), q), [1, 0, 2, -1, q.nodata])
+
+
+@pytest.mark.parametrize("evalscript", ["rgb", "rgb_optimized"])
+def test_rgb_evalscripts_fit_their_8_bit_output(reflectances, evalscript):
+    stack, data_mask = reflectances
+    rgb = run_evalscript(INDEX_DICT[evalscript], stack, data_mask)[:, :3]
+
+    # The AUTO sample type stretches [0, 1] to 0-255, values outside would be clipped
+    assert rgb.min() >= 0 and rgb.max() <= 1
+    restored = dequantize(quantize(rgb, RGB_QUANTIZATION), RGB_QUANTIZATION)
+    assert np.abs(restored - rgb).max() <= max_quantization_error(RGB_QUANTIZATION) + 1e-6
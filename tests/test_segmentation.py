@@ -0,0 +1,144 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+import torch
+from rasterio.transform import from_origin
+
+from rubicon_cs.instrumentation import recording
+from rubicon_cs.segmentation import segment_geotiff, semantic_segmentation_large_image
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src"
+
+
+class BrightestBand(torch.nn.Module):
+    """Parameter-free stand-in model: the class of a pixel is its brightest band."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def forward(self, x):
+        self.calls += 1
+        return x * 10, None
+
+
+def write_input(path, height=200, width=300):
+    image = np.random.default_rng(0).integers(0, 256, (3, height, width), dtype=np.uint8)
+    with rasterio.open(path, "w", driver="GTiff", height=height, width=width, count=3, dtype=np.uint8,
+                       crs="EPSG:4326", transform=from_origin(2.0, 49.0, 1e-4, 1e-4)) as dst:
+        dst.write(image)
+    return image
+
+
+def test_segment_geotiff_resumes_after_kill(tmp_path):
+    input_path = tmp_path / "input.tif"
+    image = write_input(input_path)
+    output_path = tmp_path / "class_map.tif"
+    kwargs = dict(window_size=64, patch_size=64, batch_size=1)  # 4 x 5 windows, one forward each
+
+    # A run killed while segmenting its 7th window
+    child = textwrap.dedent(f"""
+        import os, signal, torch
+        from rubicon_cs.segmentation import segment_geotiff
+
+        class KilledModel(torch.nn.Module):
+            calls = 0
+            def forward(self, x):
+                KilledModel.calls += 1
+                if KilledModel.calls == 7:
+                    os.kill(os.getpid(), signal.SIGKILL)
+                return x * 10, None
+
+        segment_geotiff({str(input_path)!r}, {str(output_path)!r}, KilledModel(), "cpu", **{kwargs!r})
+    """)
+    result = subprocess.run([sys.executable, "-c", child], env={**os.environ, "PYTHONPATH": str(SRC_DIR)},
+                            capture_output=True)
+    assert result.returncode == -signal.SIGKILL
+    assert not output_path.exists()
+    assert len(list(Path(f"{output_path}.parts").glob("*.npy"))) == 6
+
+    # Resuming only segments the 14 remaining windows
+    model = BrightestBand()
+    segment_geotiff(str(input_path), str(output_path), model, "cpu", **kwargs)
+    assert model.calls == 14
+    assert not Path(f"{output_path}.parts").exists()
+
+    with rasterio.open(output_path) as dst:
+        assert dst.crs.to_epsg() == 4326
+        class_map = dst.read(1)
+    np.testing.assert_array_equal(class_map, image.argmax(axis=0))
+
+
+def test_segment_geotiff_skips_complete_output(tmp_path):
+    input_path = tmp_path / "input.tif"
+    write_input(input_path, 64, 64)
+    output_path = tmp_path / "class_map.tif"
+    segment_geotiff(str(input_path), str(output_path), BrightestBand(), "cpu", window_size=64, patch_size=64)
+
+    model = BrightestBand()
+    segment_geotiff(str(input_path), str(output_path), model, "cpu", window_size=64, patch_size=64)
+    assert model.calls == 0
+
+
+def test_segment_geotiff_restarts_parts_of_another_configuration(tmp_path):
+    input_path = tmp_path / "input.tif"
+    image = write_input(input_path, 128, 128)
+    output_path = tmp_path / "class_map.tif"
+    parts_dir = Path(f"{output_path}.parts")
+
+    # Leave the parts of an interrupted run with 64 pixel windows, then resume with 128 pixel windows
+    class Interrupted(Exception):
+        pass
+
+    class InterruptedModel(BrightestBand):
+        def forward(self, x):
+            if self.calls == 2:
+                raise Interrupted
+            return super().forward(x)
+
+    with pytest.raises(Interrupted):
+        segment_geotiff(str(input_path), str(output_path), InterruptedModel(), "cpu", window_size=64, patch_size=64,
+                        batch_size=1)
+    assert len(list(parts_dir.glob("window_*.npy"))) == 2
+
+    model = BrightestBand()
+    segment_geotiff(str(input_path), str(output_path), model, "cpu", window_size=128, patch_size=64, batch_size=1)
+    assert model.calls == 4
+    with rasterio.open(output_path) as dst:
+        np.testing.assert_array_equal(dst.read(1), image.argmax(axis=0))
+
+
+def test_segment_geotiff_rejects_the_arguments_it_sets(tmp_path):
+    input_path = tmp_path / "input.tif"
+    write_input(input_path, 64, 64)
+    for kwargs in ({"output": "logits"}, {"with_confidence": True}, {"valid_mask": None}):
+        with pytest.raises(ValueError):
+            segment_geotiff(str(input_path), str(tmp_path / "class_map.tif"), BrightestBand(), "cpu", **kwargs)
+
+
+def test_nodata_patches_are_only_skipped_on_request():
+    image = torch.rand(3, 128, 128)
+    image[:, :64, :64] = 0  # an all-zero patch, predicted as class 0 by the model
+    kwargs = dict(patch_size=64, batch_size=1, output='class_map', background_class=2)
+
+    model = BrightestBand()
+    with recording() as recorder:
+        class_map = semantic_segmentation_large_image(image, model, "cpu", **kwargs)
+    assert model.calls == 4
+    assert recorder.counters[("skipped_patches", ())] == 0
+    np.testing.assert_array_equal(class_map, image.argmax(dim=0).numpy())
+
+    model = BrightestBand()
+    with recording() as recorder:
+        class_map = semantic_segmentation_large_image(image, model, "cpu", nodata_value=0, **kwargs)
+    assert model.calls == 3
+    assert recorder.counters[("skipped_patches", ())] == 1
+    assert (class_map[:64, :64] == 2).all()
+    np.testing.assert_array_equal(class_map[64:], image.argmax(dim=0).numpy()[64:])
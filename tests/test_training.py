@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+import rasterio
+import torch
+from rasterio.transform import from_origin
+
+from rubicon_cs.patches import extract_patches, find_valid_patches, pad_to_multiple
+from rubicon_cs.training import PatchShardDataset, augment_batch, measure_throughput, write_patch_shards
+
+PATCH_SIZE, STRIDE = 32, 24
+
+
+def make_scene(seed=0, height=70, width=90):
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 10000, (3, height, width), dtype=np.uint16)
+    label = rng.integers(0, 5, (height, width), dtype=np.uint8)
+    label[:, :40] = 255  # unlabeled patches are skipped
+    return image, label
+
+
+def write_geotiff(path, array):
+    array = array if array.ndim == 3 else array[None]
+    with rasterio.open(path, "w", driver="GTiff", height=array.shape[1], width=array.shape[2], count=array.shape[0],
+                       dtype=array.dtype, crs="EPSG:4326", transform=from_origin(2.0, 49.0, 1e-4, 1e-4)) as dst:
+        dst.write(array)
+    return str(path)
+
+
+def expected_patches(image, label):
+    """Patches of `extract_patches` that have at least one labeled pixel, as {(row, col): (image, label)}."""
+    padded_image, _, _ = pad_to_multiple(torch.from_numpy(image.astype(np.int32)), PATCH_SIZE, STRIDE)
+    # Shifted so that the zero padding of pad_to_multiple becomes the ignore index 255
+    padded_label, _, _ = pad_to_multiple(torch.from_numpy(label.astype(np.int32))[None] - 255, PATCH_SIZE, STRIDE)
+    labeled = find_valid_patches(torch.from_numpy(label != 255), PATCH_SIZE, STRIDE)
+    return {position: (patch.numpy(), label_patch[0].numpy() + 255)
+            for ((position, patch), (_, label_patch), keep) in zip(extract_patches(padded_image, PATCH_SIZE, STRIDE),
+                                                                    extract_patches(padded_label, PATCH_SIZE, STRIDE),
+                                                                    labeled) if keep}
+
+
+@pytest.fixture
+def shards(tmp_path):
+    scenes = [make_scene(0), make_scene(1)]
+    index_path = write_patch_shards(scenes, tmp_path / "shards", patch_size=PATCH_SIZE, stride=STRIDE, shard_size=5)
+    return scenes, index_path
+
+
+def test_shards_match_extract_patches(shards):
+    scenes, index_path = shards
+    dataset = PatchShardDataset(index_path)
+    positions = np.load(index_path.replace("index.json", "positions.npy"))
+
+    expected = [expected_patches(*scene) for scene in scenes]
+    assert [tuple(position) for position in positions] == [(source, *position) for source in range(len(scenes))
+                                                           for position in expected[source]]
+    assert dataset.num_samples == len(positions) == dataset.index["num_samples"]
+    assert len(dataset.index["shards"]) == -(-len(positions) // 5)
+    for i, (source, row, col) in enumerate(positions):
+        image, label = dataset.sample(i)
+        assert image.dtype == torch.uint16 and label.dtype == torch.uint8
+        np.testing.assert_array_equal(image.numpy(), expected[source][(row, col)][0])
+        np.testing.assert_array_equal(label.numpy(), expected[source][(row, col)][1])
+
+
+def test_geotiff_sources_give_the_same_shards(shards, tmp_path):
+    scenes, index_path = shards
+    paths = [(write_geotiff(tmp_path / f"image_{i}.tif", image), write_geotiff(tmp_path / f"label_{i}.tif", label))
+             for i, (image, label) in enumerate(scenes)]
+    geotiff_index_path = write_patch_shards(paths, tmp_path / "geotiff_shards", patch_size=PATCH_SIZE, stride=STRIDE,
+                                            shard_size=5)
+
+    arrays, geotiffs = PatchShardDataset(index_path), PatchShardDataset(geotiff_index_path)
+    assert geotiffs.num_samples == arrays.num_samples
+    for i in range(arrays.num_samples):
+        for from_array, from_geotiff in zip(arrays.sample(i), geotiffs.sample(i)):
+            np.testing.assert_array_equal(from_geotiff.numpy(), from_array.numpy())
+
+
+def test_batches_are_the_same_for_any_number_of_workers(shards):
+    _, index_path = shards
+    dataset = PatchShardDataset(index_path, batch_size=4, shuffle=True, augment=True, seed=3)
+    dataset.set_epoch(2)
+
+    epochs = {workers: list(torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=workers))
+              for workers in (0, 2)}
+    assert len(epochs[0]) == len(dataset) == dataset.num_samples // 4
+    for (images, labels), (worker_images, worker_labels) in zip(epochs[0], epochs[2], strict=True):
+        assert images.dtype == torch.float32 and labels.dtype == torch.int64
+        torch.testing.assert_close(worker_images, images, rtol=0, atol=0)
+        torch.testing.assert_close(worker_labels, labels, rtol=0, atol=0)
+
+    dataset.set_epoch(3)
+    next_epoch = next(iter(torch.utils.data.DataLoader(dataset, batch_size=None)))
+    assert not torch.equal(next_epoch[0], epochs[0][0][0])
+
+
+def test_augment_batch_applies_the_same_symmetry_to_image_and_label():
+    rng = np.random.default_rng(0)
+    labels = torch.from_numpy(rng.integers(0, 255, (64, 8, 8), dtype=np.uint8))
+    images = torch.from_numpy(np.stack([labels.numpy().astype(np.uint16) * (c + 1) for c in range(3)], axis=1))
+    originals = labels.numpy().copy()
+
+    augmented_images, augmented_labels = augment_batch(images, labels, np.random.default_rng(1))
+    assert augmented_images.shape == (64, 3, 8, 8) and augmented_images.dtype == torch.uint16
+    assert augmented_labels.shape == (64, 8, 8) and augmented_labels.dtype == torch.uint8
+    for c in range(3):
+        np.testing.assert_array_equal(augmented_images[:, c].numpy(), augmented_labels.numpy().astype(np.uint16) * (c + 1))
+
+    symmetries = set()
+    for original, label in zip(originals, augmented_labels.numpy()):
+        matches = [k + 4 * flip for flip in (0, 1) for k in range(4)
+                   if np.array_equal(np.rot90(original[:, ::-1] if flip else original, k), label)]
+        assert matches
+        symmetries.add(matches[0])
+    assert len(symmetries) == 8
+
+
+def test_measure_throughput_skips_the_warmup_batches():
+    batches = [(torch.zeros(4, 3, 8, 8), torch.zeros(4, 8, 8)) for _ in range(5)]
+    steps = []
+    stats = measure_throughput(batches, step=lambda images, labels: steps.append(len(images)), warmup=1)
+    assert len(steps) == 5
+    assert stats["batches"] == 4 and stats["samples"] == 16
+    assert 0 <= stats["data_wait_fraction"] <= 1
+    assert measure_throughput(batches, max_batches=2, warmup=0)["batches"] == 2
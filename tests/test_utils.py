@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from sentinelhub import CRS, Geometry
+from shapely.geometry import Polygon, box
+
+from rubicon_cs.utils import get_tile_grid
+
+
+def test_tiles_partition_the_mosaic_within_the_size_limit():
+    # About 5.5 x 3.3 km at 10 m, i.e. 3 x 2 tiles of at most 200 pixels
+    geometry = Geometry(box(2.30, 48.80, 2.3755, 48.83), CRS.WGS84)
+    width, height, tiles = get_tile_grid(geometry, max_dim=200)
+
+    assert len(tiles) == 6
+    coverage = np.zeros((height, width), dtype=np.int32)
+    for window, _ in tiles:
+        assert 0 < window.width <= 200 and 0 < window.height <= 200
+        coverage[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width] += 1
+    assert (coverage == 1).all()
+
+    bbox = geometry.bbox
+    x_res, y_res = (bbox.max_x - bbox.min_x) / width, (bbox.max_y - bbox.min_y) / height
+    for window, tile_bbox in tiles:
+        assert tile_bbox.crs == bbox.crs
+        assert tile_bbox.min_x == pytest.approx(bbox.min_x + window.col_off * x_res)
+        assert tile_bbox.max_y == pytest.approx(bbox.max_y - window.row_off * y_res)
+        assert tile_bbox.max_x - tile_bbox.min_x == pytest.approx(window.width * x_res)
+        assert tile_bbox.max_y - tile_bbox.min_y == pytest.approx(window.height * y_res)
+
+
+def test_small_aoi_is_a_single_tile():
+    geometry = Geometry(box(2.30, 48.80, 2.31, 48.81), CRS.WGS84)
+    width, height, tiles = get_tile_grid(geometry)
+
+    assert len(tiles) == 1
+    window, tile_bbox = tiles[0]
+    assert (window.col_off, window.row_off, window.width, window.height) == (0, 0, width, height)
+    assert tuple(tile_bbox) == pytest.approx(tuple(geometry.bbox))
+
+
+def test_tiles_outside_the_polygon_are_skipped():
+    # An L-shaped AOI whose arms stay clear of the top right quarter of its bounding box
+    polygon = Polygon([(2.30, 48.80), (2.40, 48.80), (2.40, 48.84), (2.34, 48.84), (2.34, 48.90), (2.30, 48.90)])
+    geometry = Geometry(polygon, CRS.WGS84)
+    full_width, full_height, _ = get_tile_grid(geometry, max_dim=10 ** 6)
+    width, height, tiles = get_tile_grid(geometry, max_dim=(max(full_width, full_height) + 1) // 2)
+
+    assert len(tiles) == 3
+    offsets = {(window.col_off, window.row_off) for window, _ in tiles}
+    assert (0, 0) in offsets
+    assert not any(col_off > 0 and row_off == 0 for col_off, row_off in offsets)
@@ -0,0 +1,28 @@
+import numpy as np
+from rasterio.windows import Window
+
+from rubicon_cs.zonal import ZonalTimeSeries
+
+
+def test_dates_without_in_zone_pixels_have_rows():
+    labels = np.zeros((4, 8), dtype=np.int32)
+    labels[:, :4] = 1
+    labels[:2, 2:4] = 2
+    time_series = ZonalTimeSeries(labels, ["a", "b"], percentiles=(50,))
+    left, right = Window(0, 0, 4, 4), Window(4, 0, 4, 4)
+
+    time_series.add("2024-09-01", left, {"ndvi": np.full((4, 4), 0.5, dtype=np.float32)})
+    time_series.add("2024-09-01", right, {"ndvi": np.full((4, 4), 0.9, dtype=np.float32)})
+    # Only the window outside the zones was delivered for this date
+    time_series.add("2024-09-06", right, {"ndvi": np.full((4, 4), 0.9, dtype=np.float32)})
+    time_series.add("2024-09-11", left, {"ndvi": np.full((4, 4), np.nan, dtype=np.float32)})
+    frame = time_series.to_frame().set_index(["date", "zone"])
+
+    assert len(frame) == 6
+    assert frame.loc[("2024-09-01", "a"), "mean"] == 0.5
+    assert frame.loc[("2024-09-01", "b"), "valid_fraction"] == 1
+    for date in ("2024-09-06", "2024-09-11"):
+        assert (frame.loc[date, "valid_fraction"] == 0).all()
+        assert frame.loc[date, ["mean", "std", "min", "max", "p50"]].isna().all(axis=None)
+    assert (frame.loc["2024-09-06", "pixels"] == 0).all()
+    assert (frame.loc["2024-09-11", "pixels"] == [12, 4]).all()